@@ -0,0 +1,133 @@
+import asyncio
+import itertools
+import threading
+from collections import deque
+
+# === サーバー全体の同時実行数の制御 (admission.py) ===
+# 各実行 (run) が同時に処理するレコード数を、サーバー全体の上限と利用者ごとの上限で制限する。
+# 枠が空いたときは、待っている実行のうち現在の使用数が最も少ない実行に渡す (公平な配分)。
+# Streamlit のセッションはそれぞれ別スレッドのイベントループで実行されるため、状態はロックで保護し、
+# 待っている側の起床は call_soon_threadsafe で行う。
+
+SERVER_MAX_CONCURRENT_RECORDS = 50 # サーバー全体で同時に処理するレコード数の上限
+USER_MAX_CONCURRENT_RECORDS = 25 # 利用者1人あたりの上限 (複数の実行を合わせた数)
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "seq", "granted")
+
+    def __init__(self, loop, future, seq):
+        self.loop = loop
+        self.future = future
+        self.seq = seq # 待ち始めた順番 (同じ使用数の実行の間では先に待った方を優先する)
+        self.granted = False
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """サーバー全体で共有する同時実行枠 (スレッドセーフ)"""
+
+    def __init__(self, capacity=SERVER_MAX_CONCURRENT_RECORDS, per_user=USER_MAX_CONCURRENT_RECORDS):
+        self.capacity = capacity
+        self.per_user = per_user
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._run_active = {} # 実行ID -> 使用中の枠数
+        self._run_users = {} # 実行ID -> 利用者
+        self._user_active = {} # 利用者 -> 使用中の枠数
+        self._waiters = {} # 実行ID -> deque[_Waiter]
+        self._seq = itertools.count()
+
+    def for_run(self, run_id, user=""):
+        """1回の実行で使う枠の取得・返却の窓口"""
+        return RunAdmission(self, run_id, user)
+
+    async def acquire(self, run_id, user=""):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._run_users[run_id] = user
+            waiter = _Waiter(loop, loop.create_future(), next(self._seq))
+            self._waiters.setdefault(run_id, deque()).append(waiter)
+            self._grant_locked()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter.granted:
+                    self._release_locked(run_id)
+                else:
+                    self._waiters[run_id].remove(waiter)
+                    self._cleanup_locked(run_id)
+            raise
+
+    def release(self, run_id):
+        with self._lock:
+            self._release_locked(run_id)
+
+    def _release_locked(self, run_id):
+        user = self._run_users.get(run_id, "")
+        self._in_use -= 1
+        self._run_active[run_id] -= 1
+        self._user_active[user] -= 1
+        self._cleanup_locked(run_id)
+        self._grant_locked()
+
+    def _cleanup_locked(self, run_id):
+        if self._run_active.get(run_id, 0) == 0 and not self._waiters.get(run_id):
+            self._run_active.pop(run_id, None)
+            self._waiters.pop(run_id, None)
+            user = self._run_users.pop(run_id, "")
+            if self._user_active.get(user) == 0 and user not in self._run_users.values():
+                self._user_active.pop(user, None)
+
+    def _grant_locked(self):
+        """空いている枠を、待っている実行のうち使用数が最も少ない実行へ順に渡す"""
+        while self._in_use < self.capacity:
+            candidates = [
+                (self._run_active.get(run_id, 0), waiters[0].seq, run_id)
+                for run_id, waiters in self._waiters.items()
+                if waiters and self._user_active.get(self._run_users.get(run_id, ""), 0) < self.per_user
+            ]
+            if not candidates:
+                return
+            _, _, run_id = min(candidates)
+            waiter = self._waiters[run_id].popleft()
+            user = self._run_users.get(run_id, "")
+            try:
+                waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+            except RuntimeError:
+                continue # イベントループが終了済み (枠は渡さない)
+            waiter.granted = True
+            self._in_use += 1
+            self._run_active[run_id] = self._run_active.get(run_id, 0) + 1
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+
+    def stats(self):
+        """現在の使用数・待ち数・実行中の実行数・利用者数"""
+        with self._lock:
+            return {
+                "使用中": self._in_use,
+                "上限": self.capacity,
+                "待ち": sum(len(waiters) for waiters in self._waiters.values()),
+                "実行数": len(self._run_users),
+                "利用者数": len(set(self._run_users.values())),
+            }
+
+
+class RunAdmission:
+    """AdmissionController の枠を1回の実行 (実行ID・利用者) として取得・返却する"""
+
+    def __init__(self, controller, run_id, user=""):
+        self.controller = controller
+        self.run_id = run_id
+        self.user = user
+
+    async def acquire(self):
+        await self.controller.acquire(self.run_id, self.user)
+
+    def release(self):
+        self.controller.release(self.run_id)
@@ -1,26 +1,20 @@
 import streamlit as st
-import pandas as pd
 import io
 import re
 import json
 import base64
 import datetime
-from openai import AsyncOpenAI
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 import streamlit.components.v1 as components
 import asyncio
 from functools import partial
 import math
-import requests
 import os
+import uuid
 
-# --- ローカルモジュールのインポート ---
-from neng_api import get_neng_content
-from export import save_to_spreadsheet
-from manual import show_instructions
-from log import log_ocr_execution
+# pandas・Google API・OpenAI などの重いモジュールは、ログイン後 (else 以下) で読み込む。
+# ログイン画面の表示にはこれらが不要なため、新しく起動したインスタンスでもログイン画面をすぐに表示できる。
+# 保存・ログ記録・OCR実行でのみ使うモジュール (export, openai) は、使う時点で読み込む。
+# 読み込み時間の確認: python -m bench.startup_bench
 
 
 # --- Streamlit ページ設定 ---
@@ -88,6 +82,31 @@ if not st.user.get("is_logged_in", False):
 # === ログイン成功後のメインアプリ ===
 else: # Google認証済みの場合のみ以下を実行
 
+    import pandas as pd
+    import requests
+    from googleapiclient.errors import HttpError
+
+    # --- ローカルモジュールのインポート ---
+    from manual import show_instructions
+    from log import log_ocr_execution, log_usage_breakdown, read_local_log, SHEET_NAME, STAGE_SHEET_NAME
+    from usage import UsageLedger, rollup_usage_history
+    from tracing import Tracer, NOOP_TRACER, get_default_exporter
+    from routing import DEFAULT_MODEL_ROUTES
+    from check_cache import CheckCache
+    from image_workers import ImageProcessor
+    from ocr_job import OcrJob
+    from admission import AdmissionController
+    from municipality_registry import MunicipalityRegistry
+    from google_clients import get_google_clients
+    from estimate import (
+        estimate_run, stage_profiles_from_history, compare_modes, format_duration, monthly_spend_jpy, budget_warnings,
+        DEFAULT_MONTHLY_BUDGET_JPY, DEFAULT_RUN_BUDGET_JPY
+    )
+    from ocr_pipeline import (
+        get_product_code_from_filename, get_business_code_from_product_code,
+        build_image_groups, fetch_neng_content_map, main_async_runner, record_from_result, RECORD_WINDOW, DEFAULT_STAGE_WORKERS
+    )
+
     # --- CSSファイルを読み込む関数 ---
     def load_css(file_name):
         try:
@@ -136,22 +155,22 @@ else: # Google認証済みの場合のみ以下を実行
         st.session_state.business_codes = []
     if 'product_codes' not in st.session_state:
         st.session_state.product_codes = []
-    if 'ocr_result_df' not in st.session_state:
-        st.session_state.ocr_result_df = None
-    if 'ocr_plain_df' not in st.session_state: # 検索用の平文DF
-        st.session_state.ocr_plain_df = None
-    if 'ocr_excel_df' not in st.session_state: # スプレッドシート保存用の元DF
-        st.session_state.ocr_excel_df = None
-    if 'ocr_image_bytes' not in st.session_state: # 画像バイナリデータ
-        st.session_state.ocr_image_bytes = None
+    if 'ocr_result_store' not in st.session_state: # 列指向の結果ストア (表示・保存・検索用のDFは使う時点で生成)
+        st.session_state.ocr_result_store = None
+    if 'local_export_file' not in st.session_state: # ダウンロード用に作成したファイル (データ, ファイル名, MIME)
+        st.session_state.local_export_file = None
+    if 'ocr_usage_ledger' not in st.session_state: # 直近の実行のトークン使用量台帳
+        st.session_state.ocr_usage_ledger = None
+    if 'ocr_trace' not in st.session_state: # 直近の実行のステージ別計測 (Tracer)
+        st.session_state.ocr_trace = None
+    if 'ocr_job' not in st.session_state: # 実行中のOCRジョブ (OcrJob)。画面の再実行をまたいで保持する
+        st.session_state.ocr_job = None
     if 'show_ocr_confirmation' not in st.session_state:
         st.session_state.show_ocr_confirmation = False
     if 'record_count_to_process' not in st.session_state:
         st.session_state.record_count_to_process = 0
     if 'image_total_count_to_process' not in st.session_state:
         st.session_state.image_total_count_to_process = 0
-    if 'municipality_map' not in st.session_state:
-        st.session_state.municipality_map = {}
     if 'db_update_count' not in st.session_state:
         st.session_state.db_update_count = 0
     if 'current_page' not in st.session_state:
@@ -183,40 +202,39 @@ else: # Google認証済みの場合のみ以下を実行
         st.session_state.gspread_save_success_url = None
     if 'gspread_save_error_message' not in st.session_state:
         st.session_state.gspread_save_error_message = None
+    if 'gspread_save_timings' not in st.session_state: # フェーズごとの保存所要時間
+        st.session_state.gspread_save_timings = None
 
 
     # --- スプレッドシートから自治体リストとコードを取得する関数 ---
-    @st.cache_data(ttl=3600) # 1時間キャッシュ
-    def get_municipality_map(_sheets_service):
-        """スプレッドシートから自治体名とコードのマップを取得する"""
-        SPREADSHEET_ID = '1n8qDS8OvuFJwDy2J6wduDHI32GxDmbx1QIrqHPFjdGo'
-        RANGE_NAME = '自治体DB!A2:B'
-        municipality_map = {}
-        try:
-            sheet = _sheets_service.spreadsheets()
-            result = sheet.values().get(spreadsheetId=SPREADSHEET_ID, range=RANGE_NAME).execute()
-            values = result.get('values', [])
-
-            if not values:
-                # st.error はサイドバーではなくメイン画面に出てしまうため、サイドバーのエラーに変更
-                st.sidebar.error("スプレッドシートから自治体データを取得できませんでした。")
-                return {}
-
-            # { "自治体名": "コード", ... } の辞書を作成
-            for row in values:
-                if len(row) >= 2 and row[0] and row[1]: # 名前とコードが両方存在する場合のみ
-                    municipality_map[row[0]] = row[1]
-
-            # 名前順にソートした辞書を返す
-            sorted_map = dict(sorted(municipality_map.items()))
-            return sorted_map
+    MUNICIPALITY_SPREADSHEET_ID = '1n8qDS8OvuFJwDy2J6wduDHI32GxDmbx1QIrqHPFjdGo'
+    MUNICIPALITY_RANGE_NAME = '自治体DB!A2:B'
 
-        except HttpError as err:
+    def load_municipality_map(creds_info):
+        """
+        スプレッドシートから自治体名とコードのマップを取得する。
+        MunicipalityRegistry がバックグラウンドのスレッドからも呼ぶため、st.* は呼ばず、失敗時は例外を送出する。
+        (共有の Sheets サービスは接続プールを使うため、バックグラウンドのスレッドからも使える)
+        """
+        result = get_google_clients(creds_info).sheets().spreadsheets().values().get(
+            spreadsheetId=MUNICIPALITY_SPREADSHEET_ID, range=MUNICIPALITY_RANGE_NAME
+        ).execute()
+        values = result.get('values', [])
+        if not values:
+            raise Exception("スプレッドシートから自治体データを取得できませんでした。")
+
+        # { "自治体名": "コード", ... } の辞書を作成 (名前とコードが両方存在する場合のみ)
+        return {row[0]: row[1] for row in values if len(row) >= 2 and row[0] and row[1]}
+
+    def show_municipality_error(err, stale=False):
+        """自治体リストの読み込みエラーをサイドバーに表示する (stale=True: 以前の表は表示できている場合)"""
+        # st.error はサイドバーではなくメイン画面に出てしまうため、サイドバーのエラーにする
+        if stale:
+            st.sidebar.warning(f"自治体リストを更新できませんでした（前回読み込んだリストを表示しています）: {err}")
+        elif isinstance(err, HttpError):
             st.sidebar.error(f"自治体リストのスプレッドシートへのアクセスに失敗しました: {err}")
-            return {}
-        except Exception as e:
-            st.sidebar.error(f"自治体リスト取得中にエラーが発生しました: {e}")
-            return {}
+        else:
+            st.sidebar.error(f"自治体リスト取得中にエラーが発生しました: {err}")
 
     # --- 変更検知・確認ダイアログ用コールバック関数 ---
 
@@ -235,7 +253,7 @@ else: # Google認証済みの場合のみ以下を実行
         if new_value == old_value or st.session_state.show_clear_confirmation:
             return
 
-        if st.session_state.ocr_result_df is not None:
+        if st.session_state.ocr_result_store is not None:
             st.session_state.pending_change = {"key": key_name, "old_key": old_key_name, "new_value": new_value}
             st.session_state.show_clear_confirmation = True
             st.session_state[key_name] = old_value # 警告中は値を戻す
@@ -246,10 +264,8 @@ else: # Google認証済みの場合のみ以下を実行
         """
         確認ダイアログで「OK」が押された時の処理
         """
-        st.session_state.ocr_result_df = None
-        st.session_state.ocr_plain_df = None
-        st.session_state.ocr_excel_df = None 
-        st.session_state.ocr_image_bytes = None
+        st.session_state.ocr_result_store = None
+        st.session_state.local_export_file = None
         st.session_state.current_page = 1
 
         if st.session_state.pending_change:
@@ -284,7 +300,7 @@ else: # Google認証済みの場合のみ以下を実行
         # OCR確認メッセージが表示されていれば消す
         st.session_state.show_ocr_confirmation = False
 
-        if st.session_state.ocr_result_df is not None:
+        if st.session_state.ocr_result_store is not None:
             st.session_state.show_drive_clear_confirmation = True
         else:
             st.session_state.execute_drive_load_now = True
@@ -300,10 +316,8 @@ else: # Google認証済みの場合のみ以下を実行
         st.session_state.current_page = 1
 
         # ドライブ読み込み時は結果と選択状態をリセット
-        st.session_state.ocr_result_df = None
-        st.session_state.ocr_plain_df = None
-        st.session_state.ocr_excel_df = None 
-        st.session_state.ocr_image_bytes = None
+        st.session_state.ocr_result_store = None
+        st.session_state.local_export_file = None
         st.session_state.old_municipality = None
         st.session_state.old_business_code = None
         st.session_state.old_product_code = None
@@ -377,13 +391,8 @@ else: # Google認証済みの場合のみ以下を実行
     def get_google_credentials():
         try:
             google_credentials_info = json.loads(st.secrets["google"]["credentials_json"])
-            creds = service_account.Credentials.from_service_account_info(
-                google_credentials_info,
-                scopes=[
-                    'https://www.googleapis.com/auth/drive',
-                    'https://www.googleapis.com/auth/spreadsheets'
-                ]
-            )
+            # 認証情報は export.py・log.py と共有する (トークンの取得・更新は1か所で行う)
+            creds = get_google_clients(google_credentials_info).credentials
             
             # --- 辞書とオブジェクトの両方を返す ---
             return creds, google_credentials_info
@@ -392,25 +401,46 @@ else: # Google認証済みの場合のみ以下を実行
             st.stop()
             return None, None # 戻り値を2つに
 
-    def get_drive_service(_credentials):
-        return build('drive', 'v3', credentials=_credentials)
+    def get_drive_service():
+        """Drive API のサービス (全セッションで共有。初回の利用時に作成)"""
+        return get_google_clients(google_creds_info).drive()
 
-    def get_sheets_service(_credentials):
-        return build('sheets', 'v4', credentials=_credentials)
+    @st.cache_resource
+    def get_check_cache():
+        """OCR・二次チェック結果のキャッシュ (全セッション・全実行で共有)"""
+        return CheckCache()
+
+    @st.cache_resource
+    def get_image_processor():
+        """画像の前処理 (ハッシュ・Base64・縮小画像) を行うプロセスプール (全セッションで共有)"""
+        return ImageProcessor()
+
+    @st.cache_resource
+    def get_admission_controller():
+        """サーバー全体の同時実行枠 (全セッションで共有。利用者ごとの上限と実行間の公平な配分)"""
+        return AdmissionController()
+
+    def get_sheets_service():
+        """Sheets API のサービス (全セッションで共有。初回の利用時に作成)"""
+        return get_google_clients(google_creds_info).sheets()
+
+    @st.cache_resource
+    def get_municipality_registry(_creds_info):
+        """自治体リスト (全セッションで共有。スナップショットから起動し、期限切れ後は裏で再読み込み)"""
+        return MunicipalityRegistry(partial(load_municipality_map, _creds_info))
 
     try:
         # --- 戻り値を2つ受け取る ---
         google_creds, google_creds_info = get_google_credentials()
-        drive_service = get_drive_service(google_creds)
-        sheets_service = get_sheets_service(google_creds)
-        async_openai_client = AsyncOpenAI(api_key=st.secrets["openai"]["api_key"])
+        openai_api_key = st.secrets["openai"]["api_key"] # クライアントは実行時に作成する (openai の読み込みを遅らせる)
 
-        # --- アプリ起動時に自治体マップを読み込む ---
-        if 'municipality_map' not in st.session_state or not st.session_state.municipality_map:
-            # メイン画面ではなくサイドバーにスピナーを表示する
+        # --- 自治体リスト (スナップショットがあれば待たずに表示し、古ければ裏で再読み込み) ---
+        municipality_registry = get_municipality_registry(google_creds_info)
+        if not municipality_registry.ready:
+            # スナップショットがない初回のみ読み込みを待つ。メイン画面ではなくサイドバーにスピナーを表示する
             with st.sidebar:
                 with st.spinner("自治体リストを読み込み中..."):
-                    st.session_state.municipality_map = get_municipality_map(sheets_service)
+                    municipality_registry.get()
 
     except Exception as e:
         st.error(f"APIキーまたは認証情報の読み込み中にエラーが発生しました: {e}")
@@ -451,6 +481,24 @@ else: # Google認証済みの場合のみ以下を実行
         match = re.search(r'/d/([a-zA-Z0-9_-]+)', url)
         return match.group(1) if match else None
 
+    def list_all_drive_files(query, fields):
+        """files().list を nextPageToken がなくなるまで繰り返し、全件のファイル情報を返す (1ページの既定は100件のため)"""
+        files = []
+        page_token = None
+        while True:
+            response = get_drive_service().files().list(
+                q=query,
+                fields=f"nextPageToken, files({fields})",
+                pageSize=1000,
+                pageToken=page_token,
+                supportsAllDrives=True, # 共有ドライブ対応
+                includeItemsFromAllDrives=True # 共有ドライブ対応
+            ).execute()
+            files.extend(response.get('files', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return files
+
     # @st.cache_data 
     def list_drive_files_and_business_codes(drive_folder_id):
         portal_files = {}
@@ -458,7 +506,7 @@ else: # Google認証済みの場合のみ以下を実行
         try:
             # まず指定されたフォルダ自体を取得（存在確認と名前取得のため）
             # --- 共有ドライブ対応 ---
-            folder_info = drive_service.files().get(
+            folder_info = get_drive_service().files().get(
                 fileId=drive_folder_id, 
                 fields="id, name",
                 supportsAllDrives=True # 共有ドライブ対応
@@ -466,13 +514,7 @@ else: # Google認証済みの場合のみ以下を実行
 
             # サブフォルダを検索
             subfolders_query = f"'{drive_folder_id}' in parents and mimeType='application/vnd.google-apps.folder'"
-            subfolders_response = drive_service.files().list(
-                q=subfolders_query, 
-                fields="files(id, name)",
-                supportsAllDrives=True, # 共有ドライブ対応
-                includeItemsFromAllDrives=True # 共有ドライブ対応
-            ).execute()
-            subfolders = subfolders_response.get('files', [])
+            subfolders = list_all_drive_files(subfolders_query, "id, name")
 
             # サブフォルダがあればそれらを処理、なければ指定されたフォルダ自体を処理対象に
             folders_to_process = subfolders if subfolders else [folder_info]
@@ -483,17 +525,15 @@ else: # Google認証済みの場合のみ以下を実行
                 portal_files[portal_name] = []
                 # フォルダ内の画像ファイルを検索
                 files_query = f"'{folder['id']}' in parents and (mimeType='image/jpeg' or mimeType='image/png')"
-                files_response = drive_service.files().list(
-                    q=files_query, 
-                    fields="files(id, name, mimeType)",
-                    supportsAllDrives=True, # 共有ドライブ対応
-                    includeItemsFromAllDrives=True # 共有ドライブ対応
-                ).execute()
-                files_in_folder = files_response.get('files', [])
+                # md5Checksum は同一画像の重複OCR防止、size・imageMediaMetadata は実行前の見積もりに使う
+                files_in_folder = list_all_drive_files(files_query, "id, name, mimeType, md5Checksum, size, imageMediaMetadata(width, height)")
                 total_image_count += len(files_in_folder)
 
                 for file in files_in_folder:
-                    portal_files[portal_name].append({'id': file['id'], 'name': file['name'], 'mimeType': file['mimeType']})
+                    portal_files[portal_name].append({
+                        'id': file['id'], 'name': file['name'], 'mimeType': file['mimeType'], 'md5Checksum': file.get('md5Checksum'),
+                        'size': file.get('size'), 'imageMediaMetadata': file.get('imageMediaMetadata')
+                    })
                     # ファイル名から事業者コードを抽出
                     prod_code = get_product_code_from_filename(file['name'])
                     bus_code = get_business_code_from_product_code(prod_code)
@@ -524,25 +564,6 @@ else: # Google認証済みの場合のみ以下を実行
             return None, []
 
 
-    def get_product_code_from_filename(filename):
-        # 拡張子を除去
-        name_without_ext = filename.rsplit('.', 1)[0]
-        # 最初のハイフンまでを取得（ハイフンがない場合は全体）
-        return name_without_ext.split('-')[0]
-
-    def get_business_code_from_product_code(product_code):
-        if not product_code: return None
-        # 正規表現パターン (大文字小文字を区別しない)
-        # 1. 数字2桁 + 英字4桁 (例: 01ABCD)
-        # 2. 英字4桁 (例: ABCD)
-        # 3. 英字3桁 (例: ABC)
-        patterns = [r'^[0-9]{2}[a-zA-Z]{4}', r'^[a-zA-Z]{4}', r'^[a-zA-Z]{3}']
-        for p in patterns:
-            match = re.match(p, product_code) # re.IGNORECASE は不要かも
-            if match:
-                return match.group(0).upper() # マッチした部分を大文字で返す
-        return None # どのパターンにもマッチしない場合
-
     def get_product_codes_for_business_code(portal_files, selected_business_code):
         if not portal_files or not selected_business_code: return []
         product_codes_set = set()
@@ -571,637 +592,194 @@ else: # Google認証済みの場合のみ以下を実行
                     image_total_count += 1
         return len(image_records), image_total_count
 
-    # --- 非同期処理の定義 (OpenAI API関連) ---
-    async def call_openai_vision_api_async(client, prompt, image_base64, mime_type, model="gpt-4o", max_tokens=1000):
-        try:
-            messages = [{"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}}]}]
-            # JSONモードを有効化
-            response = await client.chat.completions.create(
-                model=model, 
-                messages=messages, 
-                temperature=0.0, 
-                max_tokens=max_tokens,
-                response_format={"type": "json_object"}
+    # --- 途中結果 (ライブテーブル) の描画 ---
+    LIVE_RESULT_COLUMNS = ["画像名", "ステータス", "テキスト比較", "誤字脱字", "内容量比較", "エラー検出"]
+    LIVE_REFRESH_INTERVAL = 0.5 # 秒 (描画の間引き間隔)
+
+    def render_live_results(placeholder, ocr_job):
+        """件数と、完了した「要確認」のレコード (新しいものから最大 LIVE_NEED_CHECK_ROWS 件) をライブ表示する"""
+        completed, need_check_count, need_check_records = ocr_job.live_summary()
+        ok_count = completed - need_check_count
+        df_live = pd.DataFrame(
+            [[r.image_name, r.status, r.text_comparison, r.typo, r.volume_comparison, r.error_detection] for r in need_check_records],
+            columns=LIVE_RESULT_COLUMNS
+        )
+
+        with placeholder.container(border=True):
+            st.markdown(
+                f"<h2 style='font-size: 20px; font-weight: 600; margin-bottom: 0px;'>途中結果 {completed} / {ocr_job.total_records}件 "
+                f"<span style='font-size: 0.8em;'>（<span style='color: #ff3456;'>要確認 {need_check_count}件</span> / 異常なし {ok_count}件）</span></h2>",
+                unsafe_allow_html=True
             )
-            # コンテンツと、入力/出力トークンを返す
-            return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
-        except Exception as e: 
-            return f'{{"error": "OpenAI APIエラー: {e}"}}', 0, 0
+            if need_check_count > len(df_live):
+                st.caption(f"「要確認」のうち新しい{len(df_live)}件を表示しています（すべての結果は完了後に表示します）。")
+            if not df_live.empty:
+                styler = df_live.style.map(lambda v: "color: red;", subset=["ステータス"])
+                st.dataframe(styler, hide_index=True, width='stretch', height=400)
 
-    async def call_openai_text_api_async(client, prompt, model="gpt-4o"):
-        try:
-            messages = [{"role": "user", "content": prompt}]
-            response = await client.chat.completions.create(model=model, messages=messages, temperature=0.0, response_format={"type": "json_object"})
-            # コンテンツと、入力/出力トークンを返す
-            return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
-        except Exception as e: 
-            return f'{{"status": "api_error", "message": "OpenAI APIエラー: {e}"}}', 0, 0
-
-    async def call_openai_simple_text_api_async(client, prompt, model="gpt-4o"):
-        try:
-            messages = [{"role": "user", "content": prompt}]
-            response = await client.chat.completions.create(model=model, messages=messages, temperature=0.0)
-            # コンテンツと、入力/出力トークンを返す
-            return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
-        except Exception as e: 
-            return f"OpenAI APIエラー: {e}", 0, 0
-
-    async def check_typos_async(client, ocr_results_dict):
-        """
-        誤字脱字チェックを行う。
-        ポータルごとのテキストを辞書で受け取り、誤字がある場合は対象のポータル名も特定して返す。
-        """
-        # 無効なテキストを除外して辞書を再構築
-        filtered_items = {
-            k: v for k, v in ocr_results_dict.items() 
-            if v and "テキストは検出されませんでした。" not in v and "APIエラー" not in v and "予期せぬエラー" not in v
-        }
-        
-        if not filtered_items: return "OK！", 0, 0
-
-        # AIに渡すテキストを整形（【ポータル名】テキスト... の形式）
-        formatted_text = ""
-        for portal_name, text in filtered_items.items():
-            formatted_text += f"【{portal_name}】\n{text}\n---\n"
-
-        # --- プロンプト修正開始 ---
-        prompt = f"""あなたは商品広告テキストに含まれる「明らかな誤字・脱字・誤用」のみを検出する品質管理AIです。
-校正者ではありません。「修正すべき致命的なミス」以外は全て無視してください。
-
-### 重要：指摘の範囲（切り取り方）について
-単語単体で意味が通じる場合でも、文脈がおかしい場合は**「文脈（前後の助詞や動詞）を含めたフレーズ」**で指摘してください。
-- 悪い例：「保存期間」を確認 （単語自体は合っているため混乱する）
-- 良い例：「保存期間ありません」を確認 （助詞不足や言い回しの違和感が伝わる）
-
-### 除外ルール（絶対に指摘してはいけないもの）
-1. **食材名・商品名・固有名詞**:
-   - 「蓮根」「牛たん」「○○産」などの名詞は、文脈が唐突でも（例：「泥が蓮根」）商品名やキャッチコピーの可能性があるため無視してください。
-2. **広告特有の表現**:
-   - 箇条書きや短文における助詞の省略（例：「保存期間ありません」「在庫なし」）は、意味が通じる限り許容してください。
-3. **スペースによる単語連結**:
-   - OCRの仕様でスペースがないことは無視してください。
-
-### 指摘すべき対象（例）
-- **明らかな誤変換**:
-  - 「確認」→「角認」、「絶品」→「絶貧」（漢字の間違い）
-- **明らかな入力・タイプミス**:
-  - 「ありがとうございます」→「ありがとうごうざいます」（文字の重複）
-  - 「おいしい」→「おしいい」（順序逆転）
-- **文章として崩壊しているもの**:
-  - 「保存期間ありません」→広告表現としてギリギリ許容（スルー推奨だが、あまりに不自然ならフレーズで指摘）
-  - 「保存期間あありません」→明らかに「あ」が多いので、「保存期間あありません」として指摘。
-- **送り仮名の明らかな異常**:
-  - 「行います」→「行いあす」
-
-### 判断・出力フォーマット
-- 指摘すべきエラーがない場合は {{"status": "ok"}} を返してください。
-- エラーがある場合のみ、以下のJSON形式で返してください。
-  {{
-    "status": "error", 
-    "message": "\\"(問題のあるフレーズ全体)\\" を確認",
-    "affected_sources": ["ソース名1", "ソース名2", ...] 
-  }}
-  - **重要: 同じ誤字が複数のポータルに含まれている場合は、該当する全てのポータル名を `affected_sources` リストに含めてください。**
-
----チェック対象テキスト---
-{formatted_text}"""
-        # --- プロンプト修正終了 ---
-
-        response_str, in_tokens, out_tokens = await call_openai_text_api_async(client, prompt)
-        try:
-            result_json = json.loads(response_str)
-            if result_json.get("status") == "ok": 
-                return "OK！", in_tokens, out_tokens
-            elif result_json.get("status") == "error": 
-                message = result_json.get("message", "エラー")
-                affected_sources = result_json.get("affected_sources", [])
-                
-                # 対象のポータル名がある場合、メッセージに追記する
-                if affected_sources:
-                    # JSON等の表記揺れ対策（念のため文字列化して結合）
-                    sources_str = "」「".join([str(s) for s in affected_sources])
-                    return f"{message}\n（対象：「{sources_str}」）", in_tokens, out_tokens
-                else:
-                    return message, in_tokens, out_tokens
-            else: 
-                return "不明", in_tokens, out_tokens # APIが予期しない形式で返した場合
-        except (json.JSONDecodeError, AttributeError): 
-            return "解析不能", in_tokens, out_tokens # JSON解析失敗など
-
-    async def compare_content_volume_async(client, base_content, volume_results_dict):
-        """AIを使用して、基準となる内容量と複数の比較対象内容量が一致するか判定する（緩やかな判定）"""
-        # 空でない有効な内容量テキストのみを抽出した辞書を作成
-        valid_portal_items = {k: v for k, v in volume_results_dict.items() if v and v.strip()}
-
-        # 比較対象となるポータルの内容量が一つもなければ「内容量記載なし」
-        if not valid_portal_items:
-            return "内容量記載なし", 0, 0
-
-        # NENGの内容量（基準）が空なら「要確認」
-        if not base_content:
-            return "要確認", 0, 0
-
-        prompt = f"""あなたは商品の内容量テキストが、実質的に同じ意味であるかを判断するチェック担当者（人間）です。
-以下の基準に従って、柔軟に判定を行ってください。
-
-### 判定基準（緩やかな一致・部分一致の許容）
-1. **実質的な意味の一致**: 表記が異なっていても、人間が見て「同じ量」だと判断できる場合は「OK」としてください。
-   - 例: "90ml×6個" と "90mlX6" -> **OK** (×とXの違い、単位の省略は許容)
-   - 例: "2kg" と "2.0kg" -> **OK** (有効数字の違いは許容)
-2. **【重要】部分的な記載の許容（サブセット）**:
-   - 画像のデザイン上、セット商品の一部（メイン商品など）の分量しか書かれていない場合があります。
-   - **「画像に書かれている情報」が、「基準データ」の内容と矛盾せず、その一部として含まれている場合は「OK」としてください。**
-   - **例（OKのケース）**:
-     - 基準: "お米 3kg、ハム 2種、野菜 3種"
-     - 画像: "お米 3kg"
-     - 判定: **OK** (お米の量は合っているため。他が未記載でもOK)
-3. **明らかに矛盾する場合のみNG**:
-   - 画像に書かれている数値が、基準データの該当部分と食い違っている場合は「NG」としてください。
-   - **例（NGのケース）**:
-     - 基準: "お米 3kg、ハム 2種"
-     - 画像: "お米 5kg"
-     - 判定: **NG** (3kgと5kgで矛盾している)
-
-### 入力データ
-- **基準データ (NENG)**: "{base_content}"
-- **比較対象データ**: {json.dumps(valid_portal_items, ensure_ascii=False)}
-
-### 応答形式
-全ての比較対象データが、基準データと実質的に一致している（または矛盾していない部分一致である）と判断できる場合は `ok` を返してください。
-明らかに矛盾しているデータが含まれる場合は `ng` とし、**矛盾しているデータのキー名（ポータル名）のリスト**をJSON形式で返してください。
-
-成功時:
-{{"result": "ok"}}
-
-失敗時（NGの場合）:
-{{"result": "ng", "deviant_sources": ["Portal A", "Portal B"]}}
-"""
-        response_str, in_tokens, out_tokens = await call_openai_text_api_async(client, prompt)
-        try:
-            result_json = json.loads(response_str)
-            if result_json.get("result") == "ok":
-                return "OK！", in_tokens, out_tokens
-            else:
-                # NGの場合
-                deviant_sources = result_json.get("deviant_sources", [])
-                base_msg = "要確認"
-                if deviant_sources:
-                    sources_str = "」「".join([str(s) for s in deviant_sources])
-                    return f"{base_msg}\n（対象：「{sources_str}」）", in_tokens, out_tokens
-                else:
-                    return base_msg, in_tokens, out_tokens
-                    
-        except (json.JSONDecodeError, AttributeError):
-            return "要確認", in_tokens, out_tokens # JSON解析失敗や result キーがない場合は「要確認」扱い
-        
-    # テキストの意味的一致を確認するAI関数
-    async def compare_text_content_async(client, texts):
+    # --- メインの実行関数 ---
+    def start_ocr_job(portal_files, municipality_code, selected_business_code, selected_product_code, creds_info, client, vision_batch=False, model_routes=None, typo_batch=False, check_cache=None, chunked=False):
         """
-        複数のOCRテキストが、改行やスペースの違いを除いて実質的に同じか判定する。
+        OCR処理を別スレッドで開始し、ジョブ (OcrJob) を返す。処理対象がない場合は None。
+        chunked=True (分割実行) の場合、処理中のレコードを RECORD_WINDOW 件までに制限し、
+        画像データはOCR後すぐに表示用の縮小画像へ置き換えてメモリ使用量を抑える。
         """
-        # 空でないテキストのみ抽出
-        valid_texts = [t for t in texts if t and "テキストは検出されませんでした。" not in t and "APIエラー" not in t]
-        
-        if len(valid_texts) <= 1:
-            return "比較対象なし", 0, 0
-
-        # Python側で単純な正規化（全空白削除）をして一致すればAPI節約のため即OK
-        simple_normalized = {re.sub(r'\s+', '', t) for t in valid_texts}
-        if len(simple_normalized) == 1:
-            return "OK！", 0, 0
-
-        prompt = f"""あなたはテキスト比較の専門家です。以下の複数のテキストリストの内容が、実質的に同じであるかを判定してください。
-
-### 判定基準
-1. **無視してよい違い（OK）**:
-   - **改行・空白**: 「改行の位置」や「スペースの有無・個数」の違いは無視してください。（例: "商品\\n名" と "商品名" は同じ）
-   - **記号の全角半角**: 意味が変わらない範囲の記号の違い（「！」と「!」など）は無視してください。
-
-2. **許容しない違い（NG）**:
-   - **文字の相違**: 一文字でも異なる文字があればNGです。
-   - **【重要】句読点（、。,.）の有無**: 読点「、」や句点「。」があるものとないものが混在している場合は、デザインミスの可能性があるため必ず「NG」としてください。
-   - **数字・単位**: これらが異なる場合はNGです。
-
-### 入力テキストリスト
-{json.dumps(valid_texts, ensure_ascii=False)}
-
-### 応答形式
-全て実質的に同じテキストであれば `ok`、明確な差分（特に句読点の有無）があれば `ng` をJSON形式で返してください。
-{{"result": "ok"}} または {{"result": "ng"}}
-"""
-        response_str, in_tokens, out_tokens = await call_openai_text_api_async(client, prompt)
-        try:
-            result_json = json.loads(response_str)
-            return ("OK！", in_tokens, out_tokens) if result_json.get("result") == "ok" else ("差分あり", in_tokens, out_tokens)
-        except (json.JSONDecodeError, AttributeError):
-            return "差分あり", in_tokens, out_tokens # 解析失敗時は安全側に倒してNG
-
-    def download_drive_image_sync(file_id, credentials):
-        """同期的にGoogle Driveから画像データをダウンロードする"""
-        drive = build('drive', 'v3', credentials=credentials)
-        # --- 共有ドライブ対応 ---
-        request = drive.files().get_media(fileId=file_id, supportsAllDrives=True)
-        return request.execute() # 画像のバイナリデータを返す
-
-    async def extract_text_from_drive_image_async(portal_name, file_id, mime_type, credentials, client):
-        """非同期でDrive画像を取得し、OpenAI Vision APIでOCRと内容量抽出を同時に実行"""
-        image_bytes = None # 初期化
-        try:
-            loop = asyncio.get_running_loop()
-            # 同期的なダウンロード処理を非同期イベントループで実行
-            image_bytes = await loop.run_in_executor(None, partial(download_drive_image_sync, file_id, credentials))
-            # Base64エンコード
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-        except HttpError as e:
-            return portal_name, f"Google Drive画像取得失敗 (HttpError {e.resp.status})", "", None, 0, 0
-        except Exception as e:
-            return portal_name, f"Google Drive画像取得失敗: {e}", "", None, 0, 0 # その他のエラー
-
-        # --- プロンプト ---
-        prompt = """あなたは、商品広告画像のテキスト抽出の専門家です。
-与えられた画像から、以下の2つの情報をJSON形式で抽出してください。
-
-1. **full_text**: 画像に含まれる全てのテキストを、人間が読む順序（上から下、左から右）で抽出し、自然な改行を含めて書き起こしてください。
-   - レイアウトを優先し、意味のまとまりごとに改行を入れてください。
-   - **【重要】句読点（、。,.）や記号（！?）はデザインの誤植チェックに必要です。どんなに小さくても省略せず、画像通り正確に書き起こしてください。**
-   - 記号の統一（「×」→「x」など）や全角半角の統一を行ってください。
-   - テキストがない場合は空文字にしてください。
-
-2. **volume_text**: 画像の中から、「商品の内容量」「重量」「個数」に関する記述を抽出してください。
-   - **【最重要】捏造の禁止**: 画像内に**明記されているテキストのみ**を使用してください。
-     - 画像の「見た目」から商品名を推測して勝手に単語（例：「ソルベ」「アイス」など）を追加することは**絶対に禁止**です。
-     - **悪い例**: 画像に「いちご」としか書いてないのに、写真を見て "ストロベリーソルベ 6個" と出力する。
-     - **良い例**: "いちご 6個"
-   - **品名との結合**: 「6個」「2種」のように数量だけでは分からない場合は、**画像内に書かれている**「品名・カテゴリ名」を補って書き出してください。
-   - **レイアウト対応**: 品名と数量が改行で離れて記載されている場合も、それらを結合して抽出してください。
-   - 複数のアイテムがある場合は、「お米 5kg、肉 1kg」のようにそれぞれの内訳が分かるように記述してください。
-   - 不要な形容詞（「おいしい」「絶品の」など）や、量と無関係な宣伝文句は除外してください。
-   - 該当する記述がない場合は空文字にしてください。
-
-### 出力形式 (JSON)
-{
-  "full_text": "抽出した全文...",
-  "volume_text": "抽出した内容量..."
-}
-"""
-
-        # OpenAI Vision API呼び出し (JSONモード)
-        response_text, in_tokens, out_tokens = await call_openai_vision_api_async(client, prompt, image_base64, mime_type)
-
-        final_full_text = ""
-        final_volume_text = ""
-
-        # --- JSON解析と後処理 ---
-        try:
-            json_data = json.loads(response_text)
-            
-            # errorキーがある場合はAPIエラーとして処理
-            if "error" in json_data:
-                return portal_name, json_data["error"], "", image_bytes, in_tokens, out_tokens
-
-            final_full_text = json_data.get("full_text", "").strip()
-            final_volume_text = json_data.get("volume_text", "").strip()
-            
-            # AIが空文字列の代わりに '""' という文字列を返した場合の対策
-            if final_full_text == '""': final_full_text = ""
-            if final_volume_text == '""': final_volume_text = ""
-
-        except json.JSONDecodeError:
-            # JSON解析に失敗した場合のフォールバック (従来のテキストとして扱う)
-            # マークダウン記法などを除去して全文として扱う
-            cleaned_text = re.sub(r"```(json|text|plaintext)?\n?", "", response_text).replace("```", "")
-            final_full_text = cleaned_text.strip()
-            final_volume_text = "" # 解析不能なため空にする
+        # 画像ファイル名ごとにポータル情報をグループ化 (NENG APIで取得する品番も収集)
+        image_groups, unique_product_codes_to_fetch = build_image_groups(portal_files, selected_business_code, selected_product_code)
 
-        return portal_name, final_full_text, final_volume_text, image_bytes, in_tokens, out_tokens
-
-    # --- メインの非同期処理ワーカー ---
-    async def process_single_record_async(image_name, data, selected_product_code, credentials, client, semaphore, neng_content_map):
-        async with semaphore: # 同時実行数を制限
-            rec_input_tokens = 0
-            rec_output_tokens = 0
-
-            # OCRタスクとNENG APIタスクをリストに格納
-            ocr_tasks = [extract_text_from_drive_image_async(p_name, p_data['id'], p_data['mimeType'], credentials, client)
-                         for p_name, p_data in data['portals'].items()]
+        if not image_groups:
+            st.warning("処理対象の画像が見つかりませんでした。")
+            return None
 
-            # NENG API呼び出しを削除し、マップから値を取得
+        # ステージ別の計測 (実行IDはステージ別ログと共通)
+        run_id = uuid.uuid4().hex[:8]
+        # ユーザー情報の取得 (同時実行枠の配分とログ記録に使う)
+        user_info = st.user.email if hasattr(st.user, "email") else st.user.name
+        total_records = len(image_groups)
 
-            # 品番が「すべて」の場合はファイル名から取得、そうでなければ選択された品番を使用
-            product_code_for_neng = get_product_code_from_filename(image_name) if selected_product_code == "すべて" else selected_product_code
+        # 完了したレコードはジョブに蓄積し、結果ストア (表示用/保存用/検索用のDataFrameの元) はジョブから生成する
+        # ポータル名のリストを取得（Excelの列順のため）
+        all_portal_names = sorted(list(portal_files.keys()))
+        # API呼び出しごとのトークン・レイテンシの台帳 (ステージ・モデル別に集計)
+        job = OcrJob(all_portal_names, total_records, Tracer(run_id, exporter=get_default_exporter()), UsageLedger())
 
-            # マップからNENG内容量を取得（見つからない場合は空文字）
-            raw_neng_content = neng_content_map.get(product_code_for_neng, "")
-    
-            # 品番が「すべて」の場合はファイル名から取得、そうでなければ選択された品番を使用
-            product_code_for_neng = get_product_code_from_filename(image_name) if selected_product_code == "すべて" else selected_product_code
-            
-            # マップからNENG内容量を取得（見つからない場合は空文字）
-            raw_neng_content = neng_content_map.get(product_code_for_neng, "") 
+        # ジョブのスレッドでは Streamlit の関数を呼ばないため、共有オブジェクトやセッションの値はここで取得しておく
+        image_processor = get_image_processor()
+        admission = get_admission_controller().for_run(run_id, user_info)
+        image_count = st.session_state.image_total_count_to_process
 
-            ocr_task_results = await asyncio.gather(*ocr_tasks) # OCRタスクのみ実行
+        # 自治体DBと同じスプレッドシートID
+        SPREADSHEET_ID = '1n8qDS8OvuFJwDy2J6wduDHI32GxDmbx1QIrqHPFjdGo'
 
-            # OCR結果と画像データを辞書に整理
-            ocr_results, volume_results, image_bytes_data = {}, {}, {}
-            
-            for p_name, extracted_text, volume_text, img_bytes, in_t, out_t in ocr_task_results:
-                ocr_results[p_name] = extracted_text
-                volume_results[p_name] = volume_text # 画像から直接抽出した内容量
-                if img_bytes: image_bytes_data[p_name] = img_bytes # 画像データも保持
-                rec_input_tokens += in_t
-                rec_output_tokens += out_t
-
-            # 誤字脱字チェックのタスクのみ作成（内容量抽出はVision APIで完了済み、NENGはそのまま使う）
-            typo_task = check_typos_async(client, ocr_results) 
-
-            # テキスト比較タスクを追加（AIを使用）
-            text_compare_task = compare_text_content_async(client, list(ocr_results.values()))
-
-            # 上記タスクを並行実行
-            secondary_results = await asyncio.gather(
-                typo_task,
-                text_compare_task
-            )
-            (typo_result, typo_in, typo_out), (text_comparison_result, txt_in, txt_out) = secondary_results
-            
-            rec_input_tokens += typo_in + txt_in
-            rec_output_tokens += typo_out + txt_out
+        print(unique_product_codes_to_fetch)
 
-            # NENG内容量はそのまま使用（抽出なし）
-            processed_neng_content = raw_neng_content
+        async def run_records():
+            # NENG APIの事前一括呼び出し
+            neng_content_map = {}
+            if unique_product_codes_to_fetch:
+                job.progress(0.0, text="2. NENGデータ取得中...")
+                try:
+                    # 非同期でNENG APIを並列実行し、結果を辞書（品番: 内容量）にマッピング
+                    with job.tracer.span("neng"):
+                        neng_content_map = await fetch_neng_content_map(unique_product_codes_to_fetch, municipality_code)
 
-            # NENG内容量とポータル内容量を比較するタスクを実行
-            cleaned_neng_content = processed_neng_content.strip().strip('"') if processed_neng_content else ""
-            
-            # volume_results の値リストではなく、辞書そのものと、クリーニング済み辞書を作成して渡す手もあるが、
-            # AI側でJSONとして受け取るため、volume_results（辞書）をそのまま渡す
-            comparison_result, comp_in, comp_out = await compare_content_volume_async(client, cleaned_neng_content, volume_results)
-            
-            rec_input_tokens += comp_in
-            rec_output_tokens += comp_out
+                    print(neng_content_map)
 
-            # 以前のPythonによる厳密比較ロジックは削除し、AIの結果(text_comparison_result)をそのまま使用
+                    if any("エラー" in res for res in neng_content_map.values() if isinstance(res, str)):
+                        job.notify("toast", "一部のNENG APIの取得でエラーが発生しました。")
 
-            return image_name, ocr_results, volume_results, image_bytes_data, typo_result, processed_neng_content, comparison_result, text_comparison_result, rec_input_tokens, rec_output_tokens
+                except Exception as e:
+                    job.notify("error", f"NENG APIの一括取得中にエラーが発生しました: {e}")
 
-    async def main_async_runner(image_groups, selected_product_code, credentials, client, progress_bar, total_records, neng_content_map):
-        semaphore = asyncio.Semaphore(25)
-        tasks = [process_single_record_async(
-                    name,
-                    data,
+            job.progress(0.0, text="2. OCR実行中...")
+            watcher = asyncio.ensure_future(job.watch_orphan())
+            try:
+                await main_async_runner(
+                    image_groups,
                     selected_product_code,
-                    credentials,
+                    creds_info, # 画像の取得は共有の Drive サービスで行う (google_clients)
                     client,
-                    semaphore,
-                    neng_content_map 
+                    job,
+                    total_records,
+                    neng_content_map,
+                    on_result=lambda result: job.add_record(record_from_result(result, image_groups)),
+                    ledger=job.usage_ledger,
+                    tracer=job.tracer,
+                    on_error=lambda e: job.notify("error", f"非同期処理中にエラーが発生しました: {e}"),
+                    vision_batch=vision_batch,
+                    model_routes=model_routes,
+                    typo_batch=typo_batch,
+                    check_cache=check_cache,
+                    window=RECORD_WINDOW if chunked else None,
+                    thumbnails=chunked,
+                    stage_workers=DEFAULT_STAGE_WORKERS, # 取得・OCR・チェックをステージごとのワーカーで実行
+                    image_processor=image_processor, # 画像のCPU処理はイベントループの外のプロセスで実行
+                    cancel_token=job.cancel_token, # 中止された場合は完了したレコードだけで終了する
+                    admission=admission # 他の利用者の実行と同時実行枠を分け合う
                 )
-                for name, data in image_groups.items()]
-        results = []
-        # as_completed で完了したものから順次処理
-        for i, future in enumerate(asyncio.as_completed(tasks)):
-            try:
-                result = await future
-                results.append(result)
-            except Exception as e:
-                st.error(f"非同期処理中にエラーが発生しました: {e}")
             finally:
-                # プログレスバーを更新
-                progress_bar.progress((i + 1) / total_records, text=f"2. OCR実行中... ({i + 1}/{total_records})")
-        return results
+                watcher.cancel()
+
+        def run_job():
+            asyncio.run(run_records())
+            job.tracer.export()
+
+            # --- ログ記録の実行 (画面が閉じられて中止された場合も記録する) ---
+            grand_total_input, grand_total_output = job.usage_ledger.totals()
+            log_ocr_execution(
+                creds_info=creds_info,
+                spreadsheet_id=SPREADSHEET_ID,
+                user_info=user_info,
+                image_count=image_count,
+                input_tokens=grand_total_input,
+                output_tokens=grand_total_output,
+                cost_jpy=job.usage_ledger.total_cost_jpy()
+            )
+            log_usage_breakdown(
+                creds_info=creds_info,
+                spreadsheet_id=SPREADSHEET_ID,
+                run_id=run_id,
+                user_info=user_info,
+                business_code=selected_business_code,
+                ledger=job.usage_ledger,
+                record_count=job.completed
+            )
 
-    # --- メインの実行関数 ---
-    def run_ocr_process(portal_files, municipality_code, selected_business_code, selected_product_code, credentials, client, progress_bar):
-        # 画像ファイル名ごとにポータル情報をグループ化
-        image_groups = {}
-        # NENG APIで取得するユニークな品番を収集するセット
-        unique_product_codes_to_fetch = set()
+        job.start(run_job)
+        return job
 
-        for portal_name, files in portal_files.items():
-            for file in files:
-                full_product_code = get_product_code_from_filename(file['name'])
-                business_code = get_business_code_from_product_code(full_product_code)
-                # 選択された条件に合う画像のみを対象とする
-                if business_code == selected_business_code and \
-                   (selected_product_code == "すべて" or full_product_code == selected_product_code):
+    def _abort_ocr_job():
+        """中止ボタン: 実行中のレコードを打ち切り、完了した分の結果を表示する"""
+        ocr_job = st.session_state.get("ocr_job")
+        if ocr_job is not None:
+            ocr_job.cancel("中止ボタン")
 
-                    if file['name'] not in image_groups:
-                        image_groups[file['name']] = {'portals': {}}
-                    image_groups[file['name']]['portals'][portal_name] = {'id': file['id'], 'mimeType': file['mimeType']}
-
-                    if selected_product_code == "すべて":
-                        unique_product_codes_to_fetch.add(full_product_code)
+    def watch_ocr_job(ocr_job, live_placeholder=None):
+        """
+        実行中のジョブの進捗 (と途中結果) を表示し、完了したら結果をセッションに保存して再実行する。
+        画面が操作されると Streamlit はここで表示を打ち切って再実行するが、ジョブは続き、再実行後の画面がこの関数で表示を引き継ぐ。
+        """
+        with st.spinner("OCR処理を実行中です..."):
+            progress_bar = st.progress(ocr_job.progress_value, text=ocr_job.progress_text)
+            st.button("⏹ 中止（完了分の結果を表示）", key="ocr_abort_button", on_click=_abort_ocr_job, disabled=ocr_job.cancelled)
+            shown_messages = 0
+            rendered_count = None
+            done = False
+            while not done:
+                done = ocr_job.wait(LIVE_REFRESH_INTERVAL)
+                for kind, message in ocr_job.messages[shown_messages:]:
+                    if kind == "toast":
+                        st.toast(message, icon="⚠️")
                     else:
-                        unique_product_codes_to_fetch.add(selected_product_code)
-
-        if not image_groups:
-            st.warning("処理対象の画像が見つかりませんでした。")
-            return None, None, None, None
-
-        print(unique_product_codes_to_fetch)
-
-        # NENG APIの事前一括呼び出し
-        neng_content_map = {}
-        if unique_product_codes_to_fetch:
-            progress_bar.progress(0.0, text="2. NENGデータ取得中...") 
-            try:
-                # 非同期でNENG APIを並列実行
-                neng_tasks = [get_neng_content(prod_code, municipality_code) for prod_code in unique_product_codes_to_fetch]
-
-                async def fetch_neng_data():
-                    return await asyncio.gather(*neng_tasks)
-
-                neng_results = asyncio.run(fetch_neng_data())
-
-                # 結果を辞書（品番: 内容量）にマッピング
-                neng_content_map = dict(zip(unique_product_codes_to_fetch, neng_results))
-
-                print(neng_content_map)
-
-                if any("エラー" in res for res in neng_results if isinstance(res, str)):
-                    st.toast("一部のNENG APIの取得でエラーが発生しました。", icon="⚠️")
-
-            except Exception as e:
-                st.error(f"NENG APIの一括取得中にエラーが発生しました: {e}")
-        total_records = len(image_groups)
-
-        all_results = asyncio.run(main_async_runner(
-            image_groups,
-            selected_product_code,
-            credentials,
-            client,
-            progress_bar,
-            total_records,
-            neng_content_map
-        ))
-
-        # 結果をDataFrame用に整形
-        results_list_display, results_list_excel = [], []
-
-        # --- 画像バイナリデータを格納する辞書 ---
-        all_image_bytes_data = {} # {image_name: {portal_name: bytes}}
-
-        # ポータル名のリストを取得（Excelの列順のため）
-        all_portal_names = sorted(list(portal_files.keys()))
-
-        # DataFrameの列順を定義
-        ordered_columns = ["画像名", "ステータス"]
-        for p in all_portal_names:
-            ordered_columns.extend([f"{p}（画像）", f"{p}（OCR）", f"{p}（内容量）"])
-        ordered_columns.extend(["テキスト比較", "誤字脱字", "NENG内容量", "内容量比較", "エラー検出"])
-
-        grand_total_input = 0
-        grand_total_output = 0
-
-        for image_name, ocr_results, volume_results, image_bytes, typo_result, neng_content, comparison_result, text_comparison_result, rec_in, rec_out in all_results:
-            
-            # --- 画像バイナリデータを辞書に格納 ---
-            all_image_bytes_data[image_name] = image_bytes # image_bytes は {portal_name: bytes}
-            grand_total_input += rec_in
-            grand_total_output += rec_out
-            
-            row_data_display, row_data_excel = {"画像名": image_name}, {"画像名": image_name}
-
-            image_acquisition_failed = False
-            ocr_failed_for_existing_image = False
-
-            for portal_name in all_portal_names:
-                ocr_result_text = ocr_results.get(portal_name, "")
-                if "画像取得失敗" in ocr_result_text:
-                    image_acquisition_failed = True
-                    break 
-
-            if not image_acquisition_failed:
-                for portal_name in all_portal_names:
-                    img_exists = image_bytes.get(portal_name) is not None
-                    ocr_result_text = ocr_results.get(portal_name, "")
-                    if img_exists and (not ocr_result_text or "APIエラー" in ocr_result_text or "AI OCRエラー" in ocr_result_text):
-                        ocr_failed_for_existing_image = True
-                        break
-
-            final_typo_result = typo_result
-
-            error_detection_message = ""
-            if image_acquisition_failed:
-                error_detection_message = "画像読み込み失敗あり"
-            elif ocr_failed_for_existing_image:
-                error_detection_message = "テキスト検出失敗あり"
+                        st.error(message)
+                    shown_messages += 1
+                progress_bar.progress(ocr_job.progress_value, text=ocr_job.progress_text)
+                if live_placeholder is not None and ocr_job.completed != rendered_count:
+                    rendered_count = ocr_job.completed
+                    render_live_results(live_placeholder, ocr_job)
+
+        # 画面の更新で再実行の例外が送出されても結果が残るよう、先にセッションへ保存する
+        st.session_state.ocr_job = None
+        if ocr_job.exception is not None:
+            progress_bar.empty()
+            st.error(f"OCR処理の実行中にエラーが発生しました: {ocr_job.exception}")
+            return
 
-            is_error = (
-                "差分あり" in text_comparison_result or
-                "OK！" not in final_typo_result or 
-                "要確認" in comparison_result or
-                error_detection_message != "" 
+        result_store = ocr_job.result_store()
+        # セッションにはストアのみを保存し、各DataFrameは使う時点で生成する
+        st.session_state.ocr_result_store = result_store
+        st.session_state.ocr_trace = ocr_job.tracer
+        st.session_state.ocr_usage_ledger = ocr_job.usage_ledger
+        if ocr_job.cancelled:
+            st.session_state.ocr_cancel_message = (
+                f"OCR処理を中止しました。完了した {len(result_store)} / {ocr_job.total_records} 件の結果を表示しています。"
             )
-            status = "要確認" if is_error else "異常なし"
-
-            status_color = "red" if status == "要確認" else "blue"
-            row_data_display["ステータス"] = f'<span style="color: {status_color};">{status}</span>'
-            row_data_excel["ステータス"] = status
-
-            for portal_name in all_portal_names:
-                img_bytes_data = image_bytes.get(portal_name)
-                extracted_text = ocr_results.get(portal_name)
-                extracted_volume = volume_results.get(portal_name)
-                file_id = image_groups.get(image_name, {}).get('portals', {}).get(portal_name, {}).get('id')
-
-                img_col_name = f"{portal_name}（画像）"
-                ocr_col_name = f"{portal_name}（OCR）"
-                vol_col_name = f"{portal_name}（内容量）"
-
-                if file_id:
-                    #correct_image_url = f"[https://drive.google.com/file/d/](https://drive.google.com/file/d/){file_id}/view" # ← 【注意！！】画像のリンクがおかしくなるので使用しない
-                    correct_image_url = f"https://drive.google.com/file/d/{file_id}/view"
-                    cleaned_volume = extracted_volume.strip().strip('"') if extracted_volume else ""
-                    
-                    row_data_display[img_col_name] = f'<a href="{correct_image_url}" target="_blank"><img src="data:image/png;base64,{base64.b64encode(img_bytes_data).decode()}" style="max-height: 100px; display: block; margin: auto;"></a>' if img_bytes_data else ""
-                    row_data_display[ocr_col_name] = str(extracted_text).replace('\n', '<br>') if extracted_text else ""
-                    row_data_display[vol_col_name] = cleaned_volume.replace('\n', '<br>')
-                    
-                    row_data_excel[img_col_name] = correct_image_url
-                    row_data_excel[ocr_col_name] = extracted_text if extracted_text else ""
-                    row_data_excel[vol_col_name] = cleaned_volume
-                else:
-                    row_data_display[img_col_name], row_data_display[ocr_col_name], row_data_display[vol_col_name] = None, None, None
-                    row_data_excel[img_col_name], row_data_excel[ocr_col_name], row_data_excel[vol_col_name] = None, None, None
-
-            cleaned_neng_content = neng_content.strip().strip('"') if neng_content else ""
-            row_data_display["NENG内容量"] = cleaned_neng_content.replace('\n', '<br>')
-            row_data_excel["NENG内容量"] = cleaned_neng_content
-
-            if text_comparison_result == "OK！":
-                row_data_display["テキスト比較"] = f'<span style="color: blue;">{text_comparison_result}</span>'
-            elif text_comparison_result == "差分あり":
-                row_data_display["テキスト比較"] = f'<span style="color: red;">{text_comparison_result}</span>'
-            else:
-                row_data_display["テキスト比較"] = f'<span style="color: gray;">{text_comparison_result}</span>'
-            row_data_excel["テキスト比較"] = text_comparison_result
-
-            if final_typo_result == "OK！":
-                row_data_display["誤字脱字"] = f'<span style="color: blue;">{final_typo_result}</span>'
-            else:
-                display_typo_text = final_typo_result.replace('\n', '<br>')
-                row_data_display["誤字脱字"] = f'<span style="color: red;">{display_typo_text}</span>'
-            row_data_excel["誤字脱字"] = final_typo_result
-
-            display_comparison_text = comparison_result.replace('\n', '<br>')
-
-            if comparison_result == "OK！":
-                row_data_display["内容量比較"] = f'<span style="color: blue;">{display_comparison_text}</span>'
-            elif "要確認" in comparison_result: # 部分一致に変更
-                row_data_display["内容量比較"] = f'<span style="color: red;">{display_comparison_text}</span>'
-            elif comparison_result == "内容量記載なし":
-                row_data_display["内容量比較"] = f'<span style="color: gray;">{display_comparison_text}</span>'
-            else:
-                row_data_display["内容量比較"] = display_comparison_text
-            row_data_excel["内容量比較"] = comparison_result
-
-            if error_detection_message:
-                row_data_display["エラー検出"] = f'<span style="color: red;">{error_detection_message}</span>'
-            else:
-                row_data_display["エラー検出"] = ""
-            row_data_excel["エラー検出"] = error_detection_message
-
-            results_list_display.append(row_data_display)
-            results_list_excel.append(row_data_excel)
-
-        df_display = pd.DataFrame(results_list_display).sort_values(by="画像名").reindex(columns=ordered_columns)
-        df_excel = pd.DataFrame(results_list_excel).sort_values(by="画像名").reindex(columns=ordered_columns)
-
-        df_display = df_display.reset_index(drop=True)
-        df_display.insert(0, "No", df_display.index + 1)
-
-        df_excel = df_excel.reset_index(drop=True)
-        df_excel.insert(0, "No", df_excel.index + 1)
-
-        df_display, df_excel = df_display.fillna(''), df_excel.fillna('')
-
-        df_plain_text_for_search = df_display.map(
-            lambda x: re.sub('<[^<]+?>', '', str(x)) if isinstance(x, str) else x
-        )
-
-        # --- ログ記録の実行 ---
-        if 'google_credentials_info' not in globals():
-             _, google_creds_info_log = get_google_credentials()
         else:
-             google_creds_info_log = globals()['google_credentials_info']
-             
-        # 自治体DBと同じスプレッドシートID
-        SPREADSHEET_ID = '1n8qDS8OvuFJwDy2J6wduDHI32GxDmbx1QIrqHPFjdGo'
-        
-        # ユーザー情報の取得
-        user_info = st.user.email if hasattr(st.user, "email") else st.user.name
+            st.session_state.show_success_message = True
 
-        log_ocr_execution(
-            creds_info=google_creds_info_log,
-            spreadsheet_id=SPREADSHEET_ID,
-            user_info=user_info,
-            image_count=st.session_state.image_total_count_to_process,
-            input_tokens=grand_total_input,
-            output_tokens=grand_total_output
-        )
-
-        # --- all_image_bytes_data と df_excel も返す (スプレッドシート保存用) ---
-        return df_display, df_plain_text_for_search, df_excel, all_image_bytes_data
+        if live_placeholder is not None:
+            live_placeholder.empty()
+        st.rerun()
 
     # --- Streamlit UI ---
     col1, col2 = st.columns([4, 1.5]) 
@@ -1221,6 +799,9 @@ else: # Google認証済みの場合のみ以下を実行
         if st.button("📖 操作マニュアル", type="tertiary"):
             show_instructions()
 
+    # --- OCR実行中の途中結果を表示する領域 (メイン画面) ---
+    live_results_area = st.empty()
+
     with col2:
         st.markdown(f"<div style='text-align: center; margin-bottom: 1px;'>ようこそ！ <strong>{st.user.name}</strong> さん</div>", unsafe_allow_html=True) 
         if st.button("ログアウト", icon=":material/logout:", width='stretch', key="logout_button"): 
@@ -1269,19 +850,18 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
 
             with st.expander("自治体リストの参照元"):
                 st.markdown("[こちらのスプレッドシートのデータを参照しています。](https://docs.google.com/spreadsheets/d/1n8qDS8OvuFJwDy2J6wduDHI32GxDmbx1QIrqHPFjdGo/)", unsafe_allow_html=True)
-
-            municipality_map = st.session_state.get("municipality_map", {})
-
-            if isinstance(municipality_map, list):
-                st.sidebar.warning("自治体リストの形式が古いです。データを再読み込みします。")
-                with st.sidebar, st.spinner("自治体リストを更新中..."):
-                    if 'sheets_service' not in locals():
-                        google_creds_check, _ = get_google_credentials()
-                        sheets_service = get_sheets_service(google_creds_check)
-
-                    st.session_state.municipality_map = get_municipality_map(sheets_service)
-                    st.cache_data.clear() 
-                st.rerun()
+                if municipality_registry.loaded_at:
+                    loaded_at_str = datetime.datetime.fromtimestamp(municipality_registry.loaded_at).strftime('%Y-%m-%d %H:%M')
+                    source_label = "保存済みのデータ" if municipality_registry.source == "snapshot" else "スプレッドシート"
+                    st.caption(f"最終読み込み: {loaded_at_str} ({source_label})")
+                # 他のキャッシュ (OCR結果など) には影響せず、自治体リストだけを裏で読み込み直す
+                if st.button("🔄 自治体リストを再読み込み", key="reload_municipality_button"):
+                    municipality_registry.invalidate()
+                    st.toast("自治体リストを再読み込みしています。反映まで少しお待ちください。")
+
+            municipality_map = municipality_registry.get()
+            if municipality_registry.last_error:
+                show_municipality_error(municipality_registry.last_error, stale=bool(municipality_map))
 
             municipality_options = list(municipality_map.keys()) 
 
@@ -1370,7 +950,8 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
             run_disabled = not (selected_business_code and selected_municipality_name is not None) \
                             or st.session_state.show_clear_confirmation \
                             or st.session_state.show_drive_clear_confirmation \
-                            or not st.session_state.portal_files 
+                            or not st.session_state.portal_files \
+                            or st.session_state.ocr_job is not None
 
             if st.button("OCR実行", type="primary", width='stretch', disabled=run_disabled):
                 st.session_state.old_municipality = selected_municipality_name
@@ -1390,7 +971,8 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
             if st.session_state.get("show_ocr_confirmation"):
                 scroll_sidebar_to_bottom()
                 record_count, total_images = st.session_state.record_count_to_process, st.session_state.image_total_count_to_process
-                IMAGE_LIMIT = 500
+                IMAGE_LIMIT = 20000 # 1回の実行の上限 (これを超える場合はフォルダを分けて実行)
+                CHUNKED_IMAGE_THRESHOLD = 500 # これを超える場合は分割実行 (画像は縮小して保持)
                 if total_images > IMAGE_LIMIT:
                     st.error(f"画像枚数の合計が多すぎます ({IMAGE_LIMIT}枚まで)。現在: {total_images}枚")
                     if st.button("閉じる", width='stretch'):
@@ -1398,21 +980,101 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                         st.rerun()
                 else:
                     st.info(f"**{record_count}件**（画像 全{total_images}枚）の処理を開始します。")
+                    if total_images > CHUNKED_IMAGE_THRESHOLD:
+                        st.caption(f"画像が{CHUNKED_IMAGE_THRESHOLD}枚を超えるため、分割して実行します（結果の画像は縮小して表示します）。")
+                    st.toggle(
+                        "完了したレコードから順次表示",
+                        value=True,
+                        key="stream_results_toggle",
+                        help="ONにすると、処理が完了したレコードから順にメイン画面へ途中結果を表示します。"
+                    )
+                    with st.expander("コスト削減オプション", expanded=False):
+                        st.toggle(
+                            "ポータルの画像をまとめてOCR",
+                            value=False,
+                            key="vision_batch_toggle",
+                            help="ONにすると、同じ画像名の各ポータルの画像を1回のリクエストでまとめてOCRします（トークンと通信回数を節約）。"
+                        )
+                        st.toggle(
+                            "チェックは軽量モデルから判定",
+                            value=False,
+                            key="model_routing_toggle",
+                            help="ONにすると、誤字脱字・テキスト比較・内容量比較をまず軽量モデルで判定し、確信度が低い場合やエラーを指摘した場合のみGPT-4oで判定し直します。"
+                        )
+                        st.toggle(
+                            "誤字脱字チェックを複数レコードでまとめて実行",
+                            value=False,
+                            key="typo_batch_toggle",
+                            help="ONにすると、複数レコードのテキストを1回のリクエストでまとめて誤字脱字チェックします（件数が多いほどトークンを節約）。"
+                        )
+                        st.toggle(
+                            "OCR・チェック済みの画像とテキストは結果を再利用",
+                            value=True,
+                            key="check_cache_toggle",
+                            help="ONにすると、以前に（他のユーザーの実行も含めて）OCRした画像や、誤字脱字チェック・テキスト比較・内容量比較を行ったのと同じテキストは、保存済みの結果を使いAPIを呼び出しません。同じ画像を他のユーザーが処理中の場合は、その結果を待って共有します。"
+                        )
+
+                    # --- 実行前の見積もり (過去の実行ログのステージ・モデル別の使用量と昇格率、一覧取得時の画像サイズから) ---
+                    estimate_groups, _ = build_image_groups(st.session_state.portal_files, selected_business_code, selected_product_code)
+                    stage_profiles, profiled_stages, escalation_rates = stage_profiles_from_history(
+                        read_local_log(STAGE_SHEET_NAME), DEFAULT_MODEL_ROUTES
+                    )
+                    routes_for_estimate = DEFAULT_MODEL_ROUTES if st.session_state.get("model_routing_toggle", False) else None
+                    run_estimate = estimate_run(
+                        estimate_groups, stage_profiles,
+                        vision_batch=st.session_state.get("vision_batch_toggle", False),
+                        model_routes=routes_for_estimate,
+                        typo_batch=st.session_state.get("typo_batch_toggle", False),
+                        stage_workers=DEFAULT_STAGE_WORKERS,
+                        escalation_rates=escalation_rates
+                    )
+                    with st.container(border=True):
+                        st.markdown("##### 実行前の見積もり")
+                        m1, m2, m3 = st.columns(3)
+                        m1.metric("トークン", f"{run_estimate.input_tokens + run_estimate.output_tokens:,}")
+                        m2.metric("概算コスト", f"{run_estimate.cost_jpy:,.0f}円")
+                        m3.metric("所要時間", format_duration(run_estimate.seconds))
+                        st.caption(
+                            ("過去の実行ログ" if profiled_stages else "既定値") + "から見積もった目安です。"
+                            "同一画像の重複分は除き、キャッシュのヒット分は含みません。"
+                        )
+                        with st.expander("内訳・モード別の比較", expanded=False):
+                            st.dataframe(run_estimate.to_frame(), hide_index=True, width='stretch')
+                            st.dataframe(
+                                compare_modes(estimate_groups, stage_profiles, DEFAULT_MODEL_ROUTES, DEFAULT_STAGE_WORKERS, escalation_rates),
+                                hide_index=True, width='stretch'
+                            )
+
+                        budget = st.secrets.get("budget", {})
+                        estimate_user = st.user.email if hasattr(st.user, "email") else st.user.name
+                        for budget_warning in budget_warnings(
+                            run_estimate,
+                            monthly_spend_jpy(read_local_log(SHEET_NAME), estimate_user),
+                            monthly_budget_jpy=budget.get("monthly_jpy_per_user", DEFAULT_MONTHLY_BUDGET_JPY),
+                            run_budget_jpy=budget.get("run_jpy", DEFAULT_RUN_BUDGET_JPY)
+                        ):
+                            st.warning(budget_warning, icon="💰")
+
+                    server_load = get_admission_controller().stats()
+                    if server_load["待ち"] or server_load["使用中"] >= server_load["上限"] // 2:
+                        st.caption(
+                            f"現在 {server_load['利用者数']}人・{server_load['実行数']}件の実行が同時に処理中です"
+                            f"（処理中 {server_load['使用中']}/{server_load['上限']}件、待ち {server_load['待ち']}件）。"
+                            "同時実行枠を分け合うため、所要時間は見積もりより長くなる場合があります。"
+                        )
+
                     c1_ocr, c2_ocr = st.columns(2)
                     if c1_ocr.button("OK", width='stretch', key="ocr_exec_ok"):
                         st.session_state.show_ocr_confirmation = False
                         
                         # --- 実行前に前回の結果をクリアする ---
-                        st.session_state.ocr_result_df = None
-                        st.session_state.ocr_plain_df = None
-                        st.session_state.ocr_excel_df = None 
-                        st.session_state.ocr_image_bytes = None
+                        st.session_state.ocr_result_store = None
+                        st.session_state.local_export_file = None
                         st.session_state.current_page = 1
 
                         municipality_code = None
                         try:
-                            municipality_map = st.session_state.get("municipality_map", {})
-                            municipality_code = municipality_map.get(selected_municipality_name)
+                            municipality_code = municipality_registry.get().get(selected_municipality_name)
 
                             if not municipality_code:
                                 st.error("選択された自治体のコードが見つかりません。")
@@ -1421,31 +1083,25 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
 
 
                         if municipality_code:
-                            with st.spinner("OCR処理を実行中です..."):
-                                progress_bar = st.progress(0, text="準備中...")
-                                try:
-                                    # --- 戻り値に image_bytes_data と df_excel を追加 ---
-                                    df, df_plain, df_excel, image_bytes_data = run_ocr_process(
-                                        st.session_state.portal_files,
-                                        municipality_code,
-                                        selected_business_code,
-                                        selected_product_code,
-                                        google_creds,
-                                        async_openai_client,
-                                        progress_bar
-                                    )
-                                    if df is not None: 
-                                        
-                                        st.session_state.ocr_result_df = df
-                                        st.session_state.ocr_plain_df = df_plain
-                                        st.session_state.ocr_excel_df = df_excel 
-                                        # --- 画像バイナリデータをセッションに保存 ---
-                                        st.session_state.ocr_image_bytes = image_bytes_data
-                                        st.session_state.show_success_message = True
-                                except Exception as e:
-                                    st.error(f"OCR処理の実行中にエラーが発生しました: {e}")
-                                    if 'progress_bar' in locals():
-                                        progress_bar.empty()
+                            try:
+                                from openai import AsyncOpenAI
+                                # 進捗の表示は「3. OCR実行」の watch_ocr_job が行う (画面が操作されても実行は続く)
+                                st.session_state.ocr_stream_results = st.session_state.get("stream_results_toggle", True)
+                                st.session_state.ocr_job = start_ocr_job(
+                                    st.session_state.portal_files,
+                                    municipality_code,
+                                    selected_business_code,
+                                    selected_product_code,
+                                    google_creds_info,
+                                    AsyncOpenAI(api_key=openai_api_key),
+                                    vision_batch=st.session_state.get("vision_batch_toggle", False),
+                                    model_routes=DEFAULT_MODEL_ROUTES if st.session_state.get("model_routing_toggle", False) else None,
+                                    typo_batch=st.session_state.get("typo_batch_toggle", False),
+                                    check_cache=get_check_cache() if st.session_state.get("check_cache_toggle", True) else None,
+                                    chunked=total_images > CHUNKED_IMAGE_THRESHOLD
+                                )
+                            except Exception as e:
+                                st.error(f"OCR処理の実行中にエラーが発生しました: {e}")
 
                         st.rerun() 
 
@@ -1453,26 +1109,37 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                         st.session_state.show_ocr_confirmation = False
                         st.rerun()
 
+            # 実行中のジョブがあれば、完了まで進捗を表示する (画面の再実行後もここで引き継ぐ)
+            if st.session_state.ocr_job is not None:
+                watch_ocr_job(
+                    st.session_state.ocr_job,
+                    live_placeholder=live_results_area if st.session_state.get("ocr_stream_results", True) else None
+                )
+
     if st.session_state.pop("show_success_message", False):
         st.toast("処理が完了しました。", icon="🎉")
+    ocr_cancel_message = st.session_state.pop("ocr_cancel_message", None)
+    if ocr_cancel_message:
+        st.warning(ocr_cancel_message)
     
     # --- 結果表示エリア ---
-    if 'ocr_result_df' in st.session_state and st.session_state.ocr_result_df is not None:
-        df_display_source = st.session_state.ocr_result_df 
-        total_count = len(df_display_source)
+    if st.session_state.get("ocr_result_store") is not None:
+        result_store = st.session_state.ocr_result_store
+        # 絞り込み・件数は平文のDFで行い、表示用 (HTML) のDFは表示するページの行だけ生成する
+        df_result_source = result_store.plain_frame()
+        total_count = len(result_store)
 
         # --- スプレッドシート保存エリア (開閉式) ---
         
         # 保存ボタン表示条件
-        show_gspread_button = 'ocr_excel_df' in st.session_state and \
-                              st.session_state.ocr_excel_df is not None and \
-                              not st.session_state.ocr_excel_df.empty
+        show_gspread_button = len(result_store) > 0
 
         # --- _execute_gspread_save コールバック関数 (ここに移動) ---
         def _execute_gspread_save():
             # 実行前に以前のメッセージをリセット
             st.session_state.gspread_save_success_url = None
             st.session_state.gspread_save_error_message = None
+            st.session_state.gspread_save_timings = None
 
             url = st.session_state.gspread_sheet_url_input 
             if not url:
@@ -1485,12 +1152,15 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                 return
             
             try:
-                image_bytes_data = st.session_state.get("ocr_image_bytes", {})
+                saved_store = st.session_state.ocr_result_store
+                image_bytes_data = saved_store.image_bytes()
 
                 # ユーザーに処理中であることを視覚的に伝える
-                with st.spinner("スプレッドシートに保存中..."):
-                    save_to_spreadsheet(
-                        st.session_state.ocr_excel_df, 
+                save_tracer = st.session_state.ocr_trace or NOOP_TRACER
+                with st.spinner("スプレッドシートに保存中..."), save_tracer.span("sheets_export"):
+                    from export import save_to_spreadsheet
+                    save_timings = save_to_spreadsheet(
+                        saved_store.excel_frame(), 
                         spreadsheet_id, 
                         sheet_name,  
                         google_creds_info, 
@@ -1500,7 +1170,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                 
                 #  GID（シートID）を取得してURLを生成
                 with st.spinner("シートURLを取得中..."):
-                    sheet_metadata = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+                    sheet_metadata = get_sheets_service().spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
                     sheets = sheet_metadata.get('sheets', [])
                     gid = None
                     for s in sheets:
@@ -1517,6 +1187,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                 else:
                     st.session_state.gspread_save_success_url = base_url # GIDが見つからなかった場合
                 
+                st.session_state.gspread_save_timings = save_timings
                 st.toast(f"シート「{sheet_name}」に保存しました！", icon="✅") 
 
             except HttpError as e: # HttpErrorをキャッチ
@@ -1526,6 +1197,21 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
             except Exception as e:
                 st.session_state.gspread_save_error_message = str(e)
 
+        # --- ローカルファイル出力用コールバック ---
+        def _build_local_export_file():
+            st.session_state.local_export_file = None
+            st.session_state.local_export_error_message = None
+            try:
+                from export import build_local_export
+                st.session_state.local_export_file = build_local_export(
+                    st.session_state.ocr_result_store.excel_frame(),
+                    st.session_state.local_export_format,
+                    sheet_name,
+                    st.session_state.portal_files
+                )
+            except Exception as e:
+                st.session_state.local_export_error_message = str(e)
+
         # --- 保存用変数定義（シート名など） ---
         today_str = datetime.datetime.now().strftime('%Y%m%d')
         municipality_name = st.session_state.old_municipality if st.session_state.old_municipality else "unknown"
@@ -1555,12 +1241,89 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
             if st.session_state.gspread_save_success_url:
                 success_url = st.session_state.gspread_save_success_url
                 st.success(f"スプレッドシートに保存しました: [開く]({success_url})", icon="📄")
+                if st.session_state.gspread_save_timings:
+                    timing_text = " / ".join(f"{phase} {sec:.1f}秒" for phase, sec in st.session_state.gspread_save_timings.items())
+                    st.caption(f"所要時間: {timing_text}")
+
+            # --- ファイルでダウンロード (Sheets APIを使わない出力) ---
+            with st.expander("ファイルでダウンロード", expanded=False):
+                from export import LOCAL_EXPORT_FORMATS
+                st.radio(
+                    "出力形式",
+                    options=list(LOCAL_EXPORT_FORMATS.keys()),
+                    key="local_export_format",
+                    horizontal=True,
+                    on_change=lambda: st.session_state.update(local_export_file=None)
+                )
+                st.button("ファイルを作成", key="local_export_build_button", width='stretch', on_click=_build_local_export_file)
+
+                if st.session_state.get("local_export_error_message"):
+                    st.error(st.session_state.local_export_error_message, icon="🚨")
+
+                if st.session_state.local_export_file:
+                    export_data, export_file_name, export_mime = st.session_state.local_export_file
+                    st.download_button(
+                        f"{export_file_name} をダウンロード",
+                        data=export_data,
+                        file_name=export_file_name,
+                        mime=export_mime,
+                        type="primary",
+                        width='stretch',
+                        icon=":material/download:"
+                    )
+
+        # --- 利用状況 (ステージ・モデル別のトークンとコスト) ---
+        if st.session_state.ocr_usage_ledger is not None:
+            with st.expander("利用状況（トークン・コスト）", expanded=False):
+                usage_summary = st.session_state.ocr_usage_ledger.rollup()
+                st.markdown("##### 今回の実行")
+                st.dataframe(usage_summary, hide_index=True, width='stretch')
+                st.caption(f"概算コスト合計: {st.session_state.ocr_usage_ledger.total_cost_jpy():.2f}円")
+                schema_violations = st.session_state.ocr_usage_ledger.schema_violation_counts()
+                if schema_violations:
+                    st.caption("応答形式の不正（従来の解析で処理）: " + " / ".join(f"{stage} {count}件" for stage, count in schema_violations.items()))
+                escalation_summary = st.session_state.ocr_usage_ledger.escalation_summary()
+                if not escalation_summary.empty:
+                    st.markdown("##### 軽量モデルからの昇格")
+                    st.dataframe(escalation_summary, hide_index=True, width='stretch')
+                cache_summary = st.session_state.ocr_usage_ledger.cache_summary()
+                if not cache_summary.empty:
+                    st.markdown("##### OCR・チェック結果の再利用（キャッシュ）")
+                    st.dataframe(cache_summary, hide_index=True, width='stretch')
+                st.download_button(
+                    "明細をCSVでダウンロード",
+                    data=st.session_state.ocr_usage_ledger.to_dataframe().to_csv(index=False).encode("utf-8-sig"),
+                    file_name=f"{sheet_name}_usage.csv",
+                    mime="text/csv",
+                    key="usage_csv_download"
+                )
+
+                usage_history = read_local_log(STAGE_SHEET_NAME)
+                if usage_history:
+                    st.markdown("##### これまでの実行（このサーバーの記録）")
+                    history_key = st.radio("集計単位", ["ステージ", "利用者", "事業者コード"], horizontal=True, key="usage_history_key")
+                    history_keys = [history_key, "モデル"] if history_key == "ステージ" else [history_key]
+                    st.dataframe(rollup_usage_history(usage_history, history_keys), hide_index=True, width='stretch')
+
+        # --- 実行の診断情報 (ステージ別のレイテンシ・同時実行数) ---
+        if st.session_state.ocr_trace is not None:
+            with st.expander("実行の診断情報（前回の実行）", expanded=False):
+                trace = st.session_state.ocr_trace
+                st.caption(f"実行ID: {trace.run_id} / 全体の所要時間: {trace.wall_time():.1f}秒")
+                st.markdown("##### ステージ別の所要時間")
+                st.dataframe(trace.stage_stats(), hide_index=True, width='stretch')
+                st.markdown("##### 時間のかかったレコード")
+                st.dataframe(trace.slowest_records(), hide_index=True, width='stretch')
+                if trace.pipeline_stats is not None:
+                    st.markdown("##### ステージ別のスループット・キュー")
+                    st.dataframe(trace.pipeline_stats, hide_index=True, width='stretch')
+                    st.caption("稼働率が1に近く、前段のキューが上限に張り付いているステージがボトルネックです。")
 
         # ---------------------------------------------------------
 
-        if not df_display_source.empty:
+        if not df_result_source.empty:
             product_codes_in_result = sorted(list(
-                df_display_source['画像名'].apply(get_product_code_from_filename).unique()
+                df_result_source['画像名'].apply(get_product_code_from_filename).unique()
             ))
             product_filter_options = ["すべて"] + product_codes_in_result
         else:
@@ -1649,7 +1412,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
             return [style] * len(row)
 
         # --- データフィルタリング ---
-        df_to_process = df_display_source.copy() 
+        df_to_process = df_result_source # 絞り込みは新しいDFを作るため、コピーしない
 
         col_header_left, col_header_right = st.columns([3, 2])
 
@@ -1678,7 +1441,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
 
                 # 3. 誤字脱字・OCRエラー (表示時のみ)
                 if show_ocr_cols:
-                    if "誤字脱字" in row and '<span style="color: blue;">OK！</span>' not in str(row["誤字脱字"]):
+                    if "誤字脱字" in row and str(row["誤字脱字"]) != "OK！":
                         return True
                     # OCR列のエラーチェック
                     for col_name in row.index:
@@ -1709,8 +1472,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
 
             # 3. 全文検索フィルター
             if search_term:
-                df_plain_text_filtered = st.session_state.ocr_plain_df.loc[df_to_process.index]
-                mask_search = df_plain_text_filtered.apply(
+                mask_search = df_to_process.apply(
                     lambda row: row.astype(str).str.contains(search_term, case=False, na=False).any(),
                     axis=1
                 )
@@ -1749,7 +1511,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                     # 「拡大表示」をONにするスイッチ
                     is_zoom_mode = st.toggle("拡大表示", value=False, key="view_mode_toggle")
 
-            all_columns = df_display_source.columns 
+            all_columns = df_result_source.columns 
             final_columns_to_show = []
             for col in all_columns:
                 if col in ["No", "画像名", "ステータス", "エラー検出"]:
@@ -1783,7 +1545,6 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
                     elif '（内容量）' in col and show_content_cols:
                         final_columns_to_show.append(col)
 
-            df_filtered_display = df_to_process[final_columns_to_show] 
 
             ITEMS_PER_PAGE = 20
             total_pages = math.ceil(filtered_count / ITEMS_PER_PAGE) if filtered_count > 0 else 1
@@ -1793,7 +1554,7 @@ URL指定用フォルダ ＞ ポータル名等が付いたフォルダ（複数
 
             start_idx = (st.session_state.current_page - 1) * ITEMS_PER_PAGE
             end_idx = start_idx + ITEMS_PER_PAGE
-            df_paginated = df_filtered_display.iloc[start_idx:end_idx]
+            df_paginated = result_store.display_frame(rows=df_to_process.index[start_idx:end_idx])[final_columns_to_show]
 
             if not df_paginated.empty:
                 from functools import partial 
@@ -0,0 +1,268 @@
+"""
+オフラインのベンチマーク (ネットワーク・APIキー不要)。
+
+Drive / OpenAI / NENG をローカルのスタブに置き換えて、アプリと同じパイプライン
+(ocr_pipeline.py) を合成フォルダ (既定: 10 / 100 / 500 画像) に対して実行し、
+実行時間・ピークメモリ・リクエスト数/秒を表示する。
+
+使い方 (リポジトリのルートで実行):
+    python -m bench.run_bench
+    python -m bench.run_bench --sizes 10 100 --latency 0.5 --rate-429 0.05
+    python -m bench.run_bench --json bench_result.json --baseline bench_baseline.json --tolerance 0.25
+    python -m bench.run_bench --compare-vision-batch   # 1枚ずつ / まとめてOCR のトークン数と結果の一致率を比較
+    python -m bench.run_bench --check-cache --distinct-texts 20   # 同じ画像・文言のOCR・二次チェック結果を再利用
+    python -m bench.run_bench --sizes 2000 --chunked   # 分割実行 (タスクを順次作成し、画像データは縮小画像に置き換え)
+    python -m bench.run_bench --staged --stage-workers download=8 vision=40   # ステージ分割 (ステージごとのワーカー数を指定)
+    python -m bench.run_bench --staged --process-pool   # 画像の前処理をプロセスプールで実行 (アプリと同じ)
+
+--baseline を指定すると、実行時間が基準より tolerance (割合) 以上悪化したサイズがあれば終了コード 1 を返す (CI用)。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import aiohttp
+from openai import AsyncOpenAI
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocr_pipeline import build_image_groups, fetch_neng_content_map, main_async_runner, record_from_result, RECORD_WINDOW, DEFAULT_STAGE_WORKERS
+from results import OcrResultStore
+from tracing import Tracer
+from usage import UsageLedger
+from routing import DEFAULT_MODEL_ROUTES
+from check_cache import CheckCache
+from image_workers import ImageProcessor
+from bench.stubs import FakeDrive, OpenAIStub, NengStub, BENCH_BUSINESS_CODE, BENCH_MUNICIPALITY_CODE
+
+
+def run_pipeline(drive, portal_files, openai_base_url, neng_base_url, concurrency, vision_batch=False, model_routes=None, typo_batch=False, check_cache=None, chunked=False, stage_workers=None, image_processor=None):
+    """app.py の start_ocr_job と同じ手順 (NENG取得 → OCR → 結果テーブル作成) をスタブに対して実行する"""
+    image_groups, product_codes = build_image_groups(portal_files, BENCH_BUSINESS_CODE, "すべて")
+    tracer = Tracer("bench")
+    ledger = UsageLedger()
+    result_store = OcrResultStore(sorted(portal_files.keys()))
+    errors = []
+
+    with tracer.span("neng"):
+        neng_content_map = asyncio.run(fetch_neng_content_map(
+            product_codes, BENCH_MUNICIPALITY_CODE,
+            base_url=neng_base_url, auth=aiohttp.BasicAuth("bench", "bench")
+        ))
+
+    async def run():
+        # クライアントはイベントループごとに作成する
+        client = AsyncOpenAI(api_key="bench", base_url=f"{openai_base_url}/v1")
+        try:
+            return await main_async_runner(
+                image_groups, "すべて", None, client, None, len(image_groups), neng_content_map,
+                on_result=lambda result: result_store.append(record_from_result(result, image_groups)),
+                ledger=ledger, tracer=tracer, downloader=drive.download,
+                on_error=errors.append, concurrency=concurrency, vision_batch=vision_batch,
+                model_routes=model_routes, typo_batch=typo_batch, check_cache=check_cache,
+                window=RECORD_WINDOW if chunked else None, thumbnails=chunked, stage_workers=stage_workers,
+                image_processor=image_processor,
+            )
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+
+    with tracer.span("assemble"):
+        # 画面と同じく、平文で絞り込んでから1ページ分 (20件) だけ表示用のHTMLを生成する
+        result_store.display_frame(rows=result_store.plain_frame().index[:20])
+        result_store.excel_frame()
+    return result_store, ledger, tracer, errors
+
+
+def bench_size(image_count, drive, openai_stub, neng_stub, concurrency, vision_batch=False, model_routes=None, typo_batch=False, check_cache=None, chunked=False, stage_workers=None, image_processor=None):
+    portal_files = drive.list_portal_files(image_count)
+    openai_stub.reset_stats()
+    drive.download_count = 0
+
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    result_store, ledger, tracer, errors = run_pipeline(
+        drive, portal_files, openai_stub.server.base_url, neng_stub.server.base_url, concurrency, vision_batch, model_routes, typo_batch, check_cache, chunked, stage_workers, image_processor
+    )
+    wall = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    input_tokens, output_tokens = ledger.totals()
+    calls = ledger.to_dataframe()
+    typo_calls = calls[calls["stage"] == "typo"]
+    need_check = int((result_store.excel_frame()["ステータス"] == "要確認").sum()) if len(result_store) else 0
+    return {
+        "images": image_count,
+        "vision_batch": vision_batch,
+        "records": len(result_store),
+        "wall_s": round(wall, 3),
+        "peak_mb": round(peak / 1024 / 1024, 1),
+        "api_requests": openai_stub.stats["requests"],
+        "rate_limited": openai_stub.stats["rate_limited"],
+        "requests_per_s": round(openai_stub.stats["requests"] / wall, 1),
+        "records_per_s": round(len(result_store) / wall, 1),
+        "downloads": drive.download_count,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "typo_calls": len(typo_calls),
+        "typo_input_tokens": int(typo_calls["input_tokens"].sum()),
+        "cost_jpy": round(ledger.total_cost_jpy(), 2),
+        "need_check": need_check,
+        "errors": len(errors),
+        "stages": tracer.stage_stats().to_dict("records"),
+        "escalations": ledger.escalation_summary().to_dict("records"),
+        "cache": ledger.cache_summary().to_dict("records"),
+        "schema_violations": ledger.schema_violation_counts(),
+        "pipeline": tracer.pipeline_stats.to_dict("records") if tracer.pipeline_stats is not None else [],
+    }, result_store
+
+
+def ocr_agreement(store_a, store_b):
+    """2つの実行結果で、ポータルごとのOCR全文・内容量が一致した割合"""
+    df_a, df_b = store_a.excel_frame(), store_b.excel_frame()
+    columns = [col for col in df_a.columns if col.endswith("（OCR）") or col.endswith("（内容量）")]
+    if df_a.empty or not columns:
+        return 1.0
+    merged = df_a[["画像名"] + columns].merge(df_b[["画像名"] + columns], on="画像名", suffixes=("_a", "_b"))
+    matches = sum((merged[f"{col}_a"] == merged[f"{col}_b"]).sum() for col in columns)
+    return matches / (len(merged) * len(columns))
+
+
+def print_result(result, portals):
+    mode = "まとめてOCR" if result["vision_batch"] else "1枚ずつOCR"
+    print(
+        f"{result['images']:>5}画像 x {portals}ポータル [{mode}]: {result['wall_s']:.2f}秒 / "
+        f"ピーク {result['peak_mb']:.1f}MB / {result['requests_per_s']:.1f} req/s "
+        f"(API {result['api_requests']}回, 429 {result['rate_limited']}回, ダウンロード {result['downloads']}回, "
+        f"{result['records_per_s']:.1f} レコード/秒, 入力 {result['input_tokens']} / 出力 {result['output_tokens']} トークン, "
+        f"概算 {result['cost_jpy']:.2f}円, エラー {result['errors']}件)"
+    )
+    print(f"    誤字脱字チェック: {result['typo_calls']}回 / 入力 {result['typo_input_tokens']} トークン")
+    if result["schema_violations"]:
+        print("    スキーマ違反: " + " / ".join(f"{stage} {count}件" for stage, count in result["schema_violations"].items()))
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """基準より実行時間が tolerance 以上悪化したサイズを返す"""
+    base_by_key = {(r["images"], r.get("vision_batch", False)): r for r in baseline}
+    regressions = []
+    for r in results:
+        base = base_by_key.get((r["images"], r["vision_batch"]))
+        if base and r["wall_s"] > base["wall_s"] * (1 + tolerance):
+            regressions.append((r["images"], base["wall_s"], r["wall_s"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="OCRパイプラインのオフラインベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 500], help="1ポータルあたりの画像数")
+    parser.add_argument("--portals", type=int, default=3)
+    parser.add_argument("--image-kb", type=int, default=64, help="合成画像1枚のサイズ(KB)")
+    parser.add_argument("--shared-ratio", type=float, default=0.0, help="全ポータルで同一の画像になる画像名の割合")
+    parser.add_argument("--drive-latency", type=float, default=0.05, help="Drive ダウンロード1回の待ち時間(秒)")
+    parser.add_argument("--latency", type=float, default=0.3, help="OpenAI スタブの応答待ち時間(秒)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="応答待ち時間に加える 0〜jitter 秒の揺らぎ")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="429 を返す確率")
+    parser.add_argument("--input-tokens", type=int, default=None, help="1リクエストのテキスト部分の入力トークン数 (省略時はプロンプトの文字数)")
+    parser.add_argument("--image-tokens", type=int, default=765)
+    parser.add_argument("--output-tokens", type=int, default=150)
+    parser.add_argument("--neng-latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=25, help="同時に処理するレコード数")
+    parser.add_argument("--vision-batch", action="store_true", help="各ポータルの画像をまとめてOCRする")
+    parser.add_argument("--compare-vision-batch", action="store_true", help="1枚ずつ / まとめてOCR の両方で実行して比較する")
+    parser.add_argument("--typo-batch", action="store_true", help="誤字脱字チェックを複数レコードまとめて実行する")
+    parser.add_argument("--model-routing", action="store_true", help="二次チェックを軽量モデルから判定する")
+    parser.add_argument("--low-confidence-rate", type=float, default=0.1, help="軽量モデルが低い確信度を返す確率")
+    parser.add_argument("--flag-rate", type=float, default=0.05, help="チェックでエラーを指摘する確率")
+    parser.add_argument("--check-cache", action="store_true", help="OCR・二次チェックの結果をキャッシュする (サイズごとに空のメモリ上のキャッシュから開始)")
+    parser.add_argument("--chunked", action="store_true", help="分割実行 (アプリで画像が多い場合と同じ)")
+    parser.add_argument("--staged", action="store_true", help="ステージ分割で実行する (アプリと同じ)")
+    parser.add_argument("--stage-workers", nargs="+", default=[], metavar="STAGE=N", help="ステージごとのワーカー数 (例: download=8 vision=40)")
+    parser.add_argument("--process-pool", action="store_true", help="画像の前処理 (ハッシュ・Base64・縮小画像) をプロセスプールで実行する")
+    parser.add_argument("--distinct-texts", type=int, default=None, help="OCRテキストの種類数 (同じ文言が複数の画像に載っている状況を再現)")
+    parser.add_argument("--stages", action="store_true", help="ステージ別の所要時間も表示する")
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    parser.add_argument("--baseline", help="比較対象の結果JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する実行時間の悪化率")
+    args = parser.parse_args(argv)
+    stage_workers = None
+    if args.staged or args.stage_workers:
+        stage_workers = dict(DEFAULT_STAGE_WORKERS)
+        for spec in args.stage_workers:
+            stage, _, count = spec.partition("=")
+            if stage not in stage_workers or not count.isdigit():
+                parser.error(f"--stage-workers の指定が不正です: {spec}")
+            stage_workers[stage] = int(count)
+
+    drive = FakeDrive(portals=args.portals, image_kb=args.image_kb, latency=args.drive_latency, shared_ratio=args.shared_ratio)
+    openai_stub = OpenAIStub(
+        latency=args.latency, jitter=args.jitter, rate_429=args.rate_429,
+        input_tokens=args.input_tokens, image_tokens=args.image_tokens, output_tokens=args.output_tokens,
+        low_confidence_rate=args.low_confidence_rate, flag_rate=args.flag_rate, distinct_texts=args.distinct_texts,
+    )
+    neng_stub = NengStub(latency=args.neng_latency)
+    image_processor = ImageProcessor() if args.process_pool else None
+    openai_stub.server.start()
+    neng_stub.server.start()
+
+    results = []
+    try:
+        for size in args.sizes:
+            modes = [False, True] if args.compare_vision_batch else [args.vision_batch]
+            stores = []
+            for vision_batch in modes:
+                result, result_store = bench_size(
+                    size, drive, openai_stub, neng_stub, args.concurrency, vision_batch,
+                    DEFAULT_MODEL_ROUTES if args.model_routing else None, args.typo_batch,
+                    CheckCache(":memory:") if args.check_cache else None, args.chunked, stage_workers, image_processor
+                )
+                results.append(result)
+                stores.append(result_store)
+                print_result(result, args.portals)
+                for escalation in result["escalations"]:
+                    print(f"    昇格 {escalation['ステージ']}: {escalation['昇格回数']}/{escalation['判定回数']} ({escalation['昇格率']:.1%}) {escalation['昇格理由']}")
+                for cache in result["cache"]:
+                    print(f"    キャッシュ {cache['ステージ']}: {cache['ヒット数']}/{cache['参照回数']} ({cache['ヒット率']:.1%}) 共有 {cache['共有数']}")
+                for stage in result["pipeline"]:
+                    print(
+                        f"    [{stage['ステージ']}] ワーカー {stage['ワーカー数']} / {stage['スループット(件/秒)']}件/秒 / "
+                        f"稼働率 {stage['稼働率']:.0%} / キュー 平均 {stage['平均キュー長']} 最大 {stage['最大キュー長']}/{stage['キュー上限']}"
+                    )
+                if args.stages:
+                    for stage in result["stages"]:
+                        print(f"    {stage['ステージ']}: 件数 {stage['件数']} p50 {stage['p50(秒)']}秒 p95 {stage['p95(秒)']}秒 最大同時 {stage['最大同時実行数']}")
+            if args.compare_vision_batch:
+                single, batch = results[-2], results[-1]
+                saved = 1 - batch["input_tokens"] / single["input_tokens"] if single["input_tokens"] else 0
+                print(
+                    f"    → まとめてOCR: 入力トークン {saved:.1%} 削減, API呼び出し {single['api_requests']} → {batch['api_requests']}回, "
+                    f"OCR結果の一致率 {ocr_agreement(stores[0], stores[1]):.1%}"
+                )
+    finally:
+        openai_stub.server.stop()
+        neng_stub.server.stop()
+        if image_processor is not None:
+            image_processor.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        for images, base_wall, wall in regressions:
+            print(f"性能劣化: {images}画像 {base_wall:.2f}秒 → {wall:.2f}秒")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
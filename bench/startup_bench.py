@@ -0,0 +1,122 @@
+"""
+起動時間のベンチマーク (ネットワーク・APIキー不要)。
+
+新しく起動したインスタンス (コールドスタート) を想定し、毎回新しいプロセスで次の時間を測定する。
+  - ログイン画面: streamlit.testing の AppTest で app.py を1回実行する時間 (未ログイン状態)
+  - ログイン後の読み込み: app.py のログイン後 (else 以下) で import しているモジュールの読み込み時間
+  - サービス作成: Drive v3 / Sheets v4 のサービス作成1回あたりの時間 (build() と google_clients.build_service の比較)
+--importtime を指定すると、python -X importtime でログイン後の読み込みを計測し、時間のかかったモジュールを表示する。
+
+使い方 (リポジトリのルートで実行):
+    python -m bench.startup_bench
+    python -m bench.startup_bench --repeat 5 --importtime 15
+"""
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(REPO_DIR, "app.py")
+
+LOGIN_SCRIPT = """
+import time
+t = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app!r}, default_timeout=120)
+at.run()
+print(time.perf_counter() - t)
+"""
+
+IMPORT_SCRIPT = """
+import time
+import streamlit
+t = time.perf_counter()
+{imports}
+print(time.perf_counter() - t)
+"""
+
+
+def main_app_imports():
+    """app.py のログイン後 (if not st.user... の else 以下) で、関数の外で import している文を返す"""
+    with open(APP_FILE, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.If) and "is_logged_in" in ast.unparse(node.test):
+            return [ast.unparse(stmt) for stmt in node.orelse if isinstance(stmt, (ast.Import, ast.ImportFrom))]
+    raise Exception("app.py にログイン判定の if 文が見つかりません。")
+
+
+def run_timed(script):
+    """新しいプロセスで script を実行し、最終行に出力された秒数を返す"""
+    result = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise Exception(f"計測用プロセスが失敗しました: {result.stderr.strip()[-500:]}")
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def measure_service_build(iterations=20):
+    """Drive / Sheets のサービス作成1回あたりの時間 (秒) を (build(), build_service) の順に返す"""
+    sys.path.insert(0, REPO_DIR)
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    from google_clients import build_service
+
+    credentials = Credentials("bench") # 作成のみでAPIは呼ばないため、ダミーのトークンでよい
+    timings = []
+    for factory in (build, build_service):
+        factory("drive", "v3", credentials=credentials) # 初回 (文書の読み込み) は除く
+        start = time.perf_counter()
+        for _ in range(iterations):
+            factory("drive", "v3", credentials=credentials)
+            factory("sheets", "v4", credentials=credentials)
+        timings.append((time.perf_counter() - start) / iterations)
+    return timings
+
+
+def read_importtime(script):
+    """python -X importtime の結果を [(累積マイクロ秒, 自身のマイクロ秒, モジュール名)] で返す"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", script], cwd=REPO_DIR, capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    return rows
+
+
+def print_importtime(imports, top):
+    """ログイン後の読み込みのうち、累積時間の大きいモジュールを表示する (streamlit 自体の読み込み分は除く)"""
+    streamlit_modules = {name for _, _, name in read_importtime("import streamlit")}
+    rows = [row for row in read_importtime("import streamlit\n" + "\n".join(imports)) if row[2] not in streamlit_modules]
+    rows.sort(reverse=True)
+    print(f"\n読み込みに時間のかかったモジュール (上位{top}件, 累積ミリ秒 / 自身のミリ秒):")
+    for cumulative_us, self_us, name in rows[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} / {self_us / 1000:7.1f}  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--repeat", type=int, default=3, help="各測定の繰り返し回数 (毎回新しいプロセス)")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="読み込みに時間のかかったモジュールを上位N件表示する")
+    args = parser.parse_args()
+
+    imports = main_app_imports()
+    login = [run_timed(LOGIN_SCRIPT.format(app=APP_FILE)) for _ in range(args.repeat)]
+    main_imports = [run_timed(IMPORT_SCRIPT.format(imports="\n".join(imports))) for _ in range(args.repeat)]
+    build_seconds, cached_seconds = measure_service_build()
+
+    print(f"ログイン画面 (AppTest 1回実行): 中央値 {statistics.median(login):.2f}秒 (最小 {min(login):.2f} / 最大 {max(login):.2f})")
+    print(f"ログイン後の読み込み ({len(imports)}文): 中央値 {statistics.median(main_imports):.2f}秒 (最小 {min(main_imports):.2f} / 最大 {max(main_imports):.2f})")
+    print(f"サービス作成 (Drive + Sheets): build() {build_seconds * 1000:.1f}ミリ秒 / build_service {cached_seconds * 1000:.2f}ミリ秒")
+
+    if args.importtime:
+        print_importtime(imports, args.importtime)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from aiohttp import web
+
+# === ベンチマーク用のスタブ (bench/stubs.py) ===
+# 実際の Google Drive / OpenAI / NENG の代わりにローカルで応答する偽物。
+# ネットワークに出ず、トークンも消費せずにパイプライン全体のスループットを計測するために使う。
+
+BENCH_BUSINESS_CODE = "01BNCH"
+BENCH_MUNICIPALITY_CODE = "bench"
+
+
+class FakeDrive:
+    """
+    Google Drive の代わり。ポータルごとのファイル一覧を合成し、ダウンロードでは
+    ファイルごとに決まる疑似ランダムなバイト列を返す (latency 秒の待ちを挟む)。
+    shared_ratio の割合の画像名は、全ポータルで同一の画像 (同じ md5Checksum) になる。
+    """
+
+    def __init__(self, portals=3, image_kb=64, latency=0.05, shared_ratio=0.0):
+        self.portal_names = [f"ポータル{chr(ord('A') + i)}" for i in range(portals)]
+        self.image_kb = image_kb
+        self.latency = latency
+        self.shared_ratio = shared_ratio
+        self.download_count = 0
+        self._content_keys = {} # ファイルID -> 画像内容を決めるキー
+        self._lock = threading.Lock()
+
+    def _content(self, content_key):
+        return random.Random(content_key).randbytes(self.image_kb * 1024)
+
+    def list_portal_files(self, image_count):
+        """list_drive_files_and_business_codes と同じ形式の {ポータル名: [ファイル情報]} を返す"""
+        portal_files = {}
+        checksums = {}
+        for portal_name in self.portal_names:
+            files = []
+            for i in range(image_count):
+                name = f"{BENCH_BUSINESS_CODE}{i // 4:03d}-{i % 4 + 1}.jpg" # 1品番あたり4枚
+                file_id = f"{portal_name}:{name}"
+                shared = random.Random(name).random() < self.shared_ratio
+                content_key = name if shared else file_id
+                self._content_keys[file_id] = content_key
+                if content_key not in checksums:
+                    checksums[content_key] = hashlib.md5(self._content(content_key)).hexdigest()
+                files.append({"id": file_id, "name": name, "mimeType": "image/jpeg", "md5Checksum": checksums[content_key]})
+            portal_files[portal_name] = files
+        return portal_files
+
+    def download(self, file_id, credentials):
+        """download_drive_image_sync と同じシグネチャ (スレッドプールから呼ばれる)"""
+        time.sleep(self.latency)
+        with self._lock:
+            self.download_count += 1
+        return self._content(self._content_keys.get(file_id, file_id))
+
+
+class StubServer:
+    """aiohttp のアプリを専用スレッドのイベントループで起動する"""
+
+    def __init__(self, app):
+        self.app = app
+        self.base_url = None
+        self._loop = asyncio.new_event_loop()
+        self._runner = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name="bench-stub", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        return self
+
+    async def _start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+class OpenAIStub:
+    """
+    OpenAI 互換の /v1/chat/completions スタブ。
+    latency + 0〜jitter 秒待ってから応答し、rate_429 の確率で 429 (レート制限) を返す。
+    応答内容はリクエストの種類 (画像OCR / 誤字脱字 / 比較) に応じたJSON。
+    画像OCRのテキストは画像データのハッシュから決まるため、まとめてOCRした場合も同じ結果になる。
+    distinct_texts を指定すると、OCRのテキストをその種類数に限定する (同じ文言が複数の画像に載っている状況の再現)。
+    """
+
+    def __init__(self, latency=0.3, jitter=0.2, rate_429=0.0, input_tokens=None, image_tokens=765, output_tokens=150,
+                 low_confidence_rate=0.0, flag_rate=0.0, distinct_texts=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.low_confidence_rate = low_confidence_rate # 確信度を求められた場合に低い値を返す確率
+        self.flag_rate = flag_rate # 誤字あり・差分ありと判定する確率
+        self.distinct_texts = distinct_texts
+        self.input_tokens = input_tokens # テキスト部分の入力トークン数 (None の場合はプロンプトの文字数で概算)
+        self.image_tokens = image_tokens # 画像1枚あたりの入力トークン数
+        self.output_tokens = output_tokens
+        self._random = random.Random(seed)
+        self.stats = {"requests": 0, "rate_limited": 0, "images": 0}
+        self.server = StubServer(self._make_app())
+
+    def _make_app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/chat/completions", self._handle)
+        return app
+
+    def reset_stats(self):
+        self.stats = {key: 0 for key in self.stats}
+
+    async def _handle(self, request):
+        body = await request.json()
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency + self._random.uniform(0, self.jitter))
+
+        if self._random.random() < self.rate_429:
+            self.stats["rate_limited"] += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after-ms": "100"},
+            )
+
+        content = body["messages"][0]["content"]
+        images = [] # [(ラベル, データURL)]
+        if isinstance(content, list):
+            prompt = content[0].get("text", "")
+            label = None
+            for part in content[1:]:
+                if part.get("type") == "text":
+                    label = part["text"].strip("[]")
+                elif part.get("type") == "image_url":
+                    images.append((label, part["image_url"]["url"]))
+                    label = None
+        else:
+            prompt = content
+        image_count = len(images)
+        self.stats["images"] += image_count
+        prompt_tokens = (self.input_tokens if self.input_tokens is not None else len(prompt)) + image_count * self.image_tokens
+
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self._fake_content(prompt, images)},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.output_tokens,
+                "total_tokens": prompt_tokens + self.output_tokens,
+            },
+        })
+
+    def _fake_ocr(self, data_url):
+        digest = hashlib.md5(data_url.encode()).hexdigest()[:8]
+        if self.distinct_texts:
+            digest = f"{int(digest, 16) % self.distinct_texts:08d}"
+        return {"full_text": f"ベンチマーク用のテキスト {digest}\n内容量 500g", "volume_text": "500g"}
+
+    def _fake_content(self, prompt, images):
+        if len(images) == 1 and images[0][0] is None:
+            return json.dumps(self._fake_ocr(images[0][1]), ensure_ascii=False)
+        if images:
+            return json.dumps({"images": [{"label": label, **self._fake_ocr(url)} for label, url in images]}, ensure_ascii=False)
+        # 複数レコードをまとめた誤字脱字チェック
+        labels = re.findall(r"^=== (R\d+) ===$", prompt, re.M)
+        if labels:
+            return json.dumps({"results": [{"label": label, **self._fake_check(prompt)} for label in labels]}, ensure_ascii=False)
+        return json.dumps(self._fake_check(prompt), ensure_ascii=False)
+
+    def _fake_check(self, prompt):
+        flagged = self._random.random() < self.flag_rate
+        # schemas.py の応答モデルと同じ形式 (全キーを含む)
+        if "誤字" in prompt:
+            result = {"status": "error", "message": "\"ベンチマーク\" を確認", "affected_sources": []} if flagged else {"status": "ok", "message": "", "affected_sources": []}
+        elif "deviant_sources" in prompt:
+            result = {"result": "ng" if flagged else "ok", "deviant_sources": []}
+        else:
+            result = {"result": "ng"} if flagged else {"result": "ok"}
+        if "確信度" in prompt:
+            result["confidence"] = 0.4 if self._random.random() < self.low_confidence_rate else 0.95
+        return result
+
+
+class NengStub:
+    """NENG API (admin-ajax.php?action=n2_items_api) のスタブ"""
+
+    def __init__(self, latency=0.05, volume_text="500g"):
+        self.latency = latency
+        self.volume_text = volume_text
+        self.stats = {"requests": 0}
+        app = web.Application()
+        app.router.add_get("/{municipality}/wp-admin/admin-ajax.php", self._handle)
+        self.server = StubServer(app)
+
+    async def _handle(self, request):
+        self.stats["requests"] += 1
+        await asyncio.sleep(self.latency)
+        return web.json_response({"items": [{"内容量・規格等": self.volume_text}]})
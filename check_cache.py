@@ -0,0 +1,145 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# === OCR・二次チェック結果のキャッシュ (check_cache.py) ===
+# 画像OCR (画像の内容ハッシュ) と誤字脱字・テキスト比較・内容量比較 (正規化した入力) の結果を、
+# プロンプトのバージョンとモデル設定を含めたキーで保存する。
+# 同じフォルダを複数の担当者が実行した場合や、同じ文言が複数の商品画像に載っている場合に、同じ処理を繰り返さないようにする。
+# 保存先は SQLite (プロセスをまたいで保持)。件数が上限を超えたら最後に使われた日時が古いものから削除する (LRU)。
+# 同じキーの処理が他のセッションで実行中の場合は、API を呼ばずにその結果を待って共有する (SingleFlight)。
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+CHECK_CACHE_FILE = os.path.join(CACHE_DIR, "check_cache.sqlite3")
+CHECK_CACHE_MAX_ENTRIES = 50000
+
+
+def make_cache_key(stage, prompt_version, model_config, normalized_input):
+    """ステージ・プロンプトのバージョン・モデル設定・正規化済みの入力からキーを作る"""
+    payload = json.dumps([stage, prompt_version, model_config, normalized_input], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、新たに実行せずその結果を待つ。
+    Streamlit のセッションはそれぞれ別スレッドのイベントループで実行されるため、
+    待ち合わせには concurrent.futures.Future を使う (スレッド・イベントループをまたいで共有できる)。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {} # キー -> 実行中の処理の Future
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    async def do(self, key, fn):
+        """
+        fn (引数なしのコルーチン関数) を実行して結果を返す。同じキーの処理が実行中ならその結果を返す。
+        戻り値: (結果, 自分で実行したかどうか)
+        実行していた側が失敗 (例外・キャンセル) した場合は、待っていた側が自分で実行する。
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = concurrent.futures.Future()
+
+        if not leader:
+            try:
+                # 待っている側がキャンセルされても、実行中の処理は止めない
+                return await asyncio.shield(asyncio.wrap_future(future)), False
+            except Exception:
+                return await fn(), True
+
+        try:
+            result = await fn()
+        except BaseException as e:
+            with self._lock:
+                self._calls.pop(key, None)
+            future.set_exception(e if isinstance(e, Exception) else Exception("処理が中断されました"))
+            raise
+        with self._lock:
+            self._calls.pop(key, None)
+        future.set_result(result)
+        return result, True
+
+
+class CheckCache:
+    """SQLite に保存する LRU キャッシュ (スレッドセーフ)。inflight で実行中の処理を共有する"""
+
+    def __init__(self, path=CHECK_CACHE_FILE, max_entries=CHECK_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = {} # ステージ -> ヒット数 (プロセス起動後の累計)
+        self.misses = {}
+        self._lock = threading.Lock()
+        self._puts_since_evict = 0
+        self.inflight = SingleFlight()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS check_cache ("
+            " key TEXT PRIMARY KEY, stage TEXT, value TEXT, created_at REAL, last_used_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_check_cache_last_used ON check_cache (last_used_at)")
+        self._conn.commit()
+
+    def get(self, stage, key):
+        """キャッシュされた結果 (なければ None) を返し、ヒット・ミスを数える"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM check_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses[stage] = self.misses.get(stage, 0) + 1
+                return None
+            self._conn.execute("UPDATE check_cache SET last_used_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits[stage] = self.hits.get(stage, 0) + 1
+            return json.loads(row[0])
+
+    def put(self, stage, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO check_cache (key, stage, value, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                (key, stage, json.dumps(value, ensure_ascii=False), now, now)
+            )
+            self._puts_since_evict += 1
+            # 上限の確認は一定件数ごとにまとめて行う
+            if self._puts_since_evict >= 100:
+                self._evict()
+                self._puts_since_evict = 0
+            self._conn.commit()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM check_cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM check_cache WHERE key IN (SELECT key FROM check_cache ORDER BY last_used_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM check_cache").fetchone()[0]
+
+    def hit_rate(self):
+        """プロセス起動後のヒット率 (0〜1)"""
+        hits, misses = sum(self.hits.values()), sum(self.misses.values())
+        return hits / (hits + misses) if hits + misses else 0.0
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM check_cache")
+            self._conn.commit()
@@ -0,0 +1,291 @@
+import datetime
+import math
+import pandas as pd
+
+from image_workers import VISION_MAX_SIDE
+from ocr_pipeline import (
+    DEFAULT_STAGE_WORKERS, VISION_PROMPT, VISION_BATCH_MAX_IMAGES, TYPO_CHECK_RULES, TYPO_BATCH_MAX_RECORDS,
+    estimate_text_tokens
+)
+from usage import estimate_cost_jpy, STAGE_LABELS
+
+# === 実行前の見積もり (estimate.py) ===
+# Drive の一覧取得で得た画像サイズ・ファイルサイズと、過去の実行ログ (ステージ別ログ) の
+# ステージ・モデル別のトークン数・レイテンシ、軽量モデルからの昇格率から、実行前にトークン数・概算コスト・所要時間を見積もる。
+# 過去のログがないステージ・モデルは既定値を使う。キャッシュのヒットは見込まない (多めの目安)。
+
+UNROUTED_MODEL = "gpt-4o" # モデルの振り分けを行わない場合のモデル
+
+# ステージ -> 1件あたりの既定値 (入力トークン, 出力トークン, レイテンシ秒)。
+# 誤字脱字は1レコードあたり、その他は1回あたり。画像OCRの入力はプロンプト分のみ (画像分は別途計算)
+DEFAULT_STAGE_PROFILES = {
+    "vision": (estimate_text_tokens([VISION_PROMPT]), 200, 8.0),
+    "typo": (1300, 60, 3.0),
+    "text_compare": (700, 10, 2.0),
+    "volume_compare": (900, 20, 2.0),
+}
+DEFAULT_IMAGE_TOKENS = 765 # 画像サイズが不明な場合 (1024x1024 相当)
+DOWNLOAD_BASE_SECONDS = 0.3 # Drive からの取得1回あたりの固定の待ち
+DOWNLOAD_BYTES_PER_SECOND = 5 * 1024 * 1024 # 取得1回あたりの転送速度
+DEFAULT_ESCALATION_RATE = 0.2 # 軽量モデルで判定した場合に強いモデルへ昇格する割合 (ログがない場合の想定)
+BATCH_LATENCY_PER_EXTRA_IMAGE = 0.5 # まとめてOCRする場合、画像1枚追加ごとのレイテンシの増加率
+
+# 利用者ごとの予算 (secrets.toml の [budget] で上書きできる)
+DEFAULT_MONTHLY_BUDGET_JPY = 10000 # 利用者1人あたりの月の上限
+DEFAULT_RUN_BUDGET_JPY = 2000 # 1回の実行で確認を促す金額
+
+_STAGES_BY_LABEL = {label: stage for stage, label in STAGE_LABELS.items()}
+
+
+def vision_image_tokens(width, height, max_side=VISION_MAX_SIDE):
+    """
+    Vision API (detail: high) の画像1枚あたりの入力トークン数。
+    max_side に収まるよう縮小した後、短辺を768pxにそろえ、512pxのタイル数 × 170 + 85 で数える。
+    """
+    if not width or not height:
+        return DEFAULT_IMAGE_TOKENS
+    scale = min(1.0, max_side / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def stage_profiles_from_history(history_records, model_routes=None):
+    """
+    ステージ別ログのレコードから、ステージ・モデルごとの (入力トークン, 出力トークン, レイテンシ秒) と昇格率を求める。
+    - 誤字脱字は1レコードあたり。まとめて実行した実行 (呼び出し回数 < レコード数) とレコード数のない古いログは使わない。
+    - 軽量モデルで判定した実行の強いモデルの呼び出しは昇格分として数え、強いモデルのみの実行の値には含めない。
+    - 昇格率は、軽量モデルで判定した件数に対する昇格した件数の割合 (ステージ別)。
+    ログにないステージ・モデルは既定値。画像OCRの入力トークンは画像サイズから計算するため既定値のまま。
+    戻り値: ({ステージ: {モデル: (入力, 出力, レイテンシ)}}, ログから求めたステージのセット, {ステージ: 昇格率})
+    """
+    runs = {} # 実行ID -> {(ステージ, モデル): (呼び出し回数, 入力トークン, 出力トークン, 平均レイテンシ, レコード数)}
+    for record in history_records:
+        stage = _STAGES_BY_LABEL.get(record.get("ステージ"))
+        try:
+            calls = int(record.get("呼び出し回数") or 0)
+            input_tokens = float(record.get("入力トークン") or 0)
+            output_tokens = float(record.get("出力トークン") or 0)
+            latency = float(record.get("平均レイテンシ(秒)") or 0)
+            record_count = int(record.get("レコード数") or 0)
+        except (TypeError, ValueError):
+            continue
+        if stage not in DEFAULT_STAGE_PROFILES or calls <= 0:
+            continue
+        runs.setdefault(record.get("実行ID"), {})[(stage, record.get("モデル"))] = (calls, input_tokens, output_tokens, latency, record_count)
+
+    totals = {} # (ステージ, モデル) -> [件数, 入力トークン, 出力トークン, 呼び出し回数, レイテンシの合計]
+    escalations = {} # ステージ -> [軽量モデルで判定した件数, 昇格した件数]
+    for rows in runs.values():
+        for (stage, model), (calls, input_tokens, output_tokens, latency, record_count) in rows.items():
+            route = model_routes.get(stage) if model_routes else None
+            if route is not None and (stage, route.primary) in rows:
+                if model == route.escalation:
+                    continue # 昇格分 (件数は軽量モデルの行で数える)
+                if model == route.primary:
+                    judged = record_count if stage == "typo" else calls
+                    if judged > 0:
+                        escalation = escalations.setdefault(stage, [0, 0])
+                        escalation[0] += judged
+                        escalation[1] += rows.get((stage, route.escalation), (0,))[0]
+            units = calls
+            if stage == "typo":
+                if record_count <= 0 or calls < record_count:
+                    continue
+                units = record_count
+            total = totals.setdefault((stage, model), [0, 0.0, 0.0, 0, 0.0])
+            total[0] += units
+            total[1] += input_tokens
+            total[2] += output_tokens
+            total[3] += calls
+            total[4] += latency * calls
+
+    profiles = {}
+    for (stage, model), (units, input_tokens, output_tokens, calls, latency_total) in totals.items():
+        profiles.setdefault(stage, {})[model] = (
+            DEFAULT_STAGE_PROFILES[stage][0] if stage == "vision" else input_tokens / units,
+            output_tokens / units,
+            latency_total / calls,
+        )
+    escalation_rates = {stage: escalated / judged for stage, (judged, escalated) in escalations.items()}
+    return profiles, set(profiles), escalation_rates
+
+
+def _stage_profile(profiles, stage, model=UNROUTED_MODEL):
+    """ステージ・モデルの (入力, 出力, レイテンシ)。そのモデルのログがなければ振り分けなしのモデルの値、それもなければ既定値"""
+    stage_profiles = (profiles or {}).get(stage, {})
+    return stage_profiles.get(model) or stage_profiles.get(UNROUTED_MODEL) or DEFAULT_STAGE_PROFILES[stage]
+
+
+class RunEstimate:
+    """1回の実行の見積もり"""
+
+    def __init__(self, records, images, downloads):
+        self.records = records
+        self.images = images
+        self.downloads = downloads # md5Checksum が同じ画像は1回だけ取得・OCRする
+        self.stage_rows = [] # [ステージ, 呼び出し回数, 入力トークン, 出力トークン, 概算コスト(円)]
+        self.stage_seconds = {} # パイプラインのステージ -> 全レコード分の処理時間 (ワーカー数で割った値)
+        self.record_seconds = 0.0 # 1レコードあたりの所要時間 (パイプラインの立ち上がり分)
+
+    def add_stage(self, stage, calls, input_tokens, output_tokens, cost_jpy):
+        self.stage_rows.append([STAGE_LABELS.get(stage, stage), round(calls), round(input_tokens), round(output_tokens), round(cost_jpy, 2)])
+
+    @property
+    def input_tokens(self):
+        return sum(row[2] for row in self.stage_rows)
+
+    @property
+    def output_tokens(self):
+        return sum(row[3] for row in self.stage_rows)
+
+    @property
+    def cost_jpy(self):
+        return sum(row[4] for row in self.stage_rows)
+
+    @property
+    def seconds(self):
+        """ステージは並行して進むため、最も時間のかかるステージ + 1レコード分の所要時間"""
+        return max(self.stage_seconds.values(), default=0.0) + self.record_seconds
+
+    def to_frame(self):
+        return pd.DataFrame(self.stage_rows, columns=["ステージ", "呼び出し回数", "入力トークン", "出力トークン", "概算コスト(円)"])
+
+
+def estimate_run(image_groups, profiles=None, vision_batch=False, model_routes=None, typo_batch=False, stage_workers=None, escalation_rates=None):
+    """
+    build_image_groups の結果から、実行1回分のトークン数・概算コスト・所要時間を見積もる。
+    portals の各ファイルに size・imageMediaMetadata (一覧取得時の値) があれば、取得時間・画像のトークン数に使う。
+    profiles・escalation_rates は stage_profiles_from_history の結果 (省略時は既定値)。
+    """
+    workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+    vision_prompt, vision_output, vision_latency = _stage_profile(profiles, "vision")
+
+    records = len(image_groups)
+    images = sum(len(group['portals']) for group in image_groups.values())
+    download_seconds = vision_seconds = check_seconds = 0.0
+    vision_calls = vision_input = vision_output_total = 0
+    text_compare_records = 0
+    downloads = 0
+
+    for group in image_groups.values():
+        # 取得時と同じく md5Checksum が同じ画像は1枚として数える
+        unique_files = {}
+        for portal_name, p_data in group['portals'].items():
+            unique_files.setdefault(p_data.get('md5Checksum') or f"id:{p_data['id']}", p_data)
+        downloads += len(unique_files)
+        if len(unique_files) > 1:
+            text_compare_records += 1
+
+        image_token_list = []
+        for p_data in unique_files.values():
+            size = int(p_data.get('size') or 0)
+            download_seconds += DOWNLOAD_BASE_SECONDS + size / DOWNLOAD_BYTES_PER_SECOND
+            metadata = p_data.get('imageMediaMetadata') or {}
+            image_token_list.append(vision_image_tokens(metadata.get('width'), metadata.get('height')))
+
+        per_call = VISION_BATCH_MAX_IMAGES if vision_batch else 1
+        for start in range(0, len(image_token_list), per_call):
+            chunk = image_token_list[start:start + per_call]
+            vision_calls += 1
+            vision_input += vision_prompt + sum(chunk)
+            vision_output_total += vision_output * len(chunk)
+            vision_seconds += vision_latency * (1 + BATCH_LATENCY_PER_EXTRA_IMAGE * (len(chunk) - 1))
+
+    estimate = RunEstimate(records, images, downloads)
+    estimate.add_stage("vision", vision_calls, vision_input, vision_output_total, estimate_cost_jpy(UNROUTED_MODEL, vision_input, vision_output_total))
+
+    # 二次チェック (誤字脱字は全レコード、テキスト比較は画像が異なるレコード、内容量比較は全レコードで見積もる)
+    # 軽量モデルで判定する場合は、昇格率の分だけ強いモデルの呼び出しも加える (昇格は1レコードずつ)
+    check_counts = {"typo": records, "text_compare": text_compare_records, "volume_compare": records}
+    check_latency = {}
+    for stage, target_records in check_counts.items():
+        route = model_routes.get(stage) if model_routes else None
+        if route is None:
+            models = [(UNROUTED_MODEL, 1.0, typo_batch)]
+        else:
+            rate = (escalation_rates or {}).get(stage, DEFAULT_ESCALATION_RATE)
+            models = [(route.primary, 1.0, typo_batch), (route.escalation, rate, False)]
+
+        calls = input_tokens = output_tokens = cost = latency = 0.0
+        for model, share, batched in models:
+            per_input, per_output, per_latency = _stage_profile(profiles, stage, model)
+            model_calls = target_records * share
+            model_input = per_input * model_calls
+            if stage == "typo" and batched and target_records:
+                # まとめて実行する場合、チェックのルール部分はリクエストごとに1回だけ送る
+                rules = estimate_text_tokens([TYPO_CHECK_RULES])
+                model_calls = math.ceil(target_records / TYPO_BATCH_MAX_RECORDS)
+                model_input = max(per_input - rules, 0) * target_records + rules * model_calls
+            model_output = per_output * target_records * share
+            calls += model_calls
+            input_tokens += model_input
+            output_tokens += model_output
+            cost += estimate_cost_jpy(model, model_input, model_output)
+            latency += per_latency * share
+        if calls:
+            estimate.add_stage(stage, calls, input_tokens, output_tokens, cost)
+        check_latency[stage] = latency
+        check_seconds += latency * target_records
+
+    estimate.stage_seconds = {
+        "download": download_seconds / workers["download"],
+        "vision": vision_seconds / workers["vision"],
+        "checks": check_seconds / workers["checks"],
+    }
+    if records:
+        # 誤字脱字とテキスト比較は並行、内容量比較はその後
+        estimate.record_seconds = (download_seconds + vision_seconds) / records \
+            + max(check_latency["typo"], check_latency["text_compare"]) + check_latency["volume_compare"]
+    return estimate
+
+
+def compare_modes(image_groups, profiles=None, model_routes=None, stage_workers=None, escalation_rates=None):
+    """コスト削減オプションの組み合わせごとの見積もり (トークン数・概算コスト・所要時間)"""
+    modes = [
+        ("標準", False, None, False),
+        ("まとめてOCR", True, None, False),
+        ("軽量モデルで判定", False, model_routes, False),
+        ("すべてON", True, model_routes, True),
+    ]
+    rows = []
+    for label, vision_batch, routes, typo_batch in modes:
+        estimate = estimate_run(image_groups, profiles, vision_batch, routes, typo_batch, stage_workers, escalation_rates)
+        rows.append([label, estimate.input_tokens + estimate.output_tokens, round(estimate.cost_jpy), format_duration(estimate.seconds)])
+    return pd.DataFrame(rows, columns=["モード", "トークン", "概算コスト(円)", "所要時間"])
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f"約{max(1, round(seconds))}秒"
+    if seconds < 3600:
+        return f"約{round(seconds / 60)}分"
+    return f"約{seconds / 3600:.1f}時間"
+
+
+def monthly_spend_jpy(history_records, user, now=None):
+    """実行ログ (logs シートのレコード) から、利用者の今月 (日本時間) の概算コストの合計を求める"""
+    now = now or datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9)))
+    month_prefix = now.strftime('%Y/%m/')
+    total = 0.0
+    for record in history_records:
+        if str(record.get("利用者")) != str(user) or not str(record.get("日時", "")).startswith(month_prefix):
+            continue
+        try:
+            total += float(record.get("概算コスト(円)") or 0)
+        except (TypeError, ValueError):
+            continue
+    return total
+
+
+def budget_warnings(estimate, spent_this_month, monthly_budget_jpy=DEFAULT_MONTHLY_BUDGET_JPY, run_budget_jpy=DEFAULT_RUN_BUDGET_JPY):
+    """見積もりが予算を超える場合の警告文のリスト"""
+    warnings = []
+    if run_budget_jpy and estimate.cost_jpy > run_budget_jpy:
+        warnings.append(f"この実行の概算コスト（約{estimate.cost_jpy:,.0f}円）が1回あたりの目安（{run_budget_jpy:,.0f}円）を超えています。")
+    if monthly_budget_jpy and spent_this_month + estimate.cost_jpy > monthly_budget_jpy:
+        warnings.append(
+            f"今月の利用額（約{spent_this_month:,.0f}円）とこの実行の合計が、月の予算（{monthly_budget_jpy:,.0f}円）を超えます。"
+        )
+    return warnings
@@ -2,39 +2,35 @@ import streamlit as st
 import pandas as pd
 import copy
 import re 
+import io
+import json
+import time
+import random
+import threading
+import collections
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # --- Google関連 ---
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import gspread
 import gspread_dataframe as gd
 
-# --- サービスアカウントのインポート ---
-from google.oauth2 import service_account
+# --- 共有の Google API クライアント (認証・接続を保存のたびに作り直さない) ---
+from google_clients import get_google_clients
 
 
 # === スプレッドシート出力 (export.py) ===
 
-@st.cache_resource
 def get_google_services(creds_info): 
-    """サービスアカウント認証情報(辞書)からDrive, Sheets(v4), gspreadのサービスを取得"""
+    """サービスアカウント認証情報(辞書)からDrive, Sheets(v4), gspreadのサービスを取得 (プロセス全体で共有)"""
     if creds_info is None:
         raise Exception("Googleサービス(export.py)の認証情報がありません。")
 
     try:
-        scopes = [
-            'https://www.googleapis.com/auth/drive',
-            'https://www.googleapis.com/auth/spreadsheets'
-        ]
-        creds = service_account.Credentials.from_service_account_info(
-            creds_info, scopes=scopes
-        )
-        
-        user_drive_service = build('drive', 'v3', credentials=creds)
-        user_sheets_service_v4 = build('sheets', 'v4', credentials=creds)
-        gc = gspread.service_account_from_dict(creds_info)
-        
-        return user_drive_service, user_sheets_service_v4, gc
+        clients = get_google_clients(creds_info)
+        return clients.drive(), clients.sheets(), clients.gspread()
     except Exception as e:
         raise Exception(f"Googleサービス(export.py)への接続に失敗しました: {e}")
 
@@ -48,10 +44,15 @@ def hex_to_rgb(hex_code):
     }
 
 # --- 書式定義 ---
-COLOR_RED_GS = hex_to_rgb("#FF0000")
-COLOR_BLUE_GS = hex_to_rgb("#0000FF") 
-COLOR_GRAY_GS = hex_to_rgb("#808080")
-COLOR_HIGHLIGHT_BG_GS = hex_to_rgb("#FFE5E5")
+COLOR_RED_HEX = "#FF0000"
+COLOR_BLUE_HEX = "#0000FF"
+COLOR_GRAY_HEX = "#808080"
+COLOR_HIGHLIGHT_BG_HEX = "#FFE5E5"
+
+COLOR_RED_GS = hex_to_rgb(COLOR_RED_HEX)
+COLOR_BLUE_GS = hex_to_rgb(COLOR_BLUE_HEX) 
+COLOR_GRAY_GS = hex_to_rgb(COLOR_GRAY_HEX)
+COLOR_HIGHLIGHT_BG_GS = hex_to_rgb(COLOR_HIGHLIGHT_BG_HEX)
 
 BORDER_STYLE_GS = {"style": "SOLID", "width": 1, "color": hex_to_rgb("#808080")}
 BORDERS_GS = {"top": BORDER_STYLE_GS, "bottom": BORDER_STYLE_GS, "left": BORDER_STYLE_GS, "right": BORDER_STYLE_GS}
@@ -74,16 +75,16 @@ IMAGE_CELL_FORMAT_GS = {
     "verticalAlignment": "MIDDLE"
 }
 
-def get_cell_format_request(sheet_id, row_idx, col_idx, cell_format):
-    """BatchUpdate用のリクエストボディを作成"""
+def get_range_format_request(sheet_id, start_row, end_row, start_col, end_col, cell_format):
+    """BatchUpdate用のリクエストボディを作成 (範囲指定)"""
     return {
         "repeatCell": {
             "range": {
                 "sheetId": sheet_id,
-                "startRowIndex": row_idx,
-                "endRowIndex": row_idx + 1,
-                "startColumnIndex": col_idx,
-                "endColumnIndex": col_idx + 1
+                "startRowIndex": start_row,
+                "endRowIndex": end_row,
+                "startColumnIndex": start_col,
+                "endColumnIndex": end_col
             },
             "cell": {"userEnteredFormat": cell_format},
             "fields": "userEnteredFormat"
@@ -91,9 +92,117 @@ def get_cell_format_request(sheet_id, row_idx, col_idx, cell_format):
     }
 
 
-def format_worksheet_gspread(sheets_service, spreadsheet_id, sheet_id, df, portal_files):
+def get_conditional_format_request(sheet_id, start_row, end_row, start_col, end_col, formula, cell_format, index):
+    """カスタム数式による条件付き書式ルールの追加リクエストを作成"""
+    return {
+        "addConditionalFormatRule": {
+            "rule": {
+                "ranges": [{
+                    "sheetId": sheet_id,
+                    "startRowIndex": start_row,
+                    "endRowIndex": end_row,
+                    "startColumnIndex": start_col,
+                    "endColumnIndex": end_col
+                }],
+                "booleanRule": {
+                    "condition": {
+                        "type": "CUSTOM_FORMULA",
+                        "values": [{"userEnteredValue": formula}]
+                    },
+                    "format": cell_format
+                }
+            },
+            "index": index
+        }
+    }
+
+
+def column_letter(col_idx):
+    """0始まりの列番号をA1表記の列名 (A, B, ..., AA) に変換"""
+    return re.sub(r'\d+', '', gspread.utils.rowcol_to_a1(1, col_idx + 1))
+
+
+def get_status_color_conditions(col_name, cell_ref):
     """
-    Sheets API v4のBatchUpdateを使用して書式設定を行う。
+    列ごとの文字色の判定条件を (数式, 色) のリストで返す。上から順に評価され、最初に一致した色が適用される。
+    (以前のセルごとの色付けロジックと同じ判定を数式で表現したもの)
+    """
+    if col_name == "ステータス":
+        return [
+            (f'{cell_ref}="異常なし"', COLOR_BLUE_GS),
+            (f'{cell_ref}<>"異常なし"', COLOR_RED_GS),
+        ]
+    if col_name == "誤字脱字":
+        # 「OK！」以外は全て赤
+        return [
+            (f'{cell_ref}="OK！"', COLOR_BLUE_GS),
+            (f'{cell_ref}<>"OK！"', COLOR_RED_GS),
+        ]
+    if col_name == "エラー検出":
+        return [
+            (f'{cell_ref}="OK！"', COLOR_BLUE_GS),
+            (f'{cell_ref}<>""', COLOR_RED_GS),
+        ]
+    if col_name in ["テキスト比較", "内容量比較"]:
+        return [
+            (f'{cell_ref}="OK！"', COLOR_BLUE_GS),
+            (f'OR({cell_ref}="比較対象なし",{cell_ref}="内容量記載なし")', COLOR_GRAY_GS),
+            (f'{cell_ref}<>""', COLOR_RED_GS), # 「差分あり」「要確認」などそれ以外の値
+        ]
+    return []
+
+
+def resolve_text_color(col_name, value):
+    """
+    get_status_color_conditions と同じ判定をPython側で行い、セルの文字色 (HEX) を返す。
+    色を付けない場合は None。(ローカルファイル出力用)
+    """
+    value = "" if value is None else str(value)
+    if col_name == "ステータス":
+        return COLOR_BLUE_HEX if value == "異常なし" else COLOR_RED_HEX
+    if col_name == "誤字脱字":
+        return COLOR_BLUE_HEX if value == "OK！" else COLOR_RED_HEX
+    if col_name == "エラー検出":
+        if value == "OK！":
+            return COLOR_BLUE_HEX
+        return COLOR_RED_HEX if value != "" else None
+    if col_name in ["テキスト比較", "内容量比較"]:
+        if value == "OK！":
+            return COLOR_BLUE_HEX
+        if value in ["比較対象なし", "内容量記載なし"]:
+            return COLOR_GRAY_HEX
+        return COLOR_RED_HEX if value != "" else None
+    return None
+
+
+def get_column_pixel_widths(portal_files):
+    """列ごとの幅 (ピクセル) のリストを返す (スプレッドシート・Excel出力共通)"""
+    all_portal_names = sorted(list(portal_files.keys())) if portal_files else []
+
+    widths = [
+        50,  # A (No)
+        150, # B (画像名)
+        100, # C (ステータス)
+    ]
+    for _ in all_portal_names:
+        widths.append(200) # 画像 (幅)
+        widths.append(300) # OCR (広め)
+        widths.append(150) # 内容量
+
+    widths.extend([
+        150, # テキスト比較
+        200, # 誤字脱字
+        150, # NENG内容量
+        150, # 内容量比較
+        150, # エラー検出
+    ])
+    return widths
+
+
+def build_format_requests(sheet_id, df, portal_files, existing_rule_count=0):
+    """
+    書式設定用のBatchUpdateリクエスト (Sheets API v4) のリストを作成する。
+    existing_rule_count はシートに既に設定されている条件付き書式の数（削除対象）。
     """
     
     requests = []
@@ -126,38 +235,9 @@ def format_worksheet_gspread(sheets_service, spreadsheet_id, sheet_id, df, porta
         }
     })
     
-    all_portal_names = sorted(list(portal_files.keys())) if portal_files else []
-    
     # --- 1. 列幅設定 ---
     col_width_requests = []
-    
-    col_properties = [
-        {"pixelSize": 50},   # A (No)
-        {"pixelSize": 150}, # B (画像名)
-        {"pixelSize": 100}, # C (ステータス)
-    ]
-    
-    col_idx = 3
-    image_col_indices = [] 
-    
-    for _ in all_portal_names:
-        col_properties.append({"pixelSize": 200}) # 画像 (幅)
-        image_col_indices.append(col_idx) 
-        col_idx += 1
-        
-        col_properties.append({"pixelSize": 300}) # OCR (広め)
-        col_idx += 1
-        
-        col_properties.append({"pixelSize": 150}) # 内容量
-        col_idx += 1
-
-    col_properties.extend([
-        {"pixelSize": 150}, # テキスト比較
-        {"pixelSize": 200}, # 誤字脱字
-        {"pixelSize": 150}, # NENG内容量
-        {"pixelSize": 150}, # 内容量比較
-        {"pixelSize": 150}, # エラー検出
-    ])
+    col_properties = [{"pixelSize": width} for width in get_column_pixel_widths(portal_files)]
 
     for i, props in enumerate(col_properties):
         col_width_requests.append({
@@ -215,96 +295,208 @@ def format_worksheet_gspread(sheets_service, spreadsheet_id, sheet_id, df, porta
         }
     })
     
-    # --- 4. データ行のセルごとの書式設定 (Excelロジックと同様) ---
+    # --- 4. データ行の書式設定 (列範囲 + 条件付き書式) ---
+    # セル単位ではなく範囲単位で指定するため、リクエスト数は行数に依存しない
     
-    # 書式定義 (gspread_formatting.CellFormat ではない、辞書形式)
-    fmt_default = BASE_CELL_FORMAT_GS
-    fmt_highlight_bg = {"backgroundColor": COLOR_HIGHLIGHT_BG_GS}
-    fmt_text_red = {"textFormat": {"foregroundColor": COLOR_RED_GS}}
-    fmt_text_blue = {"textFormat": {"foregroundColor": COLOR_BLUE_GS}}
-    fmt_text_gray = {"textFormat": {"foregroundColor": COLOR_GRAY_GS}}
-    
-    fmt_image_cell = copy.deepcopy(BASE_CELL_FORMAT_GS)
-    fmt_image_cell.update(IMAGE_CELL_FORMAT_GS)
+    # 既存の条件付き書式を削除 (同名シートへの再保存時にルールが重複・残留しないように。0行の保存でも削除する)
+    for _ in range(existing_rule_count):
+        requests.append({"deleteConditionalFormatRule": {"sheetId": sheet_id, "index": 0}})
+
+    data_row_count = len(df)
+    if data_row_count > 0:
+        start_row, end_row = 1, data_row_count + 1 # ヘッダー(0行目)の次からデータ行の最後まで
 
-    cell_format_requests = []
+        # 4-1. データ範囲全体に基本書式
+        requests.append(get_range_format_request(sheet_id, start_row, end_row, 0, len(df.columns), BASE_CELL_FORMAT_GS))
 
-    for row_num, row_data in df.iterrows():
-        row_idx_gspread = row_num + 1 # 0始まりのヘッダー行(0) + 1
-        is_highlight_row = (row_data.get('ステータス', '') == '要確認')
-        
+        # 4-2. 画像列はURLに下線と青色を付ける（ExcelのURL書式と同様）
+        fmt_image_link = copy.deepcopy(BASE_CELL_FORMAT_GS)
+        fmt_image_link["textFormat"] = {**fmt_image_link["textFormat"], "foregroundColor": COLOR_BLUE_GS, "underline": True}
         for col_num, col_name in enumerate(df.columns):
-            cell_value = row_data[col_name]
-            col_idx_gspread = col_num
+            if '（画像）' in col_name:
+                requests.append(get_range_format_request(sheet_id, start_row, end_row, col_num, col_num + 1, fmt_image_link))
 
-            # デフォルト書式（基本 + 必要なら背景ハイライト）
-            current_cell_format = copy.deepcopy(fmt_default)
-            if is_highlight_row:
-                current_cell_format.update(fmt_highlight_bg)
-
-            # --- Excelと同じ色付けロジック ---
-            if col_name == "ステータス":
-                if cell_value == "異常なし":
-                    current_cell_format.update(fmt_text_blue)
-                else: # "要確認"
-                    current_cell_format.update(fmt_text_red)
-            
-            elif col_name in ["テキスト比較", "誤字脱字", "内容量比較", "エラー検出"]:
-                if cell_value == "OK！":
-                    current_cell_format.update(fmt_text_blue)
-                elif cell_value in ["差分あり", "要確認"] or \
-                        (col_name == "誤字脱字" and "OK！" not in str(cell_value)) or \
-                        (col_name == "エラー検出" and str(cell_value) != ""): 
-                    current_cell_format.update(fmt_text_red)
-                elif cell_value in ["比較対象なし", "内容量記載なし"]:
-                    current_cell_format.update(fmt_text_gray)
-                elif cell_value != "": 
-                    current_cell_format.update(fmt_text_red)
-            
-            elif '（画像）' in col_name:
-                # 画像列はURL文字列が入るので、中央揃えではなくデフォルト(左上)のままにする
-                # current_cell_format.update(IMAGE_CELL_FORMAT_GS)
-                
-                # URLに下線と青色を付ける（ExcelのURL書式と同様）
-                current_cell_format.update({"textFormat": {"foregroundColor": COLOR_BLUE_GS, "underline": True}})
-            
-            cell_format_requests.append(
-                get_cell_format_request(sheet_id, row_idx_gspread, col_idx_gspread, current_cell_format)
-            )
+        # 4-3. ステータス・チェック列の文字色と「要確認」行の背景ハイライト
+        # 条件付き書式はセルごとに最初に一致したルールのみ適用されるため、
+        # 「ハイライト + 文字色」の組み合わせルールを先に、ハイライトのみのルールを最後に追加する
+        fmt_highlight_bg = {"backgroundColor": COLOR_HIGHLIGHT_BG_GS}
+        rule_index = 0
 
-    # --- 5. バッチアップデート実行 (チャンク化) ---
-    
-    # チャンクサイズ (一度に送信するリクエスト数)
-    CHUNK_SIZE = 100 
-    
-    # 最初に列幅・行高・ヘッダー書式を適用
-    if requests:
-        body = {'requests': requests}
-        try:
+        status_ref = None
+        if "ステータス" in df.columns:
+            status_ref = f"${column_letter(df.columns.get_loc('ステータス'))}2"
+        is_highlight_row = f'{status_ref}="要確認"' if status_ref else None
+
+        for col_num, col_name in enumerate(df.columns):
+            cell_ref = f"{column_letter(col_num)}2"
+            for condition, color in get_status_color_conditions(col_name, cell_ref):
+                fmt_text_color = {"textFormat": {"foregroundColor": color}}
+                if is_highlight_row:
+                    requests.append(get_conditional_format_request(
+                        sheet_id, start_row, end_row, col_num, col_num + 1,
+                        f"=AND({is_highlight_row},{condition})", {**fmt_highlight_bg, **fmt_text_color}, rule_index
+                    ))
+                    rule_index += 1
+                requests.append(get_conditional_format_request(
+                    sheet_id, start_row, end_row, col_num, col_num + 1,
+                    f"={condition}", fmt_text_color, rule_index
+                ))
+                rule_index += 1
+
+        if is_highlight_row:
+            requests.append(get_conditional_format_request(
+                sheet_id, start_row, end_row, 0, len(df.columns),
+                f"={is_highlight_row}", fmt_highlight_bg, rule_index
+            ))
+
+    return requests
+
+
+def get_conditional_format_count(sheets_service, spreadsheet_id, sheet_id, executor=None):
+    """シートに設定済みの条件付き書式ルールの数を取得する"""
+    request = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets(properties.sheetId,conditionalFormats)"
+    )
+    try:
+        sheet_info = executor.execute(request) if executor else request.execute()
+    except HttpError as e:
+        raise Exception(f"スプレッドシートの書式情報の取得に失敗しました: {e}")
+
+    for s in sheet_info.get('sheets', []):
+        if s.get('properties', {}).get('sheetId') == sheet_id:
+            return len(s.get('conditionalFormats', []))
+    return 0
+
+
+def format_worksheet_gspread(sheets_service, spreadsheet_id, sheet_id, df, portal_files, executor=None):
+    """
+    Sheets API v4のBatchUpdateを使用して書式設定を行う。
+    """
+    existing_rule_count = get_conditional_format_count(sheets_service, spreadsheet_id, sheet_id, executor)
+    requests = build_format_requests(sheet_id, df, portal_files, existing_rule_count)
+    if not requests:
+        return
+
+    try:
+        if executor:
+            executor.batch_update(sheets_service, spreadsheet_id, requests)
+        else:
             sheets_service.spreadsheets().batchUpdate(
                 spreadsheetId=spreadsheet_id,
-                body=body
+                body={'requests': requests}
             ).execute()
-        except HttpError as e:
-            raise Exception(f"スプレッドシートの基本書式設定に失敗しました: {e}")
-            
-    # 次に、セルごとの書式設定をチャンクに分けて送信
-    if cell_format_requests:
-        total_chunks = (len(cell_format_requests) + CHUNK_SIZE - 1) // CHUNK_SIZE
-        
-        for i in range(0, len(cell_format_requests), CHUNK_SIZE):
-            chunk = cell_format_requests[i:i + CHUNK_SIZE]
-            body = {'requests': chunk}
-            
+    except HttpError as e:
+        raise Exception(f"スプレッドシートの書式設定に失敗しました: {e}")
+    except Exception as e:
+        raise Exception(f"スプレッドシートの書式設定中に予期せぬエラー: {e}")
+
+
+# === Sheets API 実行器 ===
+
+# 再試行対象のHTTPステータス (レート制限・一時的なサーバーエラー)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class SheetsExportExecutor:
+    """
+    スプレッドシート保存用のSheets API実行器。
+    - 1分あたりのリクエスト数 (quota_per_minute) を超えないように送信を待機
+    - 429 / 5xx エラーは指数バックオフで再試行
+    - 互いに依存しない呼び出しはスレッドで並列実行 (HTTP接続は共有の接続プールから借りて使い回す)
+    - フェーズごとの所要時間 (秒) を timings に記録
+    """
+    MAX_PAYLOAD_BYTES = 2_000_000 # 1リクエストに詰めるデータ量の上限 (目安)
+    MAX_BACKOFF_SECONDS = 32
+
+    def __init__(self, http, quota_per_minute=60, max_workers=4, max_retries=5, base_delay=1.0):
+        self.http = http # google_clients.PooledHttp (スレッドセーフ)
+        self.quota_per_minute = quota_per_minute
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.timings = {}
+        self.retry_count = 0
+        self._sent_times = collections.deque()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """with ブロックの所要時間を timings[name] に記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(self.timings.get(name, 0) + time.perf_counter() - start, 2)
+
+    def _wait_for_quota(self):
+        """直近1分間の送信数が上限に達している場合は空きが出るまで待機する"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent_times and now - self._sent_times[0] >= 60:
+                    self._sent_times.popleft()
+                if len(self._sent_times) < self.quota_per_minute:
+                    self._sent_times.append(now)
+                    return
+                wait_seconds = 60 - (now - self._sent_times[0])
+            time.sleep(wait_seconds)
+
+    def call(self, func):
+        """func を実行する。429 / 5xx の場合はバックオフして再試行する"""
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_quota()
             try:
-                sheets_service.spreadsheets().batchUpdate(
-                    spreadsheetId=spreadsheet_id,
-                    body=body
-                ).execute()
-            except HttpError as e:
-                raise Exception(f"スプレッドシートの書式設定に失敗しました (Chunk {i//CHUNK_SIZE + 1}): {e}")
-            except Exception as e:
-                raise Exception(f"スプレッドシートの書式設定中に予期せぬエラー (Chunk {i//CHUNK_SIZE + 1}): {e}")
+                return func()
+            except (HttpError, gspread.exceptions.APIError) as e:
+                status = e.resp.status if isinstance(e, HttpError) else e.response.status_code
+                if status not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    raise
+                with self._lock:
+                    self.retry_count += 1
+                backoff = min(self.base_delay * (2 ** attempt), self.MAX_BACKOFF_SECONDS)
+                time.sleep(backoff + random.uniform(0, 1))
+
+    def execute(self, request):
+        """googleapiclient のリクエストを、共有の接続プールで実行する"""
+        return self.call(lambda: request.execute(http=self.http))
+
+    @classmethod
+    def _split(cls, items):
+        """items をペイロード上限内でできるだけ大きなまとまりに分割する"""
+        chunks, current, current_size = [], [], 0
+        for item in items:
+            item_size = len(json.dumps(item, ensure_ascii=False, default=str).encode('utf-8'))
+            if current and current_size + item_size > cls.MAX_PAYLOAD_BYTES:
+                chunks.append(current)
+                current, current_size = [], 0
+            current.append(item)
+            current_size += item_size
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def split_rows(self, rows):
+        return self._split(rows)
+
+    def batch_update(self, sheets_service, spreadsheet_id, requests):
+        """BatchUpdateリクエストをまとめて送信する (分割が必要な場合も順序は維持)"""
+        responses = []
+        for chunk in self._split(requests):
+            request = sheets_service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={'requests': chunk}
+            )
+            responses.append(self.execute(request))
+        return responses
+
+    def run_concurrently(self, funcs):
+        """互いに依存しない処理を並列実行し、結果を順番どおりに返す"""
+        if len(funcs) <= 1:
+            return [func() for func in funcs]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(func) for func in funcs]
+            return [future.result() for future in futures]
 
 
 def save_to_spreadsheet(df_excel, spreadsheet_id, sheet_name, creds_info, portal_files, image_bytes_data):
@@ -312,19 +504,22 @@ def save_to_spreadsheet(df_excel, spreadsheet_id, sheet_name, creds_info, portal
     既存のスプレッドシートIDに、指定したシート名で新しいシートを作成し、
     データを書き込む (サービスアカウント使用)
     [改修] GASで処理できるよう、URL文字列を=HYPERLINK()関数で書き込む
+    [改修] API呼び出しは SheetsExportExecutor 経由で行い、フェーズごとの所要時間(秒)を返す
     """
     
-    # サービスアカウントの「辞書」から各サービスをビルド
+    # サービスアカウントの「辞書」から共有の各サービスを取得 (初回のみ作成)
     user_drive_service, user_sheets_service_v4, gc = get_google_services(creds_info) 
     
     if not user_drive_service or not gc or not user_sheets_service_v4:
         raise Exception("Googleサービスへの接続に失敗しました。")
 
+    executor = SheetsExportExecutor(get_google_clients(creds_info).http)
+
     try:
-        with st.spinner(f"スプレッドシートを開き、「{sheet_name}」シートを準備中..."):
+        with st.spinner(f"スプレッドシートを開き、「{sheet_name}」シートを準備中..."), executor.phase("準備"):
             # 1. スプレッドシートを開く
             try:
-                sh = gc.open_by_key(spreadsheet_id)
+                sh = executor.call(lambda: gc.open_by_key(spreadsheet_id))
             except gspread.exceptions.SpreadsheetNotFound:
                 raise Exception("スプレッドシートが見つかりません。URLが正しいか、サービスアカウントに編集権限が付与されているか確認してください。")
             except Exception as e:
@@ -332,21 +527,42 @@ def save_to_spreadsheet(df_excel, spreadsheet_id, sheet_name, creds_info, portal
 
             # 2. ワークシート（タブ）の準備
             worksheet_title = sheet_name
+            row_count, col_count = len(df_excel) + 1, len(df_excel.columns) # 行数+1はヘッダー分
+            prepare_requests = []
+            existing_rule_count = 0
             
             try:
                 # 同名のシートが既に存在するか確認
-                worksheet = sh.worksheet(worksheet_title)
-                # 存在したらクリア
-                worksheet.clear() 
-                # サイズ変更 (行数+1はヘッダー分)
-                worksheet.resize(rows=len(df_excel) + 1, cols=len(df_excel.columns))
+                worksheet = executor.call(lambda: sh.worksheet(worksheet_title))
+                # 存在したらクリアとサイズ変更 (書式設定と同じBatchUpdateでまとめて送信する)
+                prepare_requests = [
+                    {"updateCells": {"range": {"sheetId": worksheet.id}, "fields": "userEnteredValue"}},
+                    {
+                        "updateSheetProperties": {
+                            "properties": {
+                                "sheetId": worksheet.id,
+                                "gridProperties": {"rowCount": row_count, "columnCount": col_count}
+                            },
+                            "fields": "gridProperties(rowCount,columnCount)"
+                        }
+                    },
+                ]
+                existing_rule_count = get_conditional_format_count(user_sheets_service_v4, spreadsheet_id, worksheet.id, executor)
             except gspread.exceptions.WorksheetNotFound:
                 # 存在しなければ作成
-                worksheet = sh.add_worksheet(title=worksheet_title, rows=len(df_excel) + 1, cols=len(df_excel.columns))
+                worksheet = executor.call(lambda: sh.add_worksheet(title=worksheet_title, rows=row_count, cols=col_count))
             except Exception as e:
                 raise Exception(f"シート「{worksheet_title}」の準備中にエラーが発生しました: {e}")
 
-        with st.spinner("スプレッドシートにデータを書き込み中..."):
+        with st.spinner("スプレッドシートの書式設定中..."), executor.phase("書式設定"):
+            # クリア・サイズ変更・書式設定 (df_excel (元の値) を渡して判定させる) を1回のBatchUpdateで送信
+            format_requests = build_format_requests(worksheet.id, df_excel, portal_files, existing_rule_count)
+            try:
+                executor.batch_update(user_sheets_service_v4, spreadsheet_id, prepare_requests + format_requests)
+            except HttpError as e:
+                raise Exception(f"スプレッドシートの書式設定に失敗しました: {e}")
+
+        with st.spinner("スプレッドシートにデータを書き込み中..."), executor.phase("データ書き込み"):
             # --- データ書き込み準備 ---
             df_excel_gspread = df_excel.fillna('').copy()
             
@@ -367,20 +583,141 @@ def save_to_spreadsheet(df_excel, spreadsheet_id, sheet_name, creds_info, portal
             headers = df_excel_gspread.columns.values.tolist()
             data_values = df_excel_gspread.values.tolist()
             values_to_update = [headers] + data_values
-            
-            worksheet.update(
-                values_to_update,
-                value_input_option='USER_ENTERED' # これで =HYPERLINK() が関数として解釈される
-            )
-        
-        with st.spinner("スプレッドシートの書式設定中..."):
-            # 書式設定 (df_excel (元の値) を渡して判定させる)
-            format_worksheet_gspread(user_sheets_service_v4, spreadsheet_id, worksheet.id, df_excel, portal_files)
+
+            # 行をペイロード上限内のまとまりに分割し、範囲が重ならないため並列で書き込む
+            sheet_title_escaped = worksheet_title.replace("'", "''")
+            write_requests = []
+            start_row = 1
+            for rows in executor.split_rows(values_to_update):
+                write_requests.append(user_sheets_service_v4.spreadsheets().values().update(
+                    spreadsheetId=spreadsheet_id,
+                    range=f"'{sheet_title_escaped}'!A{start_row}",
+                    valueInputOption='USER_ENTERED', # これで =HYPERLINK() が関数として解釈される
+                    body={'values': rows}
+                ))
+                start_row += len(rows)
+
+            try:
+                executor.run_concurrently([partial(executor.execute, request) for request in write_requests])
+            except HttpError as e:
+                raise Exception(f"スプレッドシートへのデータ書き込みに失敗しました: {e}")
 
         # 実行後のURLを生成 (シートIDを指定)
         # sheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit#gid={worksheet.id}"
         # st.toast(f"シート「{sheet_name}」に保存しました！", icon="✅")
         #st.success(f"スプレッドシートに保存しました: [開く]({sheet_url})", icon="📄")
 
+        return executor.timings
+
+    except Exception as e:
+        raise Exception(f"スプレッドシートへの書き込みまたは書式設定中にエラーが発生しました: {e}")
+
+
+# === ローカルファイル出力 (Excel / CSV / Parquet) ===
+# Sheets APIを使わずに、結果をファイルとしてダウンロードするための出力処理
+
+LOCAL_EXPORT_FORMATS = {
+    "Excel (.xlsx)": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV (.csv)": ("csv", "text/csv"),
+    "Parquet (.parquet)": ("parquet", "application/octet-stream"),
+}
+
+
+def build_xlsx_bytes(df_excel, sheet_name, portal_files):
+    """
+    openpyxl の write-only モードで、スプレッドシート出力と同じ色分けのExcelファイルを作成する。
+    行ごとにストリーム書き込みするため、行数が多くてもメモリ使用量はほぼ一定。
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, PatternFill, Side
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=re.sub(r'[\\/*?:\[\]]', '_', sheet_name)[:31]) # Excelのシート名制限
+
+    # --- 列幅・固定行・フィルター (行の書き込み前に設定する) ---
+    for i, width in enumerate(get_column_pixel_widths(portal_files)[:len(df_excel.columns)]):
+        ws.column_dimensions[get_column_letter(i + 1)].width = width / 7 # ピクセル → Excelの文字幅 (概算)
+    ws.freeze_panes = "A2"
+    ws.auto_filter.ref = f"A1:{get_column_letter(len(df_excel.columns))}{len(df_excel) + 1}"
+
+    # --- 書式定義 (同じ組み合わせは使い回す) ---
+    side = Side(style="thin", color=COLOR_GRAY_HEX.lstrip('#'))
+    border = Border(top=side, bottom=side, left=side, right=side)
+    alignment = Alignment(vertical="top", wrap_text=True)
+    highlight_fill = PatternFill("solid", fgColor=COLOR_HIGHLIGHT_BG_HEX.lstrip('#'))
+    font_cache = {}
+
+    def get_font(color, underline=False, bold=False):
+        key = (color, underline, bold)
+        if key not in font_cache:
+            font_cache[key] = Font(
+                name="Yu Gothic",
+                color=color.lstrip('#') if color else None,
+                underline="single" if underline else None,
+                bold=bold
+            )
+        return font_cache[key]
+
+    # --- ヘッダー行 ---
+    header_fill = PatternFill("solid", fgColor="E0E0E0")
+    header_cells = []
+    for col_name in df_excel.columns:
+        cell = WriteOnlyCell(ws, value=col_name)
+        cell.font = get_font(None, bold=True)
+        cell.fill = header_fill
+        cell.border = border
+        cell.alignment = Alignment(vertical="center", wrap_text=True)
+        header_cells.append(cell)
+    ws.append(header_cells)
+
+    # --- データ行 ---
+    columns = list(df_excel.columns)
+    for row_values in df_excel.fillna('').itertuples(index=False, name=None):
+        row = dict(zip(columns, row_values))
+        is_highlight_row = (row.get('ステータス', '') == '要確認')
+        cells = []
+        for col_name, value in row.items():
+            if '（画像）' in col_name:
+                url = value if isinstance(value, str) and value.startswith('http') else ""
+                cell = WriteOnlyCell(ws, value=f'=HYPERLINK("{url}")' if url else "")
+                cell.font = get_font(COLOR_BLUE_HEX, underline=True)
+            else:
+                cell = WriteOnlyCell(ws, value=value)
+                cell.font = get_font(resolve_text_color(col_name, value))
+            cell.border = border
+            cell.alignment = alignment
+            if is_highlight_row:
+                cell.fill = highlight_fill
+            cells.append(cell)
+        ws.append(cells)
+
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def build_local_export(df_excel, file_format, sheet_name, portal_files):
+    """
+    指定形式 (LOCAL_EXPORT_FORMATS のキー) でファイルを作成し、(データ, ファイル名, MIMEタイプ) を返す。
+    """
+    if file_format not in LOCAL_EXPORT_FORMATS:
+        raise Exception(f"未対応の出力形式です: {file_format}")
+    extension, mime = LOCAL_EXPORT_FORMATS[file_format]
+    file_name = f"{sheet_name}.{extension}"
+
+    try:
+        if extension == "xlsx":
+            data = build_xlsx_bytes(df_excel, sheet_name, portal_files)
+        elif extension == "csv":
+            # Excelで文字化けしないようBOM付きUTF-8で出力
+            data = df_excel.to_csv(index=False).encode("utf-8-sig")
+        else:
+            buffer = io.BytesIO()
+            df_excel.to_parquet(buffer, index=False)
+            data = buffer.getvalue()
     except Exception as e:
-        raise Exception(f"スプレッドシートへの書き込みまたは書式設定中にエラーが発生しました: {e}")
\ No newline at end of file
+        raise Exception(f"ファイルの作成中にエラーが発生しました: {e}")
+
+    return data, file_name, mime
@@ -0,0 +1,173 @@
+import json
+import os
+import queue
+import threading
+
+from google.oauth2 import service_account
+
+from check_cache import CACHE_DIR
+
+# === Google API クライアントの作成・共有 (google_clients.py) ===
+# googleapiclient の build() は呼び出しのたびにディスカバリー文書 (Drive v3 で約180KB) を読み込んで解析する。
+# 解析済みの文書をプロセス内で保持し、build_from_document で作成することで、サービスの作成を軽くする。
+# 文書はライブラリに同梱のものを使い、同梱されていない場合はダウンロードして cache/discovery/ に保存する。
+# googleapiclient・gspread は重いため、このモジュールを import した時点では読み込まない (初回の作成時に読み込む)。
+#
+# GoogleClientRegistry は、サービスアカウント1つ分の認証情報・Drive / Sheets サービス・gspread クライアントを
+# プロセス全体 (app.py・export.py・log.py、全セッション・全スレッド) で共有する。
+# - アクセストークンは1つの認証情報で取得・更新する (更新はロックで1スレッドずつ)。
+# - httplib2 はスレッドセーフではないため、リクエストごとに空いている接続を借りて返す (接続は使い回す)。
+
+SCOPES = [
+    'https://www.googleapis.com/auth/drive',
+    'https://www.googleapis.com/auth/spreadsheets'
+]
+
+DISCOVERY_CACHE_DIR = os.path.join(CACHE_DIR, "discovery")
+DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest"
+
+_documents = {} # (api, version) -> 解析済みのディスカバリー文書
+_documents_lock = threading.Lock()
+
+
+def _read_discovery_document(api, version):
+    """同梱の文書 → ローカルの保存分 → ダウンロード (保存する) の順に探す"""
+    from googleapiclient import discovery_cache
+
+    content = discovery_cache.get_static_doc(api, version)
+    if content:
+        return json.loads(content)
+
+    path = os.path.join(DISCOVERY_CACHE_DIR, f"{api}.{version}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+    import requests
+    response = requests.get(DISCOVERY_URL.format(api=api, version=version), timeout=30)
+    response.raise_for_status()
+    document = response.json()
+    os.makedirs(DISCOVERY_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(document, f)
+    os.replace(tmp_path, path)
+    return document
+
+
+def get_discovery_document(api, version):
+    """解析済みのディスカバリー文書 (プロセス内で1回だけ読み込む)"""
+    key = (api, version)
+    with _documents_lock:
+        if key not in _documents:
+            _documents[key] = _read_discovery_document(api, version)
+        return _documents[key]
+
+
+def build_service(api, version, credentials=None, http=None):
+    """build() と同じサービスを、キャッシュ済みのディスカバリー文書から作成する"""
+    from googleapiclient.discovery import build_from_document
+
+    return build_from_document(get_discovery_document(api, version), credentials=credentials, http=http)
+
+
+class SharedCredentials(service_account.Credentials):
+    """複数のスレッドから同時にトークンを更新しない service_account.Credentials"""
+
+    _refresh_lock = threading.Lock()
+
+    def refresh(self, request):
+        token = self.token
+        with self._refresh_lock:
+            if self.token != token and self.valid:
+                return # 待っている間に他のスレッドが更新済み
+            super().refresh(request)
+
+
+class PooledHttp:
+    """
+    認証済みの httplib2 接続を使い回す、スレッドセーフな HTTP (googleapiclient の http として渡す)。
+    リクエストのたびに空いている接続を借り、終わったら返す (空きがなければ新しく作成する)。
+    """
+
+    def __init__(self, credentials, max_idle=8, timeout=60):
+        self.credentials = credentials # googleapiclient がバッチ実行時などに参照する
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _new_connection(self):
+        import google_auth_httplib2
+        import httplib2
+
+        return google_auth_httplib2.AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=self.timeout))
+
+    def request(self, *args, **kwargs):
+        try:
+            http = self._idle.get_nowait()
+        except queue.Empty:
+            http = self._new_connection()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            if self._idle.qsize() < self.max_idle:
+                self._idle.put(http)
+            else:
+                http.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class GoogleClientRegistry:
+    """サービスアカウント1つ分の Google API クライアント (プロセス全体で共有・スレッドセーフ)"""
+
+    def __init__(self, creds_info, scopes=SCOPES):
+        self.creds_info = creds_info
+        self.credentials = SharedCredentials.from_service_account_info(creds_info, scopes=scopes)
+        self.http = PooledHttp(self.credentials)
+        self._services = {}
+        self._gspread_client = None
+        self._lock = threading.Lock()
+
+    def service(self, api, version):
+        """googleapiclient のサービス (共有の HTTP を使うため、複数スレッドから同時に使える)"""
+        with self._lock:
+            if (api, version) not in self._services:
+                self._services[(api, version)] = build_service(api, version, http=self.http)
+            return self._services[(api, version)]
+
+    def drive(self):
+        return self.service('drive', 'v3')
+
+    def sheets(self):
+        return self.service('sheets', 'v4')
+
+    def gspread(self):
+        """gspread のクライアント (requests のセッションで接続を使い回す)"""
+        with self._lock:
+            if self._gspread_client is None:
+                import gspread
+                self._gspread_client = gspread.authorize(self.credentials)
+            return self._gspread_client
+
+
+_registries = {} # (client_email, private_key_id) -> GoogleClientRegistry
+_registries_lock = threading.Lock()
+
+
+def get_google_clients(creds_info):
+    """サービスアカウント認証情報 (辞書) に対応する共有の GoogleClientRegistry を取得する"""
+    if creds_info is None:
+        raise Exception("Googleサービスの認証情報がありません。")
+    key = (creds_info.get("client_email"), creds_info.get("private_key_id"))
+    with _registries_lock:
+        if key not in _registries:
+            _registries[key] = GoogleClientRegistry(creds_info)
+        return _registries[key]
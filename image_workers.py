@@ -0,0 +1,139 @@
+import asyncio
+import base64
+import hashlib
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+# === 画像のCPU処理を別プロセスで実行 (image_workers.py) ===
+# 内容ハッシュ・リサイズ・Base64エンコード・縮小画像の作成は CPU を使い GIL を保持するため、
+# イベントループのスレッドやスレッドプールで行うと、その間は他のコルーチンが進まない。
+# ProcessPoolExecutor で実行し、画像データは共有メモリで受け渡す (プロセス間のパイプで大きなバイト列を送らない)。
+# ワーカープロセスは spawn で起動するため、このモジュールは Streamlit などの重いモジュールを import しない。
+
+IMAGE_PROCESS_WORKERS = os.cpu_count() or 1
+VISION_MAX_SIDE = 2048 # Vision API 側でもこの大きさに縮小されるため、超える画像は送信前に縮小する
+VISION_RESIZE_QUALITY = 90
+THUMBNAIL_MAX_SIZE = (400, 200) # results.THUMBNAIL_MAX_SIZE と同じ
+THUMBNAIL_QUALITY = 75
+
+
+class PreparedImage:
+    """前処理済みの画像1枚分"""
+    __slots__ = ("md5", "image_base64", "mime_type", "thumbnail")
+
+    def __init__(self, md5, image_base64, mime_type, thumbnail):
+        self.md5 = md5 # 元の画像データの内容ハッシュ (同一画像の判定用)
+        self.image_base64 = image_base64 # Vision API に送るBase64 (大きすぎる画像は縮小済み)
+        self.mime_type = mime_type
+        self.thumbnail = thumbnail # 表示用の縮小画像 (作成しない場合・作成できない場合は None)
+
+
+def _encode_jpeg(img, quality):
+    buffer = io.BytesIO()
+    img.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def prepare_image(data, mime_type, thumbnail=False):
+    """
+    画像データ (bytes / memoryview) から、内容ハッシュ・送信用のBase64・縮小画像を作成する。
+    戻り値: (md5, Base64のバイト列, mime_type, 縮小画像 or None)
+    """
+    from PIL import Image
+
+    md5 = hashlib.md5(data).hexdigest()
+    payload = data
+    thumbnail_bytes = None
+    try:
+        with Image.open(io.BytesIO(data)) as img: # ヘッダーのみ読み込み (デコードは必要になった時点)
+            if max(img.size) > VISION_MAX_SIDE:
+                resized = img.copy()
+                resized.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE))
+                payload, mime_type = _encode_jpeg(resized, VISION_RESIZE_QUALITY), "image/jpeg"
+            if thumbnail:
+                small = img.copy()
+                small.thumbnail(THUMBNAIL_MAX_SIZE)
+                thumbnail_bytes = _encode_jpeg(small, THUMBNAIL_QUALITY)
+    except Exception:
+        pass # 画像として読めない場合は元のデータをそのまま送る (OCR側でエラーになる)
+    return md5, base64.b64encode(payload), mime_type, thumbnail_bytes
+
+
+def _prepare_in_worker(shm_name, size, mime_type, thumbnail):
+    """ワーカープロセス側の処理。入力・出力 (Base64) とも共有メモリで受け渡す"""
+    source = shared_memory.SharedMemory(name=shm_name)
+    try:
+        md5, encoded, mime_type, thumbnail_bytes = prepare_image(source.buf[:size], mime_type, thumbnail)
+    finally:
+        source.close()
+    output = shared_memory.SharedMemory(create=True, size=max(len(encoded), 1))
+    output.buf[:len(encoded)] = encoded
+    output.close() # 削除 (unlink) は読み取った親プロセス側で行う
+    return output.name, len(encoded), md5, mime_type, thumbnail_bytes
+
+
+def _read_and_unlink(shm_name, size):
+    output = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return bytes(output.buf[:size]).decode("ascii")
+    finally:
+        output.close()
+        output.unlink()
+
+
+def _unlink_output(future):
+    """待っていた側が中止された前処理の完了時に、ワーカーが作成した出力の共有メモリを削除する"""
+    if future.cancelled() or future.exception() is not None:
+        return # ワーカーで実行されなかった・失敗した場合は出力を作成していない
+    try:
+        output = shared_memory.SharedMemory(name=future.result()[0])
+    except FileNotFoundError:
+        return
+    output.close()
+    output.unlink()
+
+
+class ImageProcessor:
+    """
+    画像の前処理をプロセスプールで実行する (プロセス全体で1つを共有する想定)。
+    プロセスプールや共有メモリが使えない環境では、スレッドプールでの実行に切り替える。
+    """
+
+    def __init__(self, max_workers=IMAGE_PROCESS_WORKERS):
+        self.max_workers = max_workers
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+        self._fallback = False
+
+    async def prepare(self, image_bytes, mime_type, thumbnail=False):
+        loop = asyncio.get_running_loop()
+        if not self._fallback:
+            try:
+                return await self._prepare_in_pool(loop, image_bytes, mime_type, thumbnail)
+            except (BrokenProcessPool, OSError) as e:
+                print(f"画像の前処理をプロセスプールで実行できないため、スレッドで実行します: {e}")
+                self._fallback = True
+        md5, encoded, mime_type, thumbnail_bytes = await loop.run_in_executor(None, prepare_image, image_bytes, mime_type, thumbnail)
+        return PreparedImage(md5, encoded.decode("ascii"), mime_type, thumbnail_bytes)
+
+    async def _prepare_in_pool(self, loop, image_bytes, mime_type, thumbnail):
+        source = shared_memory.SharedMemory(create=True, size=max(len(image_bytes), 1))
+        try:
+            source.buf[:len(image_bytes)] = image_bytes
+            future = self._pool.submit(_prepare_in_worker, source.name, len(image_bytes), mime_type, thumbnail)
+            try:
+                output_name, output_size, md5, mime_type, thumbnail_bytes = await asyncio.wrap_future(future, loop=loop)
+            except asyncio.CancelledError:
+                # 実行中のワーカーは止まらず出力の共有メモリを作成するため、完了した時点で削除する
+                future.add_done_callback(_unlink_output)
+                raise
+        finally:
+            source.close()
+            source.unlink()
+        return PreparedImage(md5, _read_and_unlink(output_name, output_size), mime_type, thumbnail_bytes)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -1,83 +1,302 @@
 import datetime
-import gspread
-from google.oauth2 import service_account
+import json
+import os
+import queue
+import random
+import threading
+import time
+import atexit
 import streamlit as st
 
-def log_ocr_execution(creds_info, spreadsheet_id, user_info, image_count, input_tokens, output_tokens):
+from usage import estimate_cost_jpy
+from google_clients import get_google_clients
+
+# --- ログの保存先 ---
+SHEET_NAME = 'logs'
+STAGE_SHEET_NAME = 'logs_stage' # ステージ・モデル別の使用量ログ
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+LOCAL_LOG_FILE = os.path.join(LOG_DIR, "ocr_usage.jsonl") # 追記専用のローカルログ (1行1レコードのJSON)
+LOCAL_STAGE_LOG_FILE = os.path.join(LOG_DIR, "ocr_usage_stage.jsonl")
+
+LOG_HEADER = [
+    "日時",
+    "利用者",
+    "画像枚数",
+    "入力トークン",
+    "出力トークン",
+    "合計トークン",
+    "概算コスト(円)"
+]
+
+STAGE_LOG_HEADER = [
+    "日時",
+    "実行ID",
+    "利用者",
+    "事業者コード",
+    "ステージ",
+    "モデル",
+    "呼び出し回数",
+    "入力トークン",
+    "出力トークン",
+    "平均レイテンシ(秒)",
+    "概算コスト(円)",
+    "レコード数" # 実行で完了したレコード数 (見積もりで1レコードあたりの使用量を求めるのに使う)
+]
+
+# シート名 -> (ヘッダー, ローカルログファイル)
+LOG_SHEETS = {
+    SHEET_NAME: (LOG_HEADER, LOCAL_LOG_FILE),
+    STAGE_SHEET_NAME: (STAGE_LOG_HEADER, LOCAL_STAGE_LOG_FILE),
+}
+
+
+class UsageLogBuffer:
     """
-    OCR実行ログをスプレッドシートの「logs」シートに記録する関数
-    入力/出力トークンを分けて記録し、概算コストも計算する
-    ※日時は日本時間(JST)で記録する
+    OCR実行ログのバッファ。
+    append() はローカルの追記専用ファイルへの書き込みのみを同期的に行い、
+    スプレッドシートへの書き込みはバックグラウンドスレッドがまとめて行う。
+    送信に失敗した行は保持しておき、次回の送信時に再試行する。
     """
-    try:
-        # --- 認証とスプレッドシートへの接続 ---
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        creds = service_account.Credentials.from_service_account_info(
-            creds_info, scopes=scopes
-        )
-        gc = gspread.authorize(creds)
-
-        # スプレッドシートを開く
+
+    def __init__(self, creds_info, spreadsheet_id, sheet_name=SHEET_NAME,
+                 flush_interval=30, max_batch=100, max_retries=5):
+        self.creds_info = creds_info
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.header, self.local_file = LOG_SHEETS[sheet_name]
+        self.flush_interval = flush_interval # 秒
+        self.max_batch = max_batch
+        self.max_retries = max_retries
+
+        self._queue = queue.Queue()
+        self._pending = [] # 送信待ち (失敗して持ち越した行を含む)
+        self._file_lock = threading.Lock()
+        self._flush_lock = threading.Lock() # _pending の変更はすべてこのロックの下で行う (送信・再試行の待ちの間は保持しない)
+        self._send_lock = threading.Lock() # 送信は1スレッドずつ (送信した行を _pending の先頭から削除するのは送信中のスレッドのみ)
+        self._worksheet = None
+
+        self._thread = threading.Thread(target=self._run, name="usage-log-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self._flush_on_exit)
+
+    def append(self, record):
+        """ログ1件 (ヘッダーの列名をキーとする辞書) を記録する"""
         try:
-            sh = gc.open_by_key(spreadsheet_id)
-        except Exception as e:
-            print(f"ログ記録エラー: スプレッドシートが見つかりません。 {e}")
-            return
+            os.makedirs(LOG_DIR, exist_ok=True)
+            with self._file_lock, open(self.local_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"ローカルログの書き込みに失敗しました: {e}")
+        self._queue.put([record.get(col, "") for col in self.header])
+
+    # --- バックグラウンド送信 ---
+
+    def _run(self):
+        while True:
+            try:
+                # 最初の1件を待ち、その後 flush_interval の間に溜まった分をまとめて送信。
+                # 送信できずに持ち越した行がある場合は、新しい行が来なくても flush_interval ごとに再送する
+                with self._flush_lock:
+                    has_pending = bool(self._pending)
+                try:
+                    row = self._queue.get(timeout=self.flush_interval if has_pending else None)
+                except queue.Empty:
+                    row = None
+                if row is not None:
+                    with self._flush_lock:
+                        self._pending.append(row)
+                    time.sleep(self.flush_interval)
+                self._drain_queue()
+                self._flush()
+            except Exception as e:
+                print(f"ログ送信スレッドでエラーが発生しました: {e}")
+
+    def _drain_queue(self):
+        with self._flush_lock:
+            while True:
+                try:
+                    self._pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    return
+
+    def _get_worksheet(self):
+        """ワークシートを取得 (初回のみ認証・シート作成・ヘッダー確認を行う)"""
+        if self._worksheet is not None:
+            return self._worksheet
+
+        # gspread は重いため、初回の送信時に読み込む (アプリの起動を遅らせない)
+        import gspread
+
+        # 認証・クライアントは export.py・app.py と共有する (ログのたびに作り直さない)
+        gc = get_google_clients(self.creds_info).gspread()
+        sh = gc.open_by_key(self.spreadsheet_id)
 
         # 「logs」シートの取得、なければ作成
-        SHEET_NAME = 'logs'
         try:
-            worksheet = sh.worksheet(SHEET_NAME)
+            worksheet = sh.worksheet(self.sheet_name)
         except gspread.exceptions.WorksheetNotFound:
-            worksheet = sh.add_worksheet(title=SHEET_NAME, rows=100, cols=8)
-
-        # --- ヘッダーの確認と追加 ---
-        if not worksheet.get_all_values():
-            # ヘッダーを拡張
-            worksheet.append_row([
-                "日時", 
-                "利用者", 
-                "画像枚数", 
-                "入力トークン", 
-                "出力トークン", 
-                "合計トークン", 
-                "概算コスト(円)"
-            ])
-            
+            worksheet = sh.add_worksheet(title=self.sheet_name, rows=100, cols=len(self.header))
+
+        # --- ヘッダーの確認と追加 (1行目のみ取得。末尾に列を追加した場合は書き足す) ---
+        header_row = worksheet.row_values(1)
+        if header_row != self.header and self.header[:len(header_row)] == header_row:
+            worksheet.update([self.header], "A1")
+
+        self._worksheet = worksheet
+        return worksheet
+
+    def _flush(self, max_retries=None, blocking=True):
+        """
+        送信待ちの行をまとめて追記する。失敗した場合はバックオフして再試行する。
+        blocking=False の場合、他のスレッドが送信中 (再試行の待ちを含む) なら何もしない。
+        """
+        import gspread
+
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if not self._send_lock.acquire(blocking=blocking):
+            return
+        try:
+            while True:
+                with self._flush_lock:
+                    batch = self._pending[:self.max_batch]
+                if not batch:
+                    return
+                for attempt in range(max_retries + 1):
+                    try:
+                        # 行の挿入ではなく末尾への追記 (既存行の移動が発生しない)
+                        self._get_worksheet().append_rows(batch, value_input_option='USER_ENTERED')
+                        break
+                    except gspread.exceptions.SpreadsheetNotFound as e:
+                        print(f"ログ記録エラー: スプレッドシートが見つかりません。 {e}")
+                        return
+                    except Exception as e:
+                        # シートの削除・名前の変更などに備え、次の試行ではワークシートを取得し直す
+                        self._worksheet = None
+                        if attempt >= max_retries:
+                            # 送信できなかった行は残しておき、次回の送信時に再試行する
+                            print(f"ログ記録中にエラーが発生しました (次回再送): {e}")
+                            return
+                        time.sleep(min(2 ** attempt, 32) + random.uniform(0, 1))
+                with self._flush_lock:
+                    del self._pending[:len(batch)]
+        finally:
+            self._send_lock.release()
+
+    def _flush_on_exit(self):
+        """
+        プロセス終了時に、送信待ちの行を1回だけ送信を試みる。
+        バックグラウンドの送信が再試行を待っている場合は待たずに終了する (行はローカルログに残っている)。
+        """
+        self._drain_queue()
+        self._flush(max_retries=0, blocking=False)
+
+
+@st.cache_resource
+def get_usage_log_buffer(_creds_info, spreadsheet_id, sheet_name=SHEET_NAME):
+    """プロセス全体で共有するログバッファを取得 (シートごとに1つ)"""
+    return UsageLogBuffer(_creds_info, spreadsheet_id, sheet_name)
+
+
+_local_log_cache = {} # ローカルログのパス -> [ファイルのinode, 読み込んだバイト数, レコードのリスト]
+_local_log_cache_lock = threading.Lock()
+
+
+def read_local_log(sheet_name=SHEET_NAME):
+    """
+    ローカルの追記専用ログを読み込み、レコード (辞書) のリストを返す。
+    前回読み込んだ位置より後ろ (追記された行) だけを読み込む。画面の再実行のたびにファイル全体を読み直さない。
+    レコードの辞書は呼び出し間で共有するため、呼び出し側で変更しないこと。
+    """
+    _, local_file = LOG_SHEETS[sheet_name]
+    with _local_log_cache_lock:
+        try:
+            stat = os.stat(local_file)
+        except FileNotFoundError:
+            _local_log_cache.pop(local_file, None)
+            return []
+        cached = _local_log_cache.get(local_file)
+        if cached is None or cached[0] != stat.st_ino or cached[1] > stat.st_size:
+            cached = _local_log_cache[local_file] = [stat.st_ino, 0, []] # 新しいファイル (作り直された場合を含む)
+        if cached[1] < stat.st_size:
+            with open(local_file, "rb") as f:
+                f.seek(cached[1])
+                data = f.read()
+            complete = data[:data.rfind(b"\n") + 1] # 書き込み途中の最終行は次回に読む
+            for line in complete.decode("utf-8", errors="replace").splitlines():
+                try:
+                    cached[2].append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue # 壊れた行などは無視
+            cached[1] += len(complete)
+        return list(cached[2])
+
+
+def _now_jst_str():
+    # 日本時間 (JST: UTC+9) を生成
+    t_delta = datetime.timedelta(hours=9)
+    JST = datetime.timezone(t_delta, 'JST')
+    return datetime.datetime.now(JST).strftime('%Y/%m/%d %H:%M:%S')
+
+
+def log_ocr_execution(creds_info, spreadsheet_id, user_info, image_count, input_tokens, output_tokens, cost_jpy=None):
+    """
+    OCR実行ログをスプレッドシートの「logs」シートに記録する関数
+    入力/出力トークンを分けて記録し、概算コストも計算する
+    ※日時は日本時間(JST)で記録する
+    ※ローカルファイルに即時記録し、スプレッドシートへはバックグラウンドでまとめて送信する
+    ※cost_jpy を省略した場合は GPT-4o の料金で概算する
+    """
+    try:
         # --- 記録するデータの準備 ---
-        
-        # 日本時間 (JST: UTC+9) を生成
-        t_delta = datetime.timedelta(hours=9)
-        JST = datetime.timezone(t_delta, 'JST')
-        now = datetime.datetime.now(JST)
-        now_str = now.strftime('%Y/%m/%d %H:%M:%S')
-        
+        now_str = _now_jst_str()
+
         user_display = str(user_info)
         total_tokens = input_tokens + output_tokens
 
-        # --- 概算コスト計算 (1ドル=150円換算) ---
-        # Input: $2.50 / 1M tokens -> 375円
-        # Output: $10.00 / 1M tokens -> 1500円
-        cost_input = (input_tokens / 1_000_000) * 2.50 * 150
-        cost_output = (output_tokens / 1_000_000) * 10.00 * 150
-        total_cost = round(cost_input + cost_output, 2) # 小数点第2位まで
+        # --- 概算コスト計算 (モデル別の料金表は usage.py) ---
+        if cost_jpy is None:
+            cost_jpy = estimate_cost_jpy("gpt-4o", input_tokens, output_tokens)
+        total_cost = round(cost_jpy, 2) # 小数点第2位まで
 
         # 行データ
-        row_data = [
-            now_str,        # A: 日時 (JST)
-            user_display,   # B: 利用者
-            image_count,    # C: 画像枚数
-            input_tokens,   # D: 入力
-            output_tokens,  # E: 出力
-            total_tokens,   # F: 合計
-            total_cost      # G: 概算コスト
-        ]
-
-        # --- 挿入実行 (2行目) ---
-        worksheet.insert_row(row_data, index=2)
-        
+        record = {
+            "日時": now_str,               # A: 日時 (JST)
+            "利用者": user_display,        # B: 利用者
+            "画像枚数": image_count,       # C: 画像枚数
+            "入力トークン": input_tokens,   # D: 入力
+            "出力トークン": output_tokens,  # E: 出力
+            "合計トークン": total_tokens,   # F: 合計
+            "概算コスト(円)": total_cost,   # G: 概算コスト
+        }
+
+        get_usage_log_buffer(creds_info, spreadsheet_id).append(record)
+
+    except Exception as e:
+        print(f"ログ記録中にエラーが発生しました: {e}")
+
+
+def log_usage_breakdown(creds_info, spreadsheet_id, run_id, user_info, business_code, ledger, record_count=None):
+    """
+    実行1回分のステージ・モデル別の使用量 (UsageLedger の集計) を「logs_stage」シートに記録する
+    record_count は実行で完了したレコード数
+    """
+    try:
+        now_str = _now_jst_str()
+        buffer = get_usage_log_buffer(creds_info, spreadsheet_id, STAGE_SHEET_NAME)
+        for row in ledger.rollup().to_dict("records"):
+            buffer.append({
+                "日時": now_str,
+                "実行ID": run_id,
+                "利用者": str(user_info),
+                "事業者コード": business_code,
+                "ステージ": row["ステージ"],
+                "モデル": row["モデル"],
+                "呼び出し回数": int(row["呼び出し回数"]),
+                "入力トークン": int(row["入力トークン"]),
+                "出力トークン": int(row["出力トークン"]),
+                "平均レイテンシ(秒)": float(row["平均レイテンシ(秒)"]),
+                "概算コスト(円)": float(row["概算コスト(円)"]),
+                "レコード数": record_count if record_count is not None else "",
+            })
     except Exception as e:
-        print(f"ログ記録中にエラーが発生しました: {e}")
\ No newline at end of file
+        print(f"ステージ別ログ記録中にエラーが発生しました: {e}")
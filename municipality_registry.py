@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+
+from check_cache import CACHE_DIR
+
+# === 自治体リストの共有 (municipality_registry.py) ===
+# スプレッドシート (自治体DB) の「自治体名 -> 自治体コード」の表を、全セッションで1つだけ保持する。
+# - 起動直後はディスクのスナップショットを使い、シートの読み込みを待たずに表示する。
+# - 有効期限を過ぎても古い表をそのまま返し、裏で読み込み直す (stale-while-revalidate)。
+# - 読み込みに成功するたびにスナップショットを保存する。
+# - invalidate() はこの表だけを読み込み直す (st.cache_data.clear() のように他のキャッシュを消さない)。
+
+MUNICIPALITY_SNAPSHOT_FILE = os.path.join(CACHE_DIR, "municipality_map.json")
+MUNICIPALITY_TTL_SECONDS = 3600
+MUNICIPALITY_RETRY_SECONDS = 60 # 読み込みに失敗した後、次に自動で読み込み直すまでの間隔
+
+
+class MunicipalityRegistry:
+    """
+    loader は {自治体名: コード} を返す関数 (失敗時は例外)。バックグラウンドのスレッドからも呼ばれるため、
+    Streamlit の関数は呼ばず、スレッドごとに必要なクライアントを作成すること。
+    """
+
+    def __init__(self, loader, snapshot_path=MUNICIPALITY_SNAPSHOT_FILE, ttl=MUNICIPALITY_TTL_SECONDS):
+        self.loader = loader
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self.loaded_at = None # 表を読み込んだ (スナップショットの場合は保存元を読み込んだ) UNIX時刻
+        self.source = None # "sheet" / "snapshot"
+        self.last_error = None # 直近の読み込みエラー (成功したら None)
+        self._map = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Condition(self._lock) # 読み込みの完了を待つ (表がない状態で同時に呼ばれた場合)
+        self._refreshing = False
+        self._next_attempt = 0.0 # 失敗後はこの時刻まで自動の再読み込みを行わない
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self._map = dict(snapshot["map"])
+            self.loaded_at = float(snapshot["loaded_at"])
+            self.source = "snapshot"
+        except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            pass
+
+    def _save_snapshot(self, municipality_map, loaded_at):
+        os.makedirs(os.path.dirname(self.snapshot_path), exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"loaded_at": loaded_at, "map": municipality_map}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    @property
+    def ready(self):
+        """シートの読み込みを待たずに表を返せるか"""
+        return self._map is not None
+
+    def is_stale(self):
+        return self.loaded_at is None or time.time() - self.loaded_at > self.ttl
+
+    def get(self):
+        """
+        表を返す。表がまだない場合 (初回かつスナップショットなし) だけは読み込みを待つ
+        (他のセッションが読み込み中ならその完了を待つ。失敗後の再試行の間隔内は待たずに空の表を返す)。
+        古い場合はそのまま返し、裏で読み込み直す。
+        """
+        if self._map is None:
+            if time.time() >= self._next_attempt:
+                self.refresh()
+            return dict(self._map or {})
+        if self.is_stale() and time.time() >= self._next_attempt:
+            self.refresh_in_background()
+        return dict(self._map)
+
+    def refresh(self):
+        """シートから読み込み直す (同期)。他のスレッドが読み込み中の場合は、その完了を待つ"""
+        with self._lock:
+            if self._refreshing:
+                self._loaded.wait_for(lambda: not self._refreshing)
+                return
+            self._refreshing = True
+        self._load()
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._load, name="municipality-refresh", daemon=True).start()
+
+    def _load(self):
+        """読み込みの本体 (_refreshing を立てた呼び出し元のみ)。失敗した場合は以前の表を残し、last_error に記録する"""
+        try:
+            municipality_map = dict(sorted(self.loader().items())) # 名前順
+            loaded_at = time.time()
+            self._map, self.loaded_at, self.source, self.last_error = municipality_map, loaded_at, "sheet", None
+            try:
+                self._save_snapshot(municipality_map, loaded_at)
+            except OSError as e:
+                print(f"自治体リストのスナップショットを保存できませんでした: {e}")
+        except Exception as e:
+            self.last_error = e
+            self._next_attempt = time.time() + MUNICIPALITY_RETRY_SECONDS
+            print(f"自治体リストの読み込み中にエラーが発生しました: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+                self._loaded.notify_all()
+
+    def invalidate(self):
+        """この表だけを期限切れにし、裏で読み込み直す"""
+        self.loaded_at = None
+        self._next_attempt = 0.0
+        self.refresh_in_background()
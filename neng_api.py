@@ -1,14 +1,23 @@
-import aiohttp
 import asyncio
+import os
+from typing import TYPE_CHECKING
 import streamlit as st
 
-async def get_neng_content(product_code: str, municipality_code: str) -> str:
+if TYPE_CHECKING:
+    import aiohttp
+
+# NENG APIの接続先 (環境変数 NENG_BASE_URL で差し替え可能。ベンチマーク用のスタブなど)
+NENG_BASE_URL = os.environ.get("NENG_BASE_URL", "https://n2.steamship.co.jp")
+
+async def get_neng_content(product_code: str, municipality_code: str, base_url: str = None, auth: "aiohttp.BasicAuth" = None) -> str:
     """
     品番と自治体コードを基にNENG APIから「内容量・規格等」を非同期で取得する。
 
     Args:
         product_code (str): 返礼品の品番 (SKU)。
         municipality_code (str): 自治体コード。
+        base_url (str): 接続先。省略時は NENG_BASE_URL。
+        auth (aiohttp.BasicAuth): 認証情報。省略時は secrets.toml の値を使用する。
 
     Returns:
         str: 取得した「内容量・規格等」のテキスト。エラーや該当なしの場合は空文字を返す。
@@ -16,17 +25,20 @@ async def get_neng_content(product_code: str, municipality_code: str) -> str:
     if not product_code or not municipality_code:
         return ""
 
+    import aiohttp # 重いため、初回の取得時に読み込む (アプリの起動を遅らせない)
+
     sku = product_code.upper()
 
-    try:
-        user = st.secrets["NENG"]["NENG_USER"]
-        password = st.secrets["NENG"]["NENG_PASSWORD"]
-    except KeyError as e:
-        st.error(f"NENG APIの認証情報がsecrets.tomlに設定されていません: {e}")
-        return "NENG認証情報エラー"
-    
-    url = f"https://n2.steamship.co.jp/{municipality_code}/wp-admin/admin-ajax.php?action=n2_items_api&mode=json&code={sku}"
-    auth = aiohttp.BasicAuth(login=user, password=password)
+    if auth is None:
+        try:
+            user = st.secrets["NENG"]["NENG_USER"]
+            password = st.secrets["NENG"]["NENG_PASSWORD"]
+        except KeyError as e:
+            st.error(f"NENG APIの認証情報がsecrets.tomlに設定されていません: {e}")
+            return "NENG認証情報エラー"
+        auth = aiohttp.BasicAuth(login=user, password=password)
+
+    url = f"{base_url or NENG_BASE_URL}/{municipality_code}/wp-admin/admin-ajax.php?action=n2_items_api&mode=json&code={sku}"
 
     try:
         async with aiohttp.ClientSession() as session:
@@ -0,0 +1,112 @@
+import asyncio
+import collections
+import threading
+import time
+
+from results import OcrResultStore
+from staged_pipeline import CancelToken
+
+# === OCR実行ジョブ (ocr_job.py) ===
+# OCR処理を Streamlit のスクリプトとは別のスレッドで実行し、ジョブはセッションに保持する。
+# - 実行中に画面が操作されて Streamlit がスクリプトを再実行しても処理は続き、再実行後の画面が進捗の表示を引き継ぐ。
+# - 処理を中止するのは cancel() (中止ボタンの on_click) だけ。
+# - 進捗を表示している画面から一定時間確認がない場合 (タブを閉じたなど) は、放置されたものとして中止する。
+# ジョブのスレッドからは Streamlit の関数を呼ばない。進捗・完了したレコード・メッセージを記録し、
+# 画面の更新はスクリプト側がそれを読み取って行う。
+
+JOB_ORPHAN_SECONDS = 30 # 画面からの確認がこの秒数途切れたら中止する
+JOB_WATCH_INTERVAL = 1.0 # 秒 (放置の確認間隔)
+LIVE_NEED_CHECK_ROWS = 200 # 途中結果に表示する「要確認」レコードの上限 (新しいものから)
+
+
+class OcrJob:
+    """1回のOCR実行 (スレッド・中止要求・進捗・完了したレコード)"""
+
+    def __init__(self, portal_names, total_records, tracer, usage_ledger, orphan_seconds=JOB_ORPHAN_SECONDS):
+        self.portal_names = portal_names
+        self.total_records = total_records
+        self.tracer = tracer
+        self.usage_ledger = usage_ledger
+        self.orphan_seconds = orphan_seconds
+        self.cancel_token = CancelToken()
+        self.progress_value = 0.0
+        self.progress_text = "準備中..."
+        self.lock = threading.Lock() # 結果ストアへの追加・実行中の読み取りはこのロックの下で行う
+        self._store = OcrResultStore(portal_names) # 完了したレコード (ジョブのスレッドが追加のみ行う)
+        self._need_check_count = 0 # 完了したレコードのうち「要確認」の件数 (追加のたびに数える)
+        self._recent_need_check = collections.deque(maxlen=LIVE_NEED_CHECK_ROWS) # 途中結果に表示する「要確認」のレコード
+        self.messages = [] # 画面に表示するメッセージ ("error" / "toast", 本文)
+        self.exception = None # 処理全体が失敗した場合の例外
+        self._done = threading.Event()
+        self._heartbeat = time.monotonic()
+
+    # --- ジョブのスレッドから呼ぶ ---
+
+    def progress(self, value, text=None):
+        """進捗を記録する (main_async_runner に progress_bar として渡す)"""
+        self.progress_value = value
+        if text is not None:
+            self.progress_text = text
+
+    def add_record(self, record):
+        with self.lock:
+            self._store.append(record)
+            if record.status == "要確認":
+                self._need_check_count += 1
+                self._recent_need_check.append(record)
+
+    def notify(self, kind, message):
+        self.messages.append((kind, message))
+
+    async def watch_orphan(self):
+        """画面から orphan_seconds 以上確認がなければ中止する (ジョブのイベントループで実行する)"""
+        while not self.cancel_token.cancelled:
+            if time.monotonic() - self._heartbeat > self.orphan_seconds:
+                self.cancel("画面が閉じられたため")
+                return
+            await asyncio.sleep(JOB_WATCH_INTERVAL)
+
+    # --- スクリプト (画面) 側から呼ぶ ---
+
+    def start(self, target):
+        """target() を別スレッドで実行する。target の例外は exception に記録する"""
+        def run():
+            try:
+                target()
+            except Exception as e:
+                self.exception = e
+            finally:
+                self._done.set()
+
+        threading.Thread(target=run, name="ocr-job", daemon=True).start()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_token.cancelled
+
+    def wait(self, timeout):
+        """完了するか timeout 秒たつまで待ち、完了したかを返す。画面が表示中であることも記録する"""
+        self._heartbeat = time.monotonic()
+        return self._done.wait(timeout)
+
+    def cancel(self, reason="中止"):
+        self.cancel_token.cancel(reason)
+
+    @property
+    def completed(self):
+        """完了したレコード数"""
+        with self.lock:
+            return len(self._store)
+
+    def live_summary(self):
+        """途中結果の表示用: (完了件数, 要確認の件数, 新しい順の「要確認」レコード (最大 LIVE_NEED_CHECK_ROWS 件))"""
+        with self.lock:
+            return len(self._store), self._need_check_count, list(reversed(self._recent_need_check))
+
+    def result_store(self):
+        """完了したレコードの結果ストア。実行中に読み取る場合は lock を取得すること"""
+        return self._store
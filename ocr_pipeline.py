@@ -0,0 +1,1323 @@
+import asyncio
+import base64
+import hashlib
+import json
+import re
+import time
+from functools import partial
+from googleapiclient.errors import HttpError
+
+from check_cache import make_cache_key
+from google_clients import get_google_clients
+from neng_api import get_neng_content
+from results import make_record, make_thumbnails
+from routing import CONFIDENCE_INSTRUCTION, BATCH_CONFIDENCE_INSTRUCTION, escalation_reason
+from schemas import (
+    VisionResult, VisionBatchResult, TypoResult, TypoBatchResult, ConfidentTypoBatchResult,
+    TextCompareResult, VolumeCompareResult, STAGE_RESPONSE_MODELS, response_format, parse_structured
+)
+from tracing import NOOP_TRACER
+from staged_pipeline import StagedPipeline
+
+# === OCRパイプライン (ocr_pipeline.py) ===
+# Drive画像の取得 → Vision APIによるOCR → 誤字脱字・テキスト比較・内容量比較 の一連の非同期処理。
+# Streamlit に依存しないため、アプリ本体 (app.py) とベンチマーク (bench/) の両方から利用する。
+
+MAX_CONCURRENT_RECORDS = 25 # 同時に処理するレコード数の上限
+RECORD_WINDOW = 100 # 分割実行で同時に作成しておくレコードのタスク数 (残りは完了に合わせて順次作成)
+
+# ステージ分割で実行する場合のステージごとのワーカー数 (staged_async_runner)
+# download: Drive取得 (スレッドプール) / preprocess: 同一画像の判定 (ハッシュ計算)・Base64・縮小画像 / vision: 画像OCR / checks: 二次チェック
+DEFAULT_STAGE_WORKERS = {"download": 16, "preprocess": 4, "vision": 25, "checks": 25}
+STAGE_QUEUE_SIZE = 32 # ステージ間のキューの上限 (後段が詰まると前段が待つ)
+
+
+# --- ファイル名からのコード抽出 ---
+def get_product_code_from_filename(filename):
+    # 拡張子を除去
+    name_without_ext = filename.rsplit('.', 1)[0]
+    # 最初のハイフンまでを取得（ハイフンがない場合は全体）
+    return name_without_ext.split('-')[0]
+
+def get_business_code_from_product_code(product_code):
+    if not product_code: return None
+    # 正規表現パターン (大文字小文字を区別しない)
+    # 1. 数字2桁 + 英字4桁 (例: 01ABCD)
+    # 2. 英字4桁 (例: ABCD)
+    # 3. 英字3桁 (例: ABC)
+    patterns = [r'^[0-9]{2}[a-zA-Z]{4}', r'^[a-zA-Z]{4}', r'^[a-zA-Z]{3}']
+    for p in patterns:
+        match = re.match(p, product_code) # re.IGNORECASE は不要かも
+        if match:
+            return match.group(0).upper() # マッチした部分を大文字で返す
+    return None # どのパターンにもマッチしない場合
+
+
+def build_image_groups(portal_files, selected_business_code, selected_product_code):
+    """
+    画像ファイル名ごとにポータル情報をグループ化し、NENG APIで取得する品番の一覧と共に返す。
+    戻り値: ({画像名: {'portals': {ポータル名: {'id', 'mimeType', 'md5Checksum', 'size', 'imageMediaMetadata'}}}}, 品番のセット)
+    size・imageMediaMetadata は一覧取得時に取得していれば入る (実行前の見積もり用。estimate.py)
+    """
+    image_groups = {}
+    # NENG APIで取得するユニークな品番を収集するセット
+    unique_product_codes_to_fetch = set()
+
+    for portal_name, files in portal_files.items():
+        for file in files:
+            full_product_code = get_product_code_from_filename(file['name'])
+            business_code = get_business_code_from_product_code(full_product_code)
+            # 選択された条件に合う画像のみを対象とする
+            if business_code == selected_business_code and \
+               (selected_product_code == "すべて" or full_product_code == selected_product_code):
+
+                if file['name'] not in image_groups:
+                    image_groups[file['name']] = {'portals': {}}
+                image_groups[file['name']]['portals'][portal_name] = {
+                    'id': file['id'], 'mimeType': file['mimeType'], 'md5Checksum': file.get('md5Checksum'),
+                    'size': file.get('size'), 'imageMediaMetadata': file.get('imageMediaMetadata')
+                }
+
+                if selected_product_code == "すべて":
+                    unique_product_codes_to_fetch.add(full_product_code)
+                else:
+                    unique_product_codes_to_fetch.add(selected_product_code)
+
+    return image_groups, unique_product_codes_to_fetch
+
+
+async def fetch_neng_content_map(product_codes, municipality_code, **neng_options):
+    """NENG APIを品番ごとに並列で呼び出し、{品番: 内容量} の辞書を返す"""
+    product_codes = list(product_codes)
+    neng_results = await asyncio.gather(
+        *[get_neng_content(prod_code, municipality_code, **neng_options) for prod_code in product_codes]
+    )
+    return dict(zip(product_codes, neng_results))
+
+
+# --- 非同期処理の定義 (OpenAI API関連) ---
+def record_usage(ledger, stage, model, response, started_at):
+    """API呼び出し1回分のトークン数とレイテンシを台帳に記録する"""
+    if ledger is not None:
+        ledger.record(stage, model, response.usage.prompt_tokens, response.usage.completion_tokens, time.perf_counter() - started_at)
+
+async def call_openai_vision_api_async(client, prompt, image_base64, mime_type, model="gpt-4o", max_tokens=1000, ledger=None, stage="vision"):
+    try:
+        messages = [{"role": "user", "content": [{"type": "text", "text": prompt}, {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}}]}]
+        started_at = time.perf_counter()
+        # Structured Outputs (VisionResult のスキーマ) を指定
+        response = await client.chat.completions.create(
+            model=model, 
+            messages=messages, 
+            temperature=0.0, 
+            max_tokens=max_tokens,
+            response_format=response_format(VisionResult)
+        )
+        record_usage(ledger, stage, model, response, started_at)
+        # コンテンツと、入力/出力トークンを返す
+        return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
+    except Exception as e: 
+        return f'{{"error": "OpenAI APIエラー: {e}"}}', 0, 0
+
+async def call_openai_vision_batch_api_async(client, prompt, labeled_images, model="gpt-4o", max_tokens=4000, ledger=None, stage="vision"):
+    """複数画像を1回のリクエストで送る。labeled_images は [(ラベル, base64, mime_type)]"""
+    try:
+        content = [{"type": "text", "text": prompt}]
+        for label, image_base64, mime_type in labeled_images:
+            content.append({"type": "text", "text": f"[{label}]"})
+            content.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{image_base64}"}})
+        started_at = time.perf_counter()
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": content}],
+            temperature=0.0,
+            max_tokens=max_tokens,
+            response_format=response_format(VisionBatchResult)
+        )
+        record_usage(ledger, stage, model, response, started_at)
+        return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
+    except Exception as e:
+        return f'{{"error": "OpenAI APIエラー: {e}"}}', 0, 0
+
+async def call_openai_text_api_async(client, prompt, model="gpt-4o", ledger=None, stage="", response_model=None):
+    """response_model (schemas.py の Pydantic モデル) を渡すとそのスキーマで応答させる (なければJSONモード)"""
+    try:
+        messages = [{"role": "user", "content": prompt}]
+        started_at = time.perf_counter()
+        response = await client.chat.completions.create(
+            model=model, messages=messages, temperature=0.0,
+            response_format=response_format(response_model) if response_model else {"type": "json_object"}
+        )
+        record_usage(ledger, stage, model, response, started_at)
+        # コンテンツと、入力/出力トークンを返す
+        return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
+    except Exception as e: 
+        return f'{{"status": "api_error", "message": "OpenAI APIエラー: {e}"}}', 0, 0
+
+async def call_openai_routed_text_api_async(client, prompt, stage, model_routes=None, ledger=None):
+    """
+    model_routes にステージの設定があれば、まず軽量モデルで判定し、応答形式の不正・確信度の低さ・
+    エラー指摘があった場合のみ強いモデルで判定し直す (設定がなければ従来どおり GPT-4o のみ)。
+    応答はステージの応答モデル (schemas.STAGE_RESPONSE_MODELS) のスキーマで返させる (軽量モデルは確信度付き)。
+    戻り値: (採用した応答テキスト, 入力トークン合計, 出力トークン合計)
+    """
+    response_model, confident_model = STAGE_RESPONSE_MODELS.get(stage, (None, None))
+    route = model_routes.get(stage) if model_routes else None
+    if route is None:
+        return await call_openai_text_api_async(client, prompt, ledger=ledger, stage=stage, response_model=response_model)
+
+    response_str, in_tokens, out_tokens = await call_openai_text_api_async(
+        client, prompt + CONFIDENCE_INSTRUCTION, model=route.primary, ledger=ledger, stage=stage, response_model=confident_model
+    )
+    reason = escalation_reason(stage, route, response_str)
+    if ledger is not None:
+        ledger.record_route(stage, reason)
+    if reason is None:
+        return response_str, in_tokens, out_tokens
+
+    strong_str, strong_in, strong_out = await call_openai_text_api_async(
+        client, prompt, model=route.escalation, ledger=ledger, stage=stage, response_model=response_model
+    )
+    return strong_str, in_tokens + strong_in, out_tokens + strong_out
+
+async def call_openai_simple_text_api_async(client, prompt, model="gpt-4o", ledger=None, stage=""):
+    try:
+        messages = [{"role": "user", "content": prompt}]
+        started_at = time.perf_counter()
+        response = await client.chat.completions.create(model=model, messages=messages, temperature=0.0)
+        record_usage(ledger, stage, model, response, started_at)
+        # コンテンツと、入力/出力トークンを返す
+        return response.choices[0].message.content, response.usage.prompt_tokens, response.usage.completion_tokens
+    except Exception as e: 
+        return f"OpenAI APIエラー: {e}", 0, 0
+
+# --- 誤字脱字チェック ---
+# 指摘の範囲と除外ルール (1レコードずつのチェックと、複数レコードをまとめたチェックで共通)
+TYPO_CHECK_RULES = """あなたは商品広告テキストに含まれる「明らかな誤字・脱字・誤用」のみを検出する品質管理AIです。
+校正者ではありません。「修正すべき致命的なミス」以外は全て無視してください。
+
+### 重要：指摘の範囲（切り取り方）について
+単語単体で意味が通じる場合でも、文脈がおかしい場合は**「文脈（前後の助詞や動詞）を含めたフレーズ」**で指摘してください。
+- 悪い例：「保存期間」を確認 （単語自体は合っているため混乱する）
+- 良い例：「保存期間ありません」を確認 （助詞不足や言い回しの違和感が伝わる）
+
+### 除外ルール（絶対に指摘してはいけないもの）
+1. **食材名・商品名・固有名詞**:
+   - 「蓮根」「牛たん」「○○産」などの名詞は、文脈が唐突でも（例：「泥が蓮根」）商品名やキャッチコピーの可能性があるため無視してください。
+2. **広告特有の表現**:
+   - 箇条書きや短文における助詞の省略（例：「保存期間ありません」「在庫なし」）は、意味が通じる限り許容してください。
+3. **スペースによる単語連結**:
+   - OCRの仕様でスペースがないことは無視してください。
+
+### 指摘すべき対象（例）
+- **明らかな誤変換**:
+  - 「確認」→「角認」、「絶品」→「絶貧」（漢字の間違い）
+- **明らかな入力・タイプミス**:
+  - 「ありがとうございます」→「ありがとうごうざいます」（文字の重複）
+  - 「おいしい」→「おしいい」（順序逆転）
+- **文章として崩壊しているもの**:
+  - 「保存期間ありません」→広告表現としてギリギリ許容（スルー推奨だが、あまりに不自然ならフレーズで指摘）
+  - 「保存期間あありません」→明らかに「あ」が多いので、「保存期間あありません」として指摘。
+- **送り仮名の明らかな異常**:
+  - 「行います」→「行いあす」
+
+"""
+
+def filter_typo_targets(ocr_results_dict):
+    """誤字脱字チェックの対象となるテキスト (空・エラーを除く) だけの辞書を返す"""
+    return {
+        k: v for k, v in ocr_results_dict.items() 
+        if v and "テキストは検出されませんでした。" not in v and "APIエラー" not in v and "予期せぬエラー" not in v
+    }
+
+def format_typo_result(result_json):
+    """誤字脱字チェックの応答 (1レコード分のJSON) を結果欄の文字列にする"""
+    if result_json.get("status") == "ok": 
+        return "OK！"
+    elif result_json.get("status") == "error": 
+        message = result_json.get("message", "エラー")
+        affected_sources = result_json.get("affected_sources", [])
+        
+        # 対象のポータル名がある場合、メッセージに追記する
+        if affected_sources:
+            # JSON等の表記揺れ対策（念のため文字列化して結合）
+            sources_str = "」「".join([str(s) for s in affected_sources])
+            return f"{message}\n（対象：「{sources_str}」）"
+        else:
+            return message
+    else: 
+        return "不明" # APIが予期しない形式で返した場合
+
+# --- OCR・二次チェック結果のキャッシュ ---
+# プロンプトを変更した場合は該当ステージの番号を上げる (以前の結果は使われなくなる)
+CHECK_PROMPT_VERSIONS = {"vision": 1, "typo": 1, "text_compare": 1, "volume_compare": 1}
+
+def normalize_check_text(text):
+    """キャッシュキー用に空白・改行を除去する (いずれのチェックでも判定に影響しない違いのため)"""
+    return re.sub(r'\s+', '', text or "")
+
+def check_cache_key(stage, normalized_input, model_routes=None):
+    """正規化済みの入力・プロンプトのバージョン・モデル設定からキャッシュキーを作る"""
+    route = model_routes.get(stage) if model_routes else None
+    model_config = f"{route.primary}>{route.escalation}@{route.min_confidence}" if route else "gpt-4o"
+    return make_cache_key(stage, CHECK_PROMPT_VERSIONS[stage], model_config, normalized_input)
+
+def typo_cache_key(filtered_items, model_routes=None):
+    return check_cache_key("typo", sorted((k, normalize_check_text(v)) for k, v in filtered_items.items()), model_routes)
+
+def lookup_check_cache(cache, stage, key, ledger=None):
+    """キャッシュを引き、ヒット・ミスを台帳に記録する (キャッシュになければ None)"""
+    value = cache.get(stage, key)
+    if ledger is not None:
+        ledger.record_cache(stage, value is not None)
+    return value
+
+async def cached_check_async(cache, stage, key, ledger, compute):
+    """
+    キャッシュを引き、なければ compute() を実行して有効な結果だけを保存する。
+    compute は (結果, 入力トークン, 出力トークン, 有効な結果か) を返すコルーチン関数。
+    同じキーの処理が他のセッション・タスクで実行中なら、API を呼ばずにその完了を待って結果を共有する (トークンは計上しない)。
+    戻り値: (結果, 入力トークン, 出力トークン)
+    """
+    cached = lookup_check_cache(cache, stage, key, ledger)
+    if cached is not None: return cached, 0, 0
+
+    async def compute_and_store():
+        outcome = await compute()
+        if outcome[3]:
+            cache.put(stage, key, outcome[0])
+        return outcome
+
+    (result, in_tokens, out_tokens, valid), executed = await cache.inflight.do(key, compute_and_store)
+    if executed:
+        return result, in_tokens, out_tokens
+    if valid:
+        if ledger is not None:
+            ledger.record_shared(stage)
+        return result, 0, 0
+    # 共有された結果が無効 (APIエラーなど) だった場合は自分で実行する
+    result, in_tokens, out_tokens, _ = await compute_and_store()
+    return result, in_tokens, out_tokens
+
+async def check_typos_async(client, ocr_results_dict, ledger=None, model_routes=None, cache=None):
+    """
+    誤字脱字チェックを行う。
+    ポータルごとのテキストを辞書で受け取り、誤字がある場合は対象のポータル名も特定して返す。
+    cache (check_cache.CheckCache) を渡すと、同じテキストの判定済みの結果を再利用する。
+    """
+    # 無効なテキストを除外して辞書を再構築
+    filtered_items = filter_typo_targets(ocr_results_dict)
+    
+    if not filtered_items: return "OK！", 0, 0
+
+    compute = partial(request_typo_check_async, client, filtered_items, ledger, model_routes)
+    if cache is not None:
+        # 解析できなかった応答やAPIエラーはキャッシュしない
+        return await cached_check_async(cache, "typo", typo_cache_key(filtered_items, model_routes), ledger, compute)
+    result, in_tokens, out_tokens, _ = await compute()
+    return result, in_tokens, out_tokens
+
+async def request_typo_check_async(client, filtered_items, ledger=None, model_routes=None):
+    """
+    誤字脱字チェックのAPI呼び出し (filtered_items は filter_typo_targets 済みの辞書)。
+    戻り値: (結果, 入力トークン, 出力トークン, 応答が有効な判定だったか)
+    """
+    # AIに渡すテキストを整形（【ポータル名】テキスト... の形式）
+    formatted_text = ""
+    for portal_name, text in filtered_items.items():
+        formatted_text += f"【{portal_name}】\n{text}\n---\n"
+
+    # --- プロンプト修正開始 ---
+    prompt = TYPO_CHECK_RULES + f"""### 判断・出力フォーマット
+- 指摘すべきエラーがない場合は {{"status": "ok"}} を返してください。
+- エラーがある場合のみ、以下のJSON形式で返してください。
+  {{
+    "status": "error", 
+    "message": "\\"(問題のあるフレーズ全体)\\" を確認",
+    "affected_sources": ["ソース名1", "ソース名2", ...] 
+  }}
+  - **重要: 同じ誤字が複数のポータルに含まれている場合は、該当する全てのポータル名を `affected_sources` リストに含めてください。**
+
+---チェック対象テキスト---
+{formatted_text}"""
+    # --- プロンプト修正終了 ---
+
+    response_str, in_tokens, out_tokens = await call_openai_routed_text_api_async(client, prompt, "typo", model_routes, ledger)
+    parsed = parse_structured(TypoResult, response_str, ledger, "typo")
+    if parsed is not None:
+        return format_typo_result(parsed.model_dump()), in_tokens, out_tokens, True
+    try:
+        # スキーマに沿わない応答は従来どおり解析する
+        result_json = json.loads(response_str)
+        return format_typo_result(result_json), in_tokens, out_tokens, result_json.get("status") in ("ok", "error")
+    except (json.JSONDecodeError, AttributeError): 
+        return "解析不能", in_tokens, out_tokens, False # JSON解析失敗など
+
+# --- 誤字脱字チェックのまとめ実行 ---
+TYPO_BATCH_TOKEN_BUDGET = 6000 # 1リクエストに詰めるチェック対象テキストの概算トークン数
+TYPO_BATCH_MAX_RECORDS = 20 # 1リクエストあたりの最大レコード数
+TYPO_BATCH_MAX_WAIT = 1.0 # 秒。この間に集まったレコードをまとめて送信する
+
+def estimate_text_tokens(texts):
+    """日本語テキストの概算トークン数 (1文字 ≒ 1トークンとして多めに見積もる)"""
+    return sum(len(t) for t in texts)
+
+def build_typo_batch_prompt(labeled_targets):
+    """複数レコードの誤字脱字チェック用プロンプト。labeled_targets は [(ラベル, {ポータル名: テキスト})]"""
+    formatted_text = ""
+    for label, filtered_items in labeled_targets:
+        formatted_text += f"=== {label} ===\n"
+        for portal_name, text in filtered_items.items():
+            formatted_text += f"【{portal_name}】\n{text}\n---\n"
+
+    return TYPO_CHECK_RULES + f"""### 判断・出力フォーマット
+- チェック対象は複数のレコードです。「=== R1 ===」のようなラベルで区切られています。レコードごとに独立して判定してください。
+- 全てのレコードについて、レコードラベルを "label" に入れ、以下のJSON形式で返してください。
+  {{
+    "results": [
+      {{"label": "R1", "status": "ok", "message": "", "affected_sources": []}},
+      {{
+        "label": "R2",
+        "status": "error",
+        "message": "\\"(問題のあるフレーズ全体)\\" を確認",
+        "affected_sources": ["ソース名1", "ソース名2", ...]
+      }}
+    ]
+  }}
+  - エラーがないレコードは "status" を "ok"、"message" を空文字、"affected_sources" を空のリストとしてください。
+  - `affected_sources` には、そのレコード内のポータル名（【】内の名前）のみを含めてください。
+  - **重要: 同じ誤字が複数のポータルに含まれている場合は、該当する全てのポータル名を `affected_sources` リストに含めてください。**
+
+---チェック対象テキスト---
+{formatted_text}"""
+
+class TypoBatcher:
+    """
+    誤字脱字チェックを複数レコード分まとめて1回のAPI呼び出しで行う。
+    check() で受け付けたレコードを、トークン予算 (token_budget) ・最大件数・最大待ち時間のいずれかに
+    達した時点でまとめて送信し、応答をレコードごとの結果に振り分ける。
+    応答を解析できない、またはレコードの結果が欠けている場合は、そのレコードだけ1件ずつのチェックに戻す。
+    cache を渡すと、判定済みのテキストのレコードはまとめる前にキャッシュの結果を返す。
+    """
+
+    def __init__(self, client, ledger=None, model_routes=None, token_budget=TYPO_BATCH_TOKEN_BUDGET,
+                 max_records=TYPO_BATCH_MAX_RECORDS, max_wait=TYPO_BATCH_MAX_WAIT, cache=None):
+        self.client = client
+        self.ledger = ledger
+        self.model_routes = model_routes
+        self.cache = cache
+        self.token_budget = token_budget
+        self.max_records = max_records
+        self.max_wait = max_wait
+        self.batch_count = 0 # 送信したまとめリクエスト数
+        self.fallback_count = 0 # 1件ずつのチェックに戻したレコード数
+        self._pending = [] # (対象テキスト, キャッシュキー, future)
+        self._pending_tokens = 0
+        self._timer = None
+        self._tasks = set()
+
+    async def check(self, ocr_results_dict):
+        """check_typos_async と同じ (結果, 入力トークン, 出力トークン) を返す"""
+        filtered_items = filter_typo_targets(ocr_results_dict)
+        if not filtered_items: return "OK！", 0, 0
+
+        cache_key = typo_cache_key(filtered_items, self.model_routes) if self.cache is not None else None
+        if cache_key:
+            cached = lookup_check_cache(self.cache, "typo", cache_key, self.ledger)
+            if cached is not None: return cached, 0, 0
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        tokens = estimate_text_tokens(filtered_items.values())
+        if self._pending and self._pending_tokens + tokens > self.token_budget:
+            self._flush()
+        self._pending.append((filtered_items, cache_key, future))
+        self._pending_tokens += tokens
+
+        if len(self._pending) >= self.max_records or self._pending_tokens >= self.token_budget:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        try:
+            if len(batch) == 1:
+                await self._fallback(batch)
+                return
+
+            route = self.model_routes.get("typo") if self.model_routes else None
+            labels = [f"R{i + 1}" for i in range(len(batch))]
+            prompt = build_typo_batch_prompt([(label, filtered_items) for label, (filtered_items, _, _) in zip(labels, batch)])
+            if route is not None:
+                prompt += BATCH_CONFIDENCE_INSTRUCTION
+            batch_model = ConfidentTypoBatchResult if route is not None else TypoBatchResult
+            response_str, in_tokens, out_tokens = await call_openai_text_api_async(
+                self.client, prompt, model=route.primary if route else "gpt-4o", ledger=self.ledger, stage="typo", response_model=batch_model
+            )
+            self.batch_count += 1
+
+            # スキーマに沿わない応答の場合、結果が欠けたレコードは下で1件ずつのチェックに戻る
+            parsed = parse_structured(batch_model, response_str, self.ledger, "typo")
+            per_record = {item.label: item.model_dump(exclude={"label"}) for item in parsed.results} if parsed is not None else {}
+
+            # まとめて呼び出した分のトークンはレコード数で按分する
+            share_in, share_out = in_tokens // len(batch), out_tokens // len(batch)
+            fallback = []
+            for label, item in zip(labels, batch):
+                filtered_items, cache_key, future = item
+                record_json = per_record.get(label)
+                if not isinstance(record_json, dict) or record_json.get("status") not in ("ok", "error"):
+                    fallback.append(item)
+                    continue
+                if route is not None:
+                    # 軽量モデルの結果が不確かなレコードは強いモデルで1件ずつ判定し直す
+                    reason = escalation_reason("typo", route, json.dumps(record_json))
+                    if self.ledger is not None:
+                        self.ledger.record_route("typo", reason)
+                    if reason is not None:
+                        fallback.append(item)
+                        continue
+                # 別レコードのポータル名が混ざった場合に備え、そのレコードのポータルに限定する
+                sources = record_json.get("affected_sources") or []
+                record_json["affected_sources"] = [s for s in sources if str(s) in filtered_items] or sources
+                result = format_typo_result(record_json)
+                if cache_key:
+                    self.cache.put("typo", cache_key, result)
+                if not future.done():
+                    future.set_result((result, share_in, share_out))
+
+            await self._fallback(fallback, use_routes=False)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    async def _fallback(self, items, use_routes=True):
+        """1件ずつの誤字脱字チェックに戻す (昇格の再判定では強いモデルを直接使う)"""
+        if not items:
+            return
+        self.fallback_count += len(items)
+        model_routes = self.model_routes if use_routes else None
+        results = await asyncio.gather(
+            *[request_typo_check_async(self.client, filtered_items, self.ledger, model_routes) for filtered_items, _, _ in items],
+            return_exceptions=True
+        )
+        for (_, cache_key, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+                continue
+            result, in_tokens, out_tokens, valid = result
+            if cache_key and valid:
+                self.cache.put("typo", cache_key, result)
+            future.set_result((result, in_tokens, out_tokens))
+
+async def compare_content_volume_async(client, base_content, volume_results_dict, ledger=None, model_routes=None, cache=None):
+    """
+    AIを使用して、基準となる内容量と複数の比較対象内容量が一致するか判定する（緩やかな判定）
+    cache (check_cache.CheckCache) を渡すと、同じ組み合わせの判定済みの結果を再利用する。
+    """
+    # 空でない有効な内容量テキストのみを抽出した辞書を作成
+    valid_portal_items = {k: v for k, v in volume_results_dict.items() if v and v.strip()}
+
+    # 比較対象となるポータルの内容量が一つもなければ「内容量記載なし」
+    if not valid_portal_items:
+        return "内容量記載なし", 0, 0
+
+    # NENGの内容量（基準）が空なら「要確認」
+    if not base_content:
+        return "要確認", 0, 0
+
+    compute = partial(request_volume_compare_async, client, base_content, valid_portal_items, ledger, model_routes)
+    if cache is not None:
+        cache_key = check_cache_key(
+            "volume_compare",
+            [normalize_check_text(base_content), sorted((k, normalize_check_text(v)) for k, v in valid_portal_items.items())],
+            model_routes
+        )
+        return await cached_check_async(cache, "volume_compare", cache_key, ledger, compute)
+    result, in_tokens, out_tokens, _ = await compute()
+    return result, in_tokens, out_tokens
+
+async def request_volume_compare_async(client, base_content, valid_portal_items, ledger=None, model_routes=None):
+    """
+    内容量比較のAPI呼び出し (valid_portal_items は空でない内容量だけの辞書)。
+    戻り値: (結果, 入力トークン, 出力トークン, ok / ng と判定できたか)
+    """
+    prompt = f"""あなたは商品の内容量テキストが、実質的に同じ意味であるかを判断するチェック担当者（人間）です。
+以下の基準に従って、柔軟に判定を行ってください。
+
+### 判定基準（緩やかな一致・部分一致の許容）
+1. **実質的な意味の一致**: 表記が異なっていても、人間が見て「同じ量」だと判断できる場合は「OK」としてください。
+   - 例: "90ml×6個" と "90mlX6" -> **OK** (×とXの違い、単位の省略は許容)
+   - 例: "2kg" と "2.0kg" -> **OK** (有効数字の違いは許容)
+2. **【重要】部分的な記載の許容（サブセット）**:
+   - 画像のデザイン上、セット商品の一部（メイン商品など）の分量しか書かれていない場合があります。
+   - **「画像に書かれている情報」が、「基準データ」の内容と矛盾せず、その一部として含まれている場合は「OK」としてください。**
+   - **例（OKのケース）**:
+     - 基準: "お米 3kg、ハム 2種、野菜 3種"
+     - 画像: "お米 3kg"
+     - 判定: **OK** (お米の量は合っているため。他が未記載でもOK)
+3. **明らかに矛盾する場合のみNG**:
+   - 画像に書かれている数値が、基準データの該当部分と食い違っている場合は「NG」としてください。
+   - **例（NGのケース）**:
+     - 基準: "お米 3kg、ハム 2種"
+     - 画像: "お米 5kg"
+     - 判定: **NG** (3kgと5kgで矛盾している)
+
+### 入力データ
+- **基準データ (NENG)**: "{base_content}"
+- **比較対象データ**: {json.dumps(valid_portal_items, ensure_ascii=False)}
+
+### 応答形式
+全ての比較対象データが、基準データと実質的に一致している（または矛盾していない部分一致である）と判断できる場合は `ok` を返してください。
+明らかに矛盾しているデータが含まれる場合は `ng` とし、**矛盾しているデータのキー名（ポータル名）のリスト**をJSON形式で返してください。
+
+成功時:
+{{"result": "ok"}}
+
+失敗時（NGの場合）:
+{{"result": "ng", "deviant_sources": ["Portal A", "Portal B"]}}
+"""
+    response_str, in_tokens, out_tokens = await call_openai_routed_text_api_async(client, prompt, "volume_compare", model_routes, ledger)
+    parsed = parse_structured(VolumeCompareResult, response_str, ledger, "volume_compare")
+    try:
+        # スキーマに沿わない応答は従来どおり解析する
+        result_json = parsed.model_dump() if parsed is not None else json.loads(response_str)
+        if result_json.get("result") == "ok":
+            result = "OK！"
+        else:
+            # NGの場合
+            deviant_sources = result_json.get("deviant_sources", [])
+            base_msg = "要確認"
+            if deviant_sources:
+                sources_str = "」「".join([str(s) for s in deviant_sources])
+                result = f"{base_msg}\n（対象：「{sources_str}」）"
+            else:
+                result = base_msg
+        # ok / ng と判定できた場合のみキャッシュする (APIエラー・不正な形式は除く)
+        return result, in_tokens, out_tokens, result_json.get("result") in ("ok", "ng")
+                
+    except (json.JSONDecodeError, AttributeError):
+        return "要確認", in_tokens, out_tokens, False # JSON解析失敗や result キーがない場合は「要確認」扱い
+    
+# テキストの意味的一致を確認するAI関数
+async def compare_text_content_async(client, texts, ledger=None, model_routes=None, cache=None):
+    """
+    複数のOCRテキストが、改行やスペースの違いを除いて実質的に同じか判定する。
+    cache (check_cache.CheckCache) を渡すと、同じテキストの組み合わせの判定済みの結果を再利用する。
+    """
+    # 空でないテキストのみ抽出
+    valid_texts = [t for t in texts if t and "テキストは検出されませんでした。" not in t and "APIエラー" not in t]
+    
+    if len(valid_texts) <= 1:
+        return "比較対象なし", 0, 0
+
+    # Python側で単純な正規化（全空白削除）をして一致すればAPI節約のため即OK
+    simple_normalized = {re.sub(r'\s+', '', t) for t in valid_texts}
+    if len(simple_normalized) == 1:
+        return "OK！", 0, 0
+
+    compute = partial(request_text_compare_async, client, valid_texts, ledger, model_routes)
+    if cache is not None:
+        cache_key = check_cache_key("text_compare", sorted(simple_normalized), model_routes)
+        return await cached_check_async(cache, "text_compare", cache_key, ledger, compute)
+    result, in_tokens, out_tokens, _ = await compute()
+    return result, in_tokens, out_tokens
+
+async def request_text_compare_async(client, valid_texts, ledger=None, model_routes=None):
+    """
+    テキスト比較のAPI呼び出し (valid_texts は比較対象の有効なテキストのリスト)。
+    戻り値: (結果, 入力トークン, 出力トークン, ok / ng と判定できたか)
+    """
+    prompt = f"""あなたはテキスト比較の専門家です。以下の複数のテキストリストの内容が、実質的に同じであるかを判定してください。
+
+### 判定基準
+1. **無視してよい違い（OK）**:
+   - **改行・空白**: 「改行の位置」や「スペースの有無・個数」の違いは無視してください。（例: "商品\\n名" と "商品名" は同じ）
+   - **記号の全角半角**: 意味が変わらない範囲の記号の違い（「！」と「!」など）は無視してください。
+
+2. **許容しない違い（NG）**:
+   - **文字の相違**: 一文字でも異なる文字があればNGです。
+   - **【重要】句読点（、。,.）の有無**: 読点「、」や句点「。」があるものとないものが混在している場合は、デザインミスの可能性があるため必ず「NG」としてください。
+   - **数字・単位**: これらが異なる場合はNGです。
+
+### 入力テキストリスト
+{json.dumps(valid_texts, ensure_ascii=False)}
+
+### 応答形式
+全て実質的に同じテキストであれば `ok`、明確な差分（特に句読点の有無）があれば `ng` をJSON形式で返してください。
+{{"result": "ok"}} または {{"result": "ng"}}
+"""
+    response_str, in_tokens, out_tokens = await call_openai_routed_text_api_async(client, prompt, "text_compare", model_routes, ledger)
+    parsed = parse_structured(TextCompareResult, response_str, ledger, "text_compare")
+    try:
+        # スキーマに沿わない応答は従来どおり解析する
+        result_json = parsed.model_dump() if parsed is not None else json.loads(response_str)
+        result = "OK！" if result_json.get("result") == "ok" else "差分あり"
+        return result, in_tokens, out_tokens, result_json.get("result") in ("ok", "ng")
+    except (json.JSONDecodeError, AttributeError):
+        return "差分あり", in_tokens, out_tokens, False # 解析失敗時は安全側に倒してNG
+
+# --- 画像OCR (Vision) のプロンプト ---
+# 抽出ルールは1枚ずつのOCRとまとめてOCRの両方で共通
+VISION_EXTRACTION_RULES = """1. **full_text**: 画像に含まれる全てのテキストを、人間が読む順序（上から下、左から右）で抽出し、自然な改行を含めて書き起こしてください。
+   - レイアウトを優先し、意味のまとまりごとに改行を入れてください。
+   - **【重要】句読点（、。,.）や記号（！?）はデザインの誤植チェックに必要です。どんなに小さくても省略せず、画像通り正確に書き起こしてください。**
+   - 記号の統一（「×」→「x」など）や全角半角の統一を行ってください。
+   - テキストがない場合は空文字にしてください。
+
+2. **volume_text**: 画像の中から、「商品の内容量」「重量」「個数」に関する記述を抽出してください。
+   - **【最重要】捏造の禁止**: 画像内に**明記されているテキストのみ**を使用してください。
+     - 画像の「見た目」から商品名を推測して勝手に単語（例：「ソルベ」「アイス」など）を追加することは**絶対に禁止**です。
+     - **悪い例**: 画像に「いちご」としか書いてないのに、写真を見て "ストロベリーソルベ 6個" と出力する。
+     - **良い例**: "いちご 6個"
+   - **品名との結合**: 「6個」「2種」のように数量だけでは分からない場合は、**画像内に書かれている**「品名・カテゴリ名」を補って書き出してください。
+   - **レイアウト対応**: 品名と数量が改行で離れて記載されている場合も、それらを結合して抽出してください。
+   - 複数のアイテムがある場合は、「お米 5kg、肉 1kg」のようにそれぞれの内訳が分かるように記述してください。
+   - 不要な形容詞（「おいしい」「絶品の」など）や、量と無関係な宣伝文句は除外してください。
+   - 該当する記述がない場合は空文字にしてください。
+
+"""
+
+VISION_PROMPT = """あなたは、商品広告画像のテキスト抽出の専門家です。
+与えられた画像から、以下の2つの情報をJSON形式で抽出してください。
+
+""" + VISION_EXTRACTION_RULES + """### 出力形式 (JSON)
+{
+  "full_text": "抽出した全文...",
+  "volume_text": "抽出した内容量..."
+}
+"""
+
+VISION_BATCH_MAX_IMAGES = 4 # まとめてOCRする場合の1リクエストあたりの最大画像数
+
+
+def build_vision_batch_prompt(labels):
+    """複数画像をまとめてOCRする場合のプロンプト (応答は画像ごとの結果のリスト。VisionBatchResult)"""
+    output_example = ",\n".join(
+        f'    {{"label": "{label}", "full_text": "抽出した全文...", "volume_text": "抽出した内容量..."}}' for label in labels
+    )
+    return (
+        "あなたは、商品広告画像のテキスト抽出の専門家です。\n"
+        f"{len(labels)}枚の画像が与えられます。各画像の直前に「[image_1]」のようなラベルがあります。\n"
+        "画像ごとに独立して、以下の2つの情報をJSON形式で抽出してください。他の画像の内容を混ぜないでください。\n\n"
+        + VISION_EXTRACTION_RULES
+        + "### 出力形式 (JSON)\n"
+        "全ての画像について、画像ラベルを \"label\" に入れて含めてください。\n"
+        "{\n"
+        '  "images": [\n'
+        f"{output_example}\n"
+        "  ]\n"
+        "}\n"
+    )
+
+
+def download_drive_image_sync(file_id, creds_info):
+    """同期的にGoogle Driveから画像データをダウンロードする (creds_info はサービスアカウント認証情報の辞書)"""
+    drive = get_google_clients(creds_info).drive() # 全セッション・全スレッドで共有のサービス (接続・トークンを使い回す)
+    # --- 共有ドライブ対応 ---
+    request = drive.files().get_media(fileId=file_id, supportsAllDrives=True)
+    return request.execute() # 画像のバイナリデータを返す
+
+async def download_image_async(file_id, creds_info, tracer=NOOP_TRACER, image_name=None, downloader=download_drive_image_sync):
+    """同期的なダウンロード処理を非同期イベントループ (スレッドプール) で実行する"""
+    loop = asyncio.get_running_loop()
+    with tracer.span("download", image_name):
+        return await loop.run_in_executor(None, partial(downloader, file_id, creds_info))
+
+def describe_download_error(e):
+    """ダウンロード失敗時にOCR結果欄へ入れるメッセージ"""
+    if isinstance(e, HttpError):
+        return f"Google Drive画像取得失敗 (HttpError {e.resp.status})"
+    return f"Google Drive画像取得失敗: {e}" # その他のエラー
+
+def parse_vision_result(json_data):
+    """Vision APIの応答 (1画像分) から (全文, 内容量) を取り出す"""
+    final_full_text = str(json_data.get("full_text", "")).strip()
+    final_volume_text = str(json_data.get("volume_text", "")).strip()
+
+    # AIが空文字列の代わりに '""' という文字列を返した場合の対策
+    if final_full_text == '""': final_full_text = ""
+    if final_volume_text == '""': final_volume_text = ""
+    return final_full_text, final_volume_text
+
+async def ocr_image_async(portal_name, image_bytes, mime_type, client, ledger=None, tracer=NOOP_TRACER, image_name=None, image_base64=None, cache=None, content_hash=None):
+    """
+    取得済みの画像1枚を OpenAI Vision API でOCRし、全文と内容量を抽出する。
+    image_base64 に前処理済み (image_workers.py) のBase64を渡した場合はエンコードを省略する。
+    cache と content_hash (元の画像データの md5) を渡すと、同じ画像のOCR済みの結果を再利用する
+    (他のセッションで同じ画像をOCR中の場合は、その結果を待って共有する)。
+    """
+    # Base64エンコード
+    if image_base64 is None:
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+
+    compute = partial(request_vision_ocr_async, client, image_base64, mime_type, ledger, tracer, image_name)
+    if cache is not None and content_hash:
+        texts, in_tokens, out_tokens = await cached_check_async(cache, "vision", check_cache_key("vision", content_hash), ledger, compute)
+    else:
+        texts, in_tokens, out_tokens, _ = await compute()
+    final_full_text, final_volume_text = texts
+    return portal_name, final_full_text, final_volume_text, image_bytes, in_tokens, out_tokens
+
+async def request_vision_ocr_async(client, image_base64, mime_type, ledger=None, tracer=NOOP_TRACER, image_name=None):
+    """
+    Vision API の呼び出しと応答の解析。
+    戻り値: ((全文, 内容量), 入力トークン, 出力トークン, 解析できたOCR結果か)
+    """
+    # OpenAI Vision API呼び出し (JSONモード)
+    with tracer.span("vision", image_name):
+        response_text, in_tokens, out_tokens = await call_openai_vision_api_async(client, VISION_PROMPT, image_base64, mime_type, ledger=ledger)
+
+    # --- JSON解析と後処理 ---
+    parsed = parse_structured(VisionResult, response_text, ledger, "vision")
+    if parsed is not None:
+        return parse_vision_result(parsed.model_dump()), in_tokens, out_tokens, True
+
+    # スキーマに沿わない応答は従来どおり解析する
+    try:
+        json_data = json.loads(response_text)
+        
+        # errorキーがある場合はAPIエラーとして処理
+        if "error" in json_data:
+            return (json_data["error"], ""), in_tokens, out_tokens, False
+
+        return parse_vision_result(json_data), in_tokens, out_tokens, True
+
+    except json.JSONDecodeError:
+        # JSON解析に失敗した場合のフォールバック (従来のテキストとして扱う)
+        # マークダウン記法などを除去して全文として扱う (内容量は解析不能なため空にする。キャッシュはしない)
+        cleaned_text = re.sub(r"```(json|text|plaintext)?\n?", "", response_text).replace("```", "")
+        return (cleaned_text.strip(), ""), in_tokens, out_tokens, False
+
+async def extract_text_from_drive_image_async(portal_name, file_id, mime_type, creds_info, client, ledger=None, tracer=NOOP_TRACER, image_name=None, downloader=download_drive_image_sync):
+    """非同期でDrive画像を取得し、OpenAI Vision APIでOCRと内容量抽出を同時に実行"""
+    try:
+        image_bytes = await download_image_async(file_id, creds_info, tracer, image_name, downloader)
+    except Exception as e:
+        return portal_name, describe_download_error(e), "", None, 0, 0
+
+    return await ocr_image_async(portal_name, image_bytes, mime_type, client, ledger, tracer, image_name)
+
+async def ocr_image_batch_async(images, client, ledger=None, tracer=NOOP_TRACER, image_name=None, cache=None):
+    """
+    取得済みの複数画像 [(ポータル名, bytes, mime_type, 前処理済みのBase64 or None, 内容ハッシュ)] を1回の Vision API 呼び出しでOCRする。
+    cache を渡すと、解析できた結果を内容ハッシュをキーに保存する。
+    応答に含まれなかった画像や、応答を解析できなかった場合は1枚ずつのOCRにフォールバックする。
+    戻り値は ocr_image_async の戻り値のリスト (images と同じ順)。
+    """
+    labels = [f"image_{i + 1}" for i in range(len(images))]
+    labeled_images = [
+        (label, image_base64 if image_base64 is not None else base64.b64encode(image_bytes).decode('utf-8'), mime_type)
+        for label, (_, image_bytes, mime_type, image_base64, _) in zip(labels, images)
+    ]
+
+    with tracer.span("vision", image_name):
+        response_text, in_tokens, out_tokens = await call_openai_vision_batch_api_async(
+            client, build_vision_batch_prompt(labels), labeled_images, max_tokens=1000 * len(images), ledger=ledger
+        )
+
+    # スキーマに沿わない応答の場合、結果が欠けた画像は下で1枚ずつのOCRに戻る
+    parsed = parse_structured(VisionBatchResult, response_text, ledger, "vision")
+    per_image = {item.label: item.model_dump() for item in parsed.images} if parsed is not None else {}
+
+    results = {}
+    fallback = []
+    for label, (portal_name, image_bytes, mime_type, image_base64, content_hash) in zip(labels, images):
+        item = per_image.get(label)
+        if isinstance(item, dict):
+            final_full_text, final_volume_text = parse_vision_result(item)
+            if cache is not None and content_hash:
+                cache.put("vision", check_cache_key("vision", content_hash), [final_full_text, final_volume_text])
+            results[portal_name] = (portal_name, final_full_text, final_volume_text, image_bytes, 0, 0)
+        else:
+            fallback.append(ocr_image_async(portal_name, image_bytes, mime_type, client, ledger, tracer, image_name, image_base64))
+
+    for result in await asyncio.gather(*fallback):
+        results[result[0]] = result
+
+    # まとめて呼び出した分のトークンは先頭の画像に計上する
+    ordered = [results[image[0]] for image in images]
+    first = ordered[0]
+    ordered[0] = first[:4] + (first[4] + in_tokens, first[5] + out_tokens)
+    return ordered
+
+async def download_record_images_async(portals, creds_info, tracer=NOOP_TRACER, image_name=None, downloader=download_drive_image_sync):
+    """
+    1レコード分の画像を取得する。一覧取得時の md5Checksum が同じポータルはまとめ、代表の1枚だけをダウンロードする。
+    戻り値: [(同じ md5Checksum のポータル名リスト, bytes or None, 取得失敗時のメッセージ or None)]
+    """
+    checksum_groups = {}
+    for portal_name, p_data in portals.items():
+        key = p_data.get('md5Checksum') or f"id:{p_data['id']}"
+        checksum_groups.setdefault(key, []).append(portal_name)
+
+    async def download(portal_name):
+        try:
+            return await download_image_async(portals[portal_name]['id'], creds_info, tracer, image_name, downloader), None
+        except Exception as e:
+            return None, describe_download_error(e)
+
+    groups = list(checksum_groups.values())
+    downloaded = await asyncio.gather(*[download(members[0]) for members in groups])
+    return [(members, image_bytes, error) for members, (image_bytes, error) in zip(groups, downloaded)]
+
+def dedup_record_images(portals, downloaded):
+    """
+    取得した内容のハッシュでも同一画像をまとめる (md5Checksum がない場合や、別ファイルの同一画像)。
+    戻り値: ({取得失敗したポータル名: 結果}, {内容ハッシュ: (代表のポータル名, bytes, mime_type, [ポータル名], Base64 or None)})
+    """
+    failed = {}
+    unique_images = {}
+    for members, image_bytes, error in downloaded:
+        if error:
+            for portal_name in members:
+                failed[portal_name] = (portal_name, error, "", None, 0, 0)
+            continue
+        content_hash = hashlib.md5(image_bytes).hexdigest()
+        if content_hash in unique_images:
+            unique_images[content_hash][3].extend(members)
+        else:
+            unique_images[content_hash] = (members[0], image_bytes, portals[members[0]]['mimeType'], list(members), None)
+    return failed, unique_images
+
+async def preprocess_record_images_async(portals, downloaded, image_processor=None, thumbnails=False):
+    """
+    取得した画像の前処理 (同一画像の判定)。戻り値は dedup_record_images と同じ形式。
+    image_processor (image_workers.ImageProcessor) を渡すと、ハッシュ・Base64エンコード・大きすぎる画像の縮小を
+    プロセスプールで実行する。thumbnails=True の場合は表示用の縮小画像も作成し、bytes の代わりに保持する
+    (Base64 があるため OCR に元の画像データは不要)。
+    image_processor がない場合はハッシュ計算だけをスレッドプールで実行する (Base64 は OCR 時に作成)。
+    """
+    if image_processor is None:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, dedup_record_images, portals, downloaded)
+
+    failed = {}
+    succeeded = []
+    for members, image_bytes, error in downloaded:
+        if error:
+            for portal_name in members:
+                failed[portal_name] = (portal_name, error, "", None, 0, 0)
+        else:
+            succeeded.append((members, image_bytes))
+    prepared = await asyncio.gather(*[
+        image_processor.prepare(image_bytes, portals[members[0]]['mimeType'], thumbnails) for members, image_bytes in succeeded
+    ])
+
+    unique_images = {}
+    for (members, image_bytes), image in zip(succeeded, prepared):
+        if image.md5 in unique_images:
+            unique_images[image.md5][3].extend(members)
+        else:
+            kept_bytes = (image.thumbnail or b"") if thumbnails else image_bytes
+            unique_images[image.md5] = (members[0], kept_bytes, image.mime_type, list(members), image.image_base64)
+    return failed, unique_images
+
+async def ocr_unique_images_async(portals, failed, unique_images, client, ledger=None, tracer=NOOP_TRACER, image_name=None, vision_batch=False, cache=None):
+    """
+    dedup_record_images / preprocess_record_images_async でまとめた異なる画像だけをOCRし、結果を同じ画像を持つ全ポータルで共有する。
+    cache (check_cache.CheckCache) を渡すと、OCR済みの画像 (内容ハッシュが同じ) は結果を再利用する。
+    戻り値: (ポータル順の結果リスト, 全ポータルの画像が同一かどうか)
+    """
+    images = [
+        (portal_name, image_bytes, mime_type, image_base64, content_hash)
+        for content_hash, (portal_name, image_bytes, mime_type, _, image_base64) in unique_images.items()
+    ]
+    ocr_by_portal = {}
+
+    def ocr_single(image, use_cache=True):
+        portal_name, image_bytes, mime_type, image_base64, content_hash = image
+        return ocr_image_async(
+            portal_name, image_bytes, mime_type, client, ledger, tracer, image_name, image_base64,
+            cache if use_cache else None, content_hash
+        )
+
+    if vision_batch and len(images) > 1:
+        if cache is not None:
+            # キャッシュ済みの画像を除いた残りをまとめてOCRする (まとめる分は他のセッションとの待ち合わせはしない)
+            remaining = []
+            for image in images:
+                cached = lookup_check_cache(cache, "vision", check_cache_key("vision", image[4]), ledger)
+                if cached is None:
+                    remaining.append(image)
+                else:
+                    ocr_by_portal[image[0]] = (image[0], cached[0], cached[1], image[1], 0, 0)
+            images = remaining
+        ocr_tasks = []
+        for start in range(0, len(images), VISION_BATCH_MAX_IMAGES):
+            chunk = images[start:start + VISION_BATCH_MAX_IMAGES]
+            if len(chunk) == 1:
+                ocr_tasks.append(asyncio.gather(ocr_single(chunk[0], use_cache=False)))
+            else:
+                ocr_tasks.append(ocr_image_batch_async(chunk, client, ledger, tracer, image_name, cache))
+    else:
+        ocr_tasks = [asyncio.gather(ocr_single(image)) for image in images]
+
+    for chunk_results in await asyncio.gather(*ocr_tasks):
+        for result in chunk_results:
+            ocr_by_portal[result[0]] = result
+
+    # 同じ画像を持つポータルへ結果を共有する (トークンは代表のポータルにのみ計上)
+    results = dict(failed)
+    for representative, _, _, members, _ in unique_images.values():
+        rep_result = ocr_by_portal[representative]
+        for portal_name in members:
+            results[portal_name] = rep_result if portal_name == representative else (portal_name,) + rep_result[1:4] + (0, 0)
+
+    all_identical = len(portals) > 1 and len(unique_images) == 1 and len(next(iter(unique_images.values()))[3]) == len(portals)
+    return [results[portal_name] for portal_name in portals], all_identical
+
+async def ocr_record_images_async(portals, creds_info, client, ledger=None, tracer=NOOP_TRACER, image_name=None, downloader=download_drive_image_sync, vision_batch=False, image_processor=None, thumbnails=False, cache=None):
+    """
+    1レコード分 (同じ画像名の各ポータル) の画像を取得してOCRする。
+    内容が同一の画像 (一覧取得時の md5Checksum、または取得後の内容ハッシュが一致) は1回だけOCRし、
+    結果を同じ画像を持つ全ポータルで共有する。
+    vision_batch=True の場合、異なる画像を VISION_BATCH_MAX_IMAGES 枚ずつまとめて1回のVision APIでOCRする。
+    image_processor・thumbnails は preprocess_record_images_async、cache は ocr_unique_images_async を参照。
+    portals は {ポータル名: {'id', 'mimeType', 'md5Checksum'}}。
+    戻り値: (extract_text_from_drive_image_async と同じ形式の結果リスト, 全ポータルの画像が同一かどうか)
+    """
+    downloaded = await download_record_images_async(portals, creds_info, tracer, image_name, downloader)
+    failed, unique_images = await preprocess_record_images_async(portals, downloaded, image_processor, thumbnails)
+    return await ocr_unique_images_async(portals, failed, unique_images, client, ledger, tracer, image_name, vision_batch, cache)
+
+# --- メインの非同期処理ワーカー ---
+async def check_record_async(image_name, ocr_task_results, all_images_identical, selected_product_code, client, neng_content_map, ledger=None, tracer=NOOP_TRACER, model_routes=None, typo_batcher=None, check_cache=None, thumbnails=False):
+    """
+    OCR済みの1レコードに二次チェック (誤字脱字・テキスト比較・内容量比較) を行い、レコードの結果を返す。
+    thumbnails=True の場合、画像データは表示用の縮小画像に置き換える。
+    """
+    rec_input_tokens = 0
+    rec_output_tokens = 0
+
+    # NENG API呼び出しを削除し、マップから値を取得
+
+    # 品番が「すべて」の場合はファイル名から取得、そうでなければ選択された品番を使用
+    product_code_for_neng = get_product_code_from_filename(image_name) if selected_product_code == "すべて" else selected_product_code
+
+    # マップからNENG内容量を取得（見つからない場合は空文字）
+    raw_neng_content = neng_content_map.get(product_code_for_neng, "")
+
+    # OCR結果と画像データを辞書に整理
+    ocr_results, volume_results, image_bytes_data = {}, {}, {}
+
+    for p_name, extracted_text, volume_text, img_bytes, in_t, out_t in ocr_task_results:
+        ocr_results[p_name] = extracted_text
+        volume_results[p_name] = volume_text # 画像から直接抽出した内容量
+        # 画像データも保持。縮小画像を作成できなかった画像 (b"") も取得済みとしてキーを残す (エラー検出の判定に使う)
+        if img_bytes is not None: image_bytes_data[p_name] = img_bytes
+        rec_input_tokens += in_t
+        rec_output_tokens += out_t
+
+    if thumbnails and image_bytes_data:
+        # 元の画像データはOCR後すぐに手放し、表示用の縮小画像だけを残す
+        loop = asyncio.get_running_loop()
+        image_bytes_data = await loop.run_in_executor(None, make_thumbnails, image_bytes_data)
+
+    # 誤字脱字チェックのタスクのみ作成（内容量抽出はVision APIで完了済み、NENGはそのまま使う）
+    if typo_batcher is not None:
+        # 他のレコードとまとめてチェック
+        typo_task = tracer.traced("typo", typo_batcher.check(ocr_results), image_name)
+    else:
+        typo_task = tracer.traced("typo", check_typos_async(client, ocr_results, ledger, model_routes, check_cache), image_name)
+
+    # テキスト比較タスクを追加（AIを使用）
+    if all_images_identical:
+        # 全ポータルの画像がバイト単位で同一 → OCR結果も共有しているため比較は不要
+        text_compare_task = asyncio.sleep(0, result=("OK！", 0, 0))
+    else:
+        text_compare_task = tracer.traced("text_compare", compare_text_content_async(client, list(ocr_results.values()), ledger, model_routes, check_cache), image_name)
+
+    # 上記タスクを並行実行
+    secondary_results = await asyncio.gather(
+        typo_task,
+        text_compare_task
+    )
+    (typo_result, typo_in, typo_out), (text_comparison_result, txt_in, txt_out) = secondary_results
+
+    rec_input_tokens += typo_in + txt_in
+    rec_output_tokens += typo_out + txt_out
+
+    # NENG内容量はそのまま使用（抽出なし）
+    processed_neng_content = raw_neng_content
+
+    # NENG内容量とポータル内容量を比較するタスクを実行
+    cleaned_neng_content = processed_neng_content.strip().strip('"') if processed_neng_content else ""
+
+    # volume_results の値リストではなく、辞書そのものと、クリーニング済み辞書を作成して渡す手もあるが、
+    # AI側でJSONとして受け取るため、volume_results（辞書）をそのまま渡す
+    with tracer.span("volume_compare", image_name):
+        comparison_result, comp_in, comp_out = await compare_content_volume_async(client, cleaned_neng_content, volume_results, ledger, model_routes, check_cache)
+
+    rec_input_tokens += comp_in
+    rec_output_tokens += comp_out
+
+    # 以前のPythonによる厳密比較ロジックは削除し、AIの結果(text_comparison_result)をそのまま使用
+
+    return image_name, ocr_results, volume_results, image_bytes_data, typo_result, processed_neng_content, comparison_result, text_comparison_result, rec_input_tokens, rec_output_tokens
+
+async def process_single_record_async(image_name, data, selected_product_code, creds_info, client, semaphore, neng_content_map, ledger=None, tracer=NOOP_TRACER, downloader=download_drive_image_sync, vision_batch=False, model_routes=None, typo_batcher=None, check_cache=None, thumbnails=False, image_processor=None, admission=None):
+    # 同時実行数を制限 (実行ごとの枠とサーバー全体の枠。枠の待ち時間も計測する)
+    with tracer.span("queue_wait", image_name):
+        await semaphore.acquire()
+        if admission is not None:
+            try:
+                await admission.acquire()
+            except BaseException:
+                semaphore.release()
+                raise
+    try:
+        with tracer.span("record", image_name):
+            # 画像の取得とOCR (同一画像は1回だけOCRし、vision_batch の場合はまとめてOCR)
+            ocr_task_results, all_images_identical = await ocr_record_images_async(
+                data['portals'], creds_info, client, ledger, tracer, image_name, downloader, vision_batch,
+                image_processor, thumbnails, check_cache
+            )
+            # image_processor がある場合、縮小画像は前処理で作成済み
+            return await check_record_async(
+                image_name, ocr_task_results, all_images_identical, selected_product_code, client, neng_content_map,
+                ledger, tracer, model_routes, typo_batcher, check_cache, thumbnails and image_processor is None
+            )
+    finally:
+        if admission is not None:
+            admission.release()
+        semaphore.release()
+
+async def main_async_runner(image_groups, selected_product_code, creds_info, client, progress_bar, total_records, neng_content_map, on_result=None, ledger=None, tracer=NOOP_TRACER, downloader=download_drive_image_sync, on_error=None, concurrency=MAX_CONCURRENT_RECORDS, vision_batch=False, model_routes=None, typo_batch=False, check_cache=None, window=None, thumbnails=False, stage_workers=None, image_processor=None, cancel_token=None, admission=None):
+    """
+    全レコードを非同期で処理する。
+    progress_bar は None 可。downloader には Drive 以外の取得関数 (ベンチマーク用のスタブなど) を渡せる。
+    vision_batch=True の場合、同じ画像名の各ポータルの画像をまとめて1回のVision APIでOCRする。
+    内容が同一の画像は vision_batch に関係なく1回だけOCRする。
+    model_routes ({ステージ: routing.ModelRoute}) を渡すと、二次チェックは軽量モデルから判定する。
+    typo_batch=True の場合、誤字脱字チェックを複数レコード分まとめて実行する (TypoBatcher)。
+    check_cache (check_cache.CheckCache) を渡すと、OCR済みの画像・判定済みのテキストの結果を再利用し、
+    他のセッションで実行中の同じ処理とは API の呼び出しを共有する。
+
+    大量の画像を処理する場合 (分割実行):
+    - window: 同時に作成しておくタスク数の上限。完了したレコードの分だけ次のレコードのタスクを作成する (None は全件)。
+    - thumbnails=True: 各レコードの画像データをOCR後すぐに縮小画像へ置き換える。
+    on_result を渡した場合、完了したレコードは on_result にだけ渡し、戻り値のリストには溜めない。
+    stage_workers ({ステージ: ワーカー数}) を渡すと、ステージ分割で実行する (staged_async_runner。window は処理中のレコード数の上限になる)。
+    image_processor (image_workers.ImageProcessor) を渡すと、画像のハッシュ・Base64・縮小画像の作成をプロセスプールで実行する。
+    cancel_token (staged_pipeline.CancelToken) が中止されると、新しいレコードは開始せず、処理中のレコード
+    (取得・API呼び出しの待ち) はキャンセルして、それまでに完了したレコードだけで終了する。
+    admission (admission.RunAdmission) を渡すと、レコードごとにサーバー全体の同時実行枠を取得してから処理する
+    (他の利用者の実行と枠を公平に分け合う)。
+    """
+    if stage_workers:
+        return await staged_async_runner(
+            image_groups, selected_product_code, creds_info, client, progress_bar, total_records, neng_content_map,
+            on_result, ledger, tracer, downloader, on_error, stage_workers, vision_batch=vision_batch,
+            model_routes=model_routes, typo_batch=typo_batch, check_cache=check_cache, thumbnails=thumbnails,
+            image_processor=image_processor, cancel_token=cancel_token, admission=admission, window=window
+        )
+
+    semaphore = asyncio.Semaphore(concurrency)
+    typo_batcher = TypoBatcher(client, ledger, model_routes, cache=check_cache) if typo_batch else None
+    window = window or max(len(image_groups), 1)
+    records = iter(image_groups.items())
+    pending = set()
+
+    def fill_window():
+        if cancel_token is not None and cancel_token.cancelled:
+            return
+        for name, data in records:
+            pending.add(asyncio.ensure_future(process_single_record_async(
+                name,
+                data,
+                selected_product_code,
+                creds_info,
+                client,
+                semaphore,
+                neng_content_map,
+                ledger,
+                tracer,
+                downloader,
+                vision_batch,
+                model_routes,
+                typo_batcher,
+                check_cache,
+                thumbnails,
+                image_processor,
+                admission
+            )))
+            if len(pending) >= window:
+                break
+
+    results = []
+    completed = 0
+    watcher = asyncio.ensure_future(cancel_token.wait()) if cancel_token is not None else None
+    fill_window()
+    try:
+        # 完了したものから順次処理
+        while pending:
+            done, _ = await asyncio.wait(pending | {watcher} if watcher is not None else pending, return_when=asyncio.FIRST_COMPLETED)
+            pending -= done
+            for task in done:
+                if task is watcher:
+                    continue
+                completed += 1
+                try:
+                    result = task.result()
+                    # 完了したレコードを呼び出し元に通知 (途中結果の表示用)
+                    if on_result:
+                        on_result(result)
+                    else:
+                        results.append(result)
+                except Exception as e:
+                    if on_error:
+                        on_error(e)
+                    else:
+                        print(f"非同期処理中にエラーが発生しました: {e}")
+                finally:
+                    # プログレスバーを更新
+                    if progress_bar is not None:
+                        progress_bar.progress(completed / total_records, text=f"2. OCR実行中... ({completed}/{total_records})")
+            if watcher is not None and watcher in done:
+                break
+            fill_window()
+    finally:
+        # 中止された場合は未完了のレコードをキャンセルし、取得・API呼び出しの待ちをすぐに手放す
+        leftover = list(pending) + ([watcher] if watcher is not None else [])
+        for task in leftover:
+            task.cancel()
+        await asyncio.gather(*leftover, return_exceptions=True)
+    return results
+
+
+class RecordJob:
+    """ステージ間で受け渡す1レコード分の途中結果"""
+    __slots__ = ("image_name", "portals", "started", "start_wall_ns", "downloaded", "failed", "unique_images", "ocr_results", "all_identical")
+
+    def __init__(self, image_name, portals):
+        self.image_name = image_name
+        self.portals = portals
+        self.started = time.perf_counter()
+        self.start_wall_ns = time.time_ns()
+        self.downloaded = None # download の結果 (画像データ)
+        self.failed = None # preprocess の結果
+        self.unique_images = None
+        self.ocr_results = None # vision の結果
+        self.all_identical = False
+
+async def staged_async_runner(image_groups, selected_product_code, creds_info, client, progress_bar, total_records, neng_content_map, on_result=None, ledger=None, tracer=NOOP_TRACER, downloader=download_drive_image_sync, on_error=None, stage_workers=None, queue_size=STAGE_QUEUE_SIZE, vision_batch=False, model_routes=None, typo_batch=False, check_cache=None, thumbnails=False, image_processor=None, cancel_token=None, admission=None, window=None):
+    """
+    main_async_runner と同じ処理を、取得 → 前処理 → OCR → チェック のステージに分けて実行する。
+    各ステージは stage_workers で指定した数のワーカーで並行に処理し、ステージ間は上限付きのキューでつなぐ。
+    レコードは次のステージに渡した時点で前のステージの枠を空けるため、取得・OCR・チェックを別々の並列度で重ねて実行できる。
+    ステージ別のスループット・キューの長さは tracer.pipeline_stats に記録する。
+    admission を渡した場合、レコードは取得の前にサーバー全体の枠を取得し、チェックの完了 (またはエラー・中止) で返却する。
+    window を渡した場合、処理中 (投入済みで未完了) のレコードをその数までに制限する (分割実行)。
+    """
+    workers = dict(DEFAULT_STAGE_WORKERS, **(stage_workers or {}))
+    typo_batcher = TypoBatcher(client, ledger, model_routes, cache=check_cache) if typo_batch else None
+
+    admitted = set() # 枠を取得済みのレコード (中止時にまとめて返却する)
+
+    def release_admission(job):
+        if job in admitted:
+            admitted.discard(job)
+            admission.release()
+
+    async def download(job):
+        if admission is not None:
+            with tracer.span("queue_wait", job.image_name):
+                await admission.acquire()
+            admitted.add(job)
+        job.downloaded = await download_record_images_async(job.portals, creds_info, tracer, job.image_name, downloader)
+        return job
+
+    async def preprocess(job):
+        # CPU処理はイベントループの外 (image_processor があればプロセスプール、なければスレッドプール) で実行する
+        job.failed, job.unique_images = await preprocess_record_images_async(job.portals, job.downloaded, image_processor, thumbnails)
+        job.downloaded = None
+        return job
+
+    async def vision(job):
+        job.ocr_results, job.all_identical = await ocr_unique_images_async(
+            job.portals, job.failed, job.unique_images, client, ledger, tracer, job.image_name, vision_batch, check_cache
+        )
+        job.unique_images = None
+        return job
+
+    async def checks(job):
+        try:
+            result = await check_record_async(
+                job.image_name, job.ocr_results, job.all_identical, selected_product_code, client, neng_content_map,
+                ledger, tracer, model_routes, typo_batcher, check_cache, thumbnails and image_processor is None
+            )
+        finally:
+            release_admission(job)
+        tracer.add_span("record", job.image_name, job.started, job.start_wall_ns)
+        return result
+
+    pipeline = StagedPipeline([
+        ("download", download, workers["download"]),
+        ("preprocess", preprocess, workers["preprocess"]),
+        ("vision", vision, workers["vision"]),
+        ("checks", checks, workers["checks"]),
+    ], queue_size=queue_size, max_in_flight=window)
+
+    results = []
+    completed = {"count": 0}
+
+    def update_progress():
+        completed["count"] += 1
+        if progress_bar is not None:
+            progress_bar.progress(completed["count"] / total_records, text=f"2. OCR実行中... ({completed['count']}/{total_records})")
+
+    def handle_output(result):
+        # 完了したレコードを呼び出し元に通知 (途中結果の表示用。例外は handle_error に渡る)
+        if on_result:
+            on_result(result)
+        else:
+            results.append(result)
+        update_progress()
+
+    def handle_error(job, e):
+        release_admission(job)
+        if on_error:
+            on_error(e)
+        else:
+            print(f"非同期処理中にエラーが発生しました: {e}")
+        update_progress()
+
+    # レコードは先頭のキューに空きができた分だけ作成される
+    jobs = (RecordJob(name, data['portals']) for name, data in image_groups.items())
+    try:
+        await pipeline.run(jobs, handle_output, handle_error, cancel_token)
+    finally:
+        for job in list(admitted):
+            release_admission(job)
+        if tracer.enabled:
+            tracer.pipeline_stats = pipeline.stats()
+    return results
+
+
+def record_from_result(result, image_groups):
+    """process_single_record_async の戻り値から OcrRecord を作成する"""
+    image_name, ocr_results, volume_results, image_bytes, typo_result, neng_content, comparison_result, text_comparison_result, rec_in, rec_out = result
+
+    portal_file_ids = {
+        p_name: p_data['id'] for p_name, p_data in image_groups.get(image_name, {}).get('portals', {}).items()
+    }
+    return make_record(
+        image_name, portal_file_ids, ocr_results, volume_results, image_bytes,
+        typo_result, neng_content, comparison_result, text_comparison_result
+    )
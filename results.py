@@ -0,0 +1,271 @@
+import base64
+import io
+import pandas as pd
+
+# === OCR結果ストア (results.py) ===
+# 1レコード = 1画像名。収集中は __slots__ 付きのレコードで保持し、
+# ストア内部では列ごとのリスト（列指向）として蓄積する。
+# 表示用HTML・スプレッドシート用の値・検索用の平文は、必要になった時点で列から生成する。
+
+CHECK_COLUMNS = ["テキスト比較", "誤字脱字", "NENG内容量", "内容量比較", "エラー検出"]
+
+# 大量の画像を処理する場合は、画像データの代わりに表示用の縮小画像 (JPEG) を保持する
+THUMBNAIL_MAX_SIZE = (400, 200) # 表示は高さ100pxのため、高解像度の画面でも粗くならない大きさ
+THUMBNAIL_QUALITY = 75
+
+
+def build_ordered_columns(portal_names):
+    """DataFrameの列順（No列を除く）を返す"""
+    ordered_columns = ["画像名", "ステータス"]
+    for p in portal_names:
+        ordered_columns.extend([f"{p}（画像）", f"{p}（OCR）", f"{p}（内容量）"])
+    ordered_columns.extend(CHECK_COLUMNS)
+    return ordered_columns
+
+
+class OcrRecord:
+    """1画像名分のOCR結果 (収集用の軽量レコード)"""
+    __slots__ = (
+        "image_name", "status", "portal_values", "image_bytes",
+        "text_comparison", "typo", "neng_content", "volume_comparison", "error_detection",
+    )
+
+    def __init__(self, image_name, status, portal_values, image_bytes,
+                 text_comparison, typo, neng_content, volume_comparison, error_detection):
+        self.image_name = image_name
+        self.status = status
+        self.portal_values = portal_values # {portal_name: (画像URL, OCRテキスト, 内容量)} ※ファイルがないポータルは含めない
+        self.image_bytes = image_bytes # {portal_name: bytes}
+        self.text_comparison = text_comparison
+        self.typo = typo
+        self.neng_content = neng_content
+        self.volume_comparison = volume_comparison
+        self.error_detection = error_detection
+
+
+def make_record(image_name, portal_file_ids, ocr_results, volume_results, image_bytes,
+                typo_result, neng_content, comparison_result, text_comparison_result):
+    """
+    1レコード分の処理結果からステータスとエラー検出を判定し、OcrRecord を作成する。
+    portal_file_ids は {portal_name: file_id}（対象画像が存在するポータルのみ）。
+    """
+    image_acquisition_failed = any(
+        "画像取得失敗" in ocr_results.get(portal_name, "") for portal_name in portal_file_ids
+    )
+
+    ocr_failed_for_existing_image = False
+    if not image_acquisition_failed:
+        for portal_name in portal_file_ids:
+            img_exists = image_bytes.get(portal_name) is not None
+            ocr_result_text = ocr_results.get(portal_name, "")
+            if img_exists and (not ocr_result_text or "APIエラー" in ocr_result_text or "AI OCRエラー" in ocr_result_text):
+                ocr_failed_for_existing_image = True
+                break
+
+    error_detection_message = ""
+    if image_acquisition_failed:
+        error_detection_message = "画像読み込み失敗あり"
+    elif ocr_failed_for_existing_image:
+        error_detection_message = "テキスト検出失敗あり"
+
+    is_error = (
+        "差分あり" in text_comparison_result or
+        "OK！" not in typo_result or
+        "要確認" in comparison_result or
+        error_detection_message != ""
+    )
+    status = "要確認" if is_error else "異常なし"
+
+    portal_values = {}
+    for portal_name, file_id in portal_file_ids.items():
+        extracted_text = ocr_results.get(portal_name)
+        extracted_volume = volume_results.get(portal_name)
+        correct_image_url = f"https://drive.google.com/file/d/{file_id}/view"
+        cleaned_volume = extracted_volume.strip().strip('"') if extracted_volume else ""
+        portal_values[portal_name] = (correct_image_url, extracted_text if extracted_text else "", cleaned_volume)
+
+    cleaned_neng_content = neng_content.strip().strip('"') if neng_content else ""
+
+    return OcrRecord(
+        image_name, status, portal_values, image_bytes,
+        text_comparison_result, typo_result, cleaned_neng_content, comparison_result, error_detection_message,
+    )
+
+
+def make_thumbnail(image_bytes):
+    """表示用の縮小画像 (JPEG) を作成する。画像として読めない場合は None"""
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail(THUMBNAIL_MAX_SIZE)
+            buffer = io.BytesIO()
+            img.convert("RGB").save(buffer, format="JPEG", quality=THUMBNAIL_QUALITY)
+            return buffer.getvalue()
+    except Exception:
+        return None
+
+
+def make_thumbnails(image_bytes_data):
+    """
+    {ポータル名: bytes} の各画像を縮小画像に置き換えた辞書を返す。
+    縮小できない画像は空のバイト列にする (画像を取得できたことはエラー検出の判定に使うため、キーは残す)。
+    """
+    return {portal_name: make_thumbnail(img_bytes) or b"" for portal_name, img_bytes in image_bytes_data.items()}
+
+
+# --- 表示用HTMLの生成 (1セル単位) ---
+
+def _color_span(text, color):
+    return f'<span style="color: {color};">{text}</span>'
+
+def _status_html(value):
+    return _color_span(value, "red" if value == "要確認" else "blue")
+
+def _text_comparison_html(value):
+    if value == "OK！":
+        return _color_span(value, "blue")
+    elif value == "差分あり":
+        return _color_span(value, "red")
+    return _color_span(value, "gray")
+
+def _typo_html(value):
+    if value == "OK！":
+        return _color_span(value, "blue")
+    return _color_span(value.replace('\n', '<br>'), "red")
+
+def _volume_comparison_html(value):
+    display_text = value.replace('\n', '<br>')
+    if value == "OK！":
+        return _color_span(display_text, "blue")
+    elif "要確認" in value:
+        return _color_span(display_text, "red")
+    elif value == "内容量記載なし":
+        return _color_span(display_text, "gray")
+    return display_text
+
+def _error_detection_html(value):
+    return _color_span(value, "red") if value else ""
+
+def _image_html(url, img_bytes):
+    if not img_bytes:
+        return ""
+    mime_type = "image/jpeg" if img_bytes[:2] == b"\xff\xd8" else "image/png"
+    return f'<a href="{url}" target="_blank"><img src="data:{mime_type};base64,{base64.b64encode(img_bytes).decode()}" style="max-height: 100px; display: block; margin: auto;"></a>'
+
+def _br(value):
+    return value.replace('\n', '<br>') if value else ""
+
+
+class OcrResultStore:
+    """
+    OCR結果の列指向ストア。
+    append() でレコードを列ごとに蓄積し、excel_frame() / display_frame() / plain_frame()
+    で用途別のDataFrameを遅延生成する（excel・plain の生成結果はレコード追加までキャッシュ。
+    display は表示する行だけを都度生成する）。
+    """
+
+    def __init__(self, portal_names):
+        self.portal_names = list(portal_names)
+        self.columns = build_ordered_columns(self.portal_names)
+        self._data = {col: [] for col in self.columns}
+        self._image_bytes = {p: [] for p in self.portal_names}
+        self._views = {}
+
+    def __len__(self):
+        return len(self._data["画像名"])
+
+    def append(self, record):
+        """レコードを列に追加する"""
+        data = self._data
+        data["画像名"].append(record.image_name)
+        data["ステータス"].append(record.status)
+        for portal_name in self.portal_names:
+            values = record.portal_values.get(portal_name)
+            if values is None:
+                values = ("", "", "")
+            data[f"{portal_name}（画像）"].append(values[0])
+            data[f"{portal_name}（OCR）"].append(values[1])
+            data[f"{portal_name}（内容量）"].append(values[2])
+            self._image_bytes[portal_name].append(record.image_bytes.get(portal_name))
+        data["テキスト比較"].append(record.text_comparison)
+        data["誤字脱字"].append(record.typo)
+        data["NENG内容量"].append(record.neng_content)
+        data["内容量比較"].append(record.volume_comparison)
+        data["エラー検出"].append(record.error_detection)
+        self._views.clear()
+
+    def _order(self):
+        """画像名順の行インデックス"""
+        if "order" not in self._views:
+            names = self._data["画像名"]
+            self._views["order"] = sorted(range(len(names)), key=names.__getitem__)
+        return self._views["order"]
+
+    def _frame(self, columns):
+        order = self._order()
+        df = pd.DataFrame({col: [values[i] for i in order] for col, values in columns.items()})
+        df.insert(0, "No", range(1, len(df) + 1))
+        return df
+
+    def excel_frame(self):
+        """スプレッドシート保存用 (元の値) のDataFrame"""
+        if "excel" not in self._views:
+            self._views["excel"] = self._frame(self._data)
+        return self._views["excel"]
+
+    def display_frame(self, rows=None):
+        """
+        画面表示用 (HTML) のDataFrame。rows は画像名順の行番号 (excel_frame / plain_frame の index) のリストで、
+        指定した行だけ HTML (画像の Base64 を含む) を生成する。表示するページ分だけを渡すこと (キャッシュしない)。
+        """
+        order = self._order()
+        rows = list(range(len(order))) if rows is None else list(rows)
+        indices = [order[r] for r in rows]
+        data = self._data
+
+        def pick(col):
+            return [data[col][i] for i in indices]
+
+        columns = {
+            "画像名": pick("画像名"),
+            "ステータス": [_status_html(v) for v in pick("ステータス")],
+        }
+        for portal_name in self.portal_names:
+            img_col = f"{portal_name}（画像）"
+            image_bytes = self._image_bytes[portal_name]
+            columns[img_col] = [_image_html(data[img_col][i], image_bytes[i]) for i in indices]
+            columns[f"{portal_name}（OCR）"] = [_br(v) for v in pick(f"{portal_name}（OCR）")]
+            columns[f"{portal_name}（内容量）"] = [_br(v) for v in pick(f"{portal_name}（内容量）")]
+        columns["テキスト比較"] = [_text_comparison_html(v) for v in pick("テキスト比較")]
+        columns["誤字脱字"] = [_typo_html(v) for v in pick("誤字脱字")]
+        columns["NENG内容量"] = [_br(v) for v in pick("NENG内容量")]
+        columns["内容量比較"] = [_volume_comparison_html(v) for v in pick("内容量比較")]
+        columns["エラー検出"] = [_error_detection_html(v) for v in pick("エラー検出")]
+        df = pd.DataFrame(columns, index=rows)
+        df.insert(0, "No", [r + 1 for r in rows])
+        return df
+
+    def plain_frame(self):
+        """全文検索用の平文DataFrame (画像列は検索対象外のため空文字)"""
+        if "plain" not in self._views:
+            empty = [""] * len(self)
+            columns = {
+                col: (empty if col.endswith("（画像）") else values)
+                for col, values in self._data.items()
+            }
+            self._views["plain"] = self._frame(columns)
+        return self._views["plain"]
+
+    def image_bytes(self):
+        """{画像名: {ポータル名: bytes}} 形式の画像データ"""
+        result = {}
+        for i, image_name in enumerate(self._data["画像名"]):
+            result[image_name] = {
+                p: self._image_bytes[p][i] for p in self.portal_names if self._image_bytes[p][i] is not None
+            }
+        return result
+
+    def to_arrow(self):
+        """保存用に Arrow テーブル (画像バイナリを除く) へ変換する"""
+        import pyarrow as pa
+        return pa.Table.from_pandas(self.excel_frame(), preserve_index=False)
@@ -0,0 +1,78 @@
+import json
+
+# === ステージ別のモデル振り分け (routing.py) ===
+# 二次チェック (誤字脱字・テキスト比較・内容量比較) は、まず軽量モデルで判定し、
+# 結果が不確かな場合のみ強いモデル (GPT-4o) で判定し直す。
+
+# 軽量モデルに確信度を答えさせるための追記 (強いモデルへの再判定では付けない)
+CONFIDENCE_INSTRUCTION = """
+
+### 確信度
+応答のJSONには、判定の確信度を "confidence" キーに 0〜1 の数値で必ず含めてください。
+判断に迷う場合は低い値にしてください。"""
+
+# 複数レコードをまとめて判定する場合の追記 (レコードごとに確信度を答えさせる)
+BATCH_CONFIDENCE_INSTRUCTION = """
+
+### 確信度
+各レコードの結果のJSONには、判定の確信度を "confidence" キーに 0〜1 の数値で必ず含めてください。
+判断に迷う場合は低い値にしてください。"""
+
+# 昇格 (強いモデルでの再判定) の理由
+ESCALATION_REASONS = {
+    "schema": "応答形式の不正",
+    "low_confidence": "確信度が低い",
+    "flagged": "エラー指摘あり",
+}
+
+
+class ModelRoute:
+    """1ステージ分の振り分け設定"""
+    __slots__ = ("primary", "escalation", "min_confidence", "escalate_on_flag")
+
+    def __init__(self, primary, escalation="gpt-4o", min_confidence=0.8, escalate_on_flag=True):
+        self.primary = primary # 最初に使うモデル
+        self.escalation = escalation # 不確かな場合に使うモデル
+        self.min_confidence = min_confidence # これ未満の確信度は昇格
+        self.escalate_on_flag = escalate_on_flag # エラー指摘 (誤字あり・差分あり等) は強いモデルで確認する
+
+
+# ステージ -> ModelRoute (ここにないステージは従来どおり GPT-4o のみ)
+# 画像OCR (vision) は精度への影響が大きいため振り分けの対象外
+DEFAULT_MODEL_ROUTES = {
+    "typo": ModelRoute("gpt-4o-mini"),
+    "text_compare": ModelRoute("gpt-4o-mini"),
+    "volume_compare": ModelRoute("gpt-4o-mini"),
+}
+
+# ステージ -> (応答JSONの判定キー, 正常な値, エラー指摘を表す値)
+STAGE_SCHEMAS = {
+    "typo": ("status", ("ok", "error"), "error"),
+    "text_compare": ("result", ("ok", "ng"), "ng"),
+    "volume_compare": ("result", ("ok", "ng"), "ng"),
+}
+
+
+def escalation_reason(stage, route, response_str):
+    """軽量モデルの応答を確認し、昇格が必要ならその理由 (ESCALATION_REASONS のキー) を返す"""
+    try:
+        result_json = json.loads(response_str)
+    except (json.JSONDecodeError, TypeError):
+        return "schema"
+    if not isinstance(result_json, dict):
+        return "schema"
+
+    key, valid_values, flag_value = STAGE_SCHEMAS[stage]
+    if result_json.get(key) not in valid_values:
+        return "schema"
+
+    try:
+        confidence = float(result_json.get("confidence"))
+    except (TypeError, ValueError):
+        return "low_confidence" # 確信度の記載がない場合も不確かとみなす
+    if confidence < route.min_confidence:
+        return "low_confidence"
+
+    if route.escalate_on_flag and result_json.get(key) == flag_value:
+        return "flagged"
+    return None
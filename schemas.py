@@ -0,0 +1,119 @@
+import json
+from functools import cache
+from typing import Literal
+
+from pydantic import BaseModel, ValidationError
+
+# === APIの応答スキーマ (schemas.py) ===
+# 画像OCR・誤字脱字・テキスト比較・内容量比較の応答を Pydantic モデルで定義し、
+# OpenAI の Structured Outputs (JSONスキーマ指定・strict) でこの形式の応答だけを返させる。
+# スキーマに沿わない応答 (拒否・途中で打ち切られた応答など) は違反として数え、呼び出し元は従来の解析に戻す。
+
+
+class VisionResult(BaseModel):
+    full_text: str
+    volume_text: str
+
+
+class LabeledVisionResult(VisionResult):
+    label: str # 画像の直前に付けたラベル (image_1 など)
+
+
+class VisionBatchResult(BaseModel):
+    images: list[LabeledVisionResult]
+
+
+class TypoResult(BaseModel):
+    status: Literal["ok", "error"]
+    message: str # エラーがない場合は空文字
+    affected_sources: list[str]
+
+
+class LabeledTypoResult(TypoResult):
+    label: str # レコードのラベル (R1 など)
+
+
+class TypoBatchResult(BaseModel):
+    results: list[LabeledTypoResult]
+
+
+class TextCompareResult(BaseModel):
+    result: Literal["ok", "ng"]
+
+
+class VolumeCompareResult(BaseModel):
+    result: Literal["ok", "ng"]
+    deviant_sources: list[str] # ok の場合は空のリスト
+
+
+# --- 軽量モデルで判定する場合 (routing.py) は確信度も答えさせる ---
+class ConfidentTypoResult(TypoResult):
+    confidence: float
+
+
+class ConfidentLabeledTypoResult(LabeledTypoResult):
+    confidence: float
+
+
+class ConfidentTypoBatchResult(BaseModel):
+    results: list[ConfidentLabeledTypoResult]
+
+
+class ConfidentTextCompareResult(TextCompareResult):
+    confidence: float
+
+
+class ConfidentVolumeCompareResult(VolumeCompareResult):
+    confidence: float
+
+
+# ステージ -> (通常の応答モデル, 確信度付きの応答モデル)
+STAGE_RESPONSE_MODELS = {
+    "typo": (TypoResult, ConfidentTypoResult),
+    "text_compare": (TextCompareResult, ConfidentTextCompareResult),
+    "volume_compare": (VolumeCompareResult, ConfidentVolumeCompareResult),
+}
+
+
+def _make_strict(node):
+    """strict モードの制約 (全プロパティ必須・追加プロパティ禁止) をスキーマ全体に適用する"""
+    if isinstance(node, dict):
+        if node.get("type") == "object" and "properties" in node:
+            node["additionalProperties"] = False
+            node["required"] = list(node["properties"])
+        for value in node.values():
+            _make_strict(value)
+    elif isinstance(node, list):
+        for value in node:
+            _make_strict(value)
+
+
+@cache
+def response_format(model):
+    """chat.completions.create の response_format に渡す値 (モデルごとに1回だけ生成する)"""
+    schema = model.model_json_schema()
+    _make_strict(schema)
+    return {"type": "json_schema", "json_schema": {"name": model.__name__, "strict": True, "schema": schema}}
+
+
+def is_api_error_response(response_str):
+    """API呼び出し関数が返すエラー応答 ({"error": ...} / {"status": "api_error", ...}) かどうか"""
+    try:
+        data = json.loads(response_str)
+    except (json.JSONDecodeError, TypeError):
+        return False
+    return isinstance(data, dict) and ("error" in data or data.get("status") == "api_error")
+
+
+def parse_structured(model, response_str, ledger=None, stage=""):
+    """
+    応答テキストをモデルで検証する (json.loads を介さず pydantic-core で直接検証)。
+    スキーマに沿っていればモデルのインスタンス、沿っていなければ None を返し、違反を台帳に記録する。
+    APIエラーの応答は違反として数えない。
+    """
+    try:
+        return model.model_validate_json(response_str)
+    except ValidationError:
+        if ledger is not None and not is_api_error_response(response_str):
+            ledger.record_schema_violation(stage)
+        return None
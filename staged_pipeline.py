@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+import pandas as pd
+
+from tracing import SPAN_LABELS
+
+# === ステージ分割の実行基盤 (staged_pipeline.py) ===
+# 処理をステージ (取得 → 前処理 → OCR → チェック) に分け、ステージ間を上限付きの asyncio.Queue でつなぐ。
+# ワーカー数はステージごとに設定でき、後段が詰まると前段の put が待たされる (バックプレッシャー) ため、
+# 処理途中のデータ量 (画像データなど) は キューの上限 × ステージ数 程度に収まる。
+# ステージごとの処理件数・スループット・稼働率・キューの長さを記録する。
+# CancelToken で実行を途中で中止できる (新しい項目の投入をやめ、処理中の項目もキャンセルする)。
+
+
+class CancelToken:
+    """
+    実行の中止要求 (スレッドセーフ)。cancel() は別スレッドからも呼べる。
+    実行側は cancelled を確認するか、wait() で中止要求を待つ。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._waiters = [] # (イベントループ, asyncio.Event)
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="中止"):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass # イベントループが終了済み
+
+    async def wait(self):
+        """中止要求があるまで待つ"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._waiters.append(waiter)
+        try:
+            await waiter[1].wait()
+        finally:
+            with self._lock:
+                self._waiters.remove(waiter)
+
+
+class PipelineStage:
+    """ステージ1つ分の処理関数・ワーカー数・入力キューと計測値"""
+
+    def __init__(self, name, handler, workers, queue_size):
+        self.name = name
+        self.handler = handler # async def handler(item) -> 次のステージに渡す値 (None は渡さない)
+        self.workers = workers
+        self.queue = asyncio.Queue(queue_size)
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0 # ワーカーが処理していた時間の合計
+        self.max_depth = 0
+        self._depth_total = 0
+        self._depth_samples = 0
+        self.first_start = None
+        self.last_end = None
+
+    async def put(self, item):
+        await self.queue.put(item)
+        depth = self.queue.qsize()
+        self.max_depth = max(self.max_depth, depth)
+        self._depth_total += depth
+        self._depth_samples += 1
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def mean_depth(self):
+        return self._depth_total / self._depth_samples if self._depth_samples else 0.0
+
+    def stats(self):
+        elapsed = (self.last_end - self.first_start) if self.first_start is not None and self.last_end is not None else 0.0
+        return {
+            "ステージ": SPAN_LABELS.get(self.name, self.name),
+            "ワーカー数": self.workers,
+            "処理件数": self.processed,
+            "エラー": self.errors,
+            "スループット(件/秒)": round(self.processed / elapsed, 2) if elapsed else 0.0,
+            "稼働率": round(self.busy_seconds / (elapsed * self.workers), 3) if elapsed else 0.0,
+            "平均キュー長": round(self.mean_depth(), 1),
+            "最大キュー長": self.max_depth,
+            "キュー上限": self.queue.maxsize,
+        }
+
+
+class StagedPipeline:
+    """
+    stages は [(ステージ名, handler, ワーカー数)] (先頭から順に実行)。
+    run() に渡した各項目は全ステージを順に通過し、最後のステージの戻り値が on_output に渡される。
+    途中のステージで例外が発生した項目は on_error に渡され、以降のステージには進まない。
+    cancel_token が中止されると、残りの項目は投入せず、処理中の項目はキャンセルして (on_error には渡さない) 終了する。
+    max_in_flight を指定すると、投入済みで完了していない項目 (キュー内・処理中) をその数までに制限する
+    (完了・エラーになった分だけ次の項目を投入する)。
+    """
+
+    def __init__(self, stages, queue_size=32, max_in_flight=None):
+        self.stages = [PipelineStage(name, handler, workers, queue_size) for name, handler, workers in stages]
+        self.max_in_flight = max_in_flight
+        self.cancelled = False
+        self._in_flight = None # run() の中で作成する (イベントループごと)
+
+    async def _worker(self, index, on_output, on_error):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = await stage.queue.get()
+            started = time.perf_counter()
+            if stage.first_start is None:
+                stage.first_start = started
+            try:
+                output = await stage.handler(item)
+            except Exception as e:
+                stage.errors += 1
+                on_error(item, e)
+                output = None
+            else:
+                stage.processed += 1
+            finally:
+                stage.last_end = time.perf_counter()
+                stage.busy_seconds += stage.last_end - started
+
+            passed_on = False
+            try:
+                if output is not None:
+                    if next_stage is not None:
+                        await next_stage.put(output) # 後段のキューが満杯ならここで待つ
+                        passed_on = True
+                    else:
+                        on_output(output)
+            except Exception as e:
+                on_error(item, e)
+            finally:
+                if not passed_on and self._in_flight is not None:
+                    self._in_flight.release() # この項目はパイプラインを出た (完了・エラー・後段に渡さない)
+                stage.queue.task_done()
+
+    async def _feed_and_join(self, items, cancel_token):
+        for item in items:
+            if cancel_token is not None and cancel_token.cancelled:
+                return
+            if self._in_flight is not None:
+                await self._in_flight.acquire()
+            await self.stages[0].put(item)
+        # 前段から順に、キューが空になり処理中の項目もなくなるのを待つ
+        for stage in self.stages:
+            await stage.queue.join()
+
+    async def run(self, items, on_output, on_error, cancel_token=None):
+        self._in_flight = asyncio.Semaphore(self.max_in_flight) if self.max_in_flight else None
+        workers = [
+            [asyncio.create_task(self._worker(index, on_output, on_error)) for _ in range(stage.workers)]
+            for index, stage in enumerate(self.stages)
+        ]
+        feeder = asyncio.ensure_future(self._feed_and_join(items, cancel_token))
+        watcher = asyncio.ensure_future(cancel_token.wait()) if cancel_token is not None else None
+        try:
+            done, _ = await asyncio.wait([task for task in (feeder, watcher) if task is not None], return_when=asyncio.FIRST_COMPLETED)
+            if feeder in done:
+                feeder.result()
+            else:
+                self.cancelled = True
+        finally:
+            tasks = [task for task in (feeder, watcher) if task is not None]
+            tasks += [task for stage_workers in workers for task in stage_workers]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        """ステージ別の処理件数・スループット・稼働率・キューの長さ"""
+        return pd.DataFrame([stage.stats() for stage in self.stages])
@@ -0,0 +1,197 @@
+import threading
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+# === 処理段階ごとの計測 (tracing.py) ===
+# レコード単位・ステージ単位のスパン (開始/終了時刻) を記録し、
+# レイテンシのパーセンタイルと同時実行数を集計する。
+# OpenTelemetry がインストールされている場合は、記録したスパンをそのまま送信できる。
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError: # オプション依存
+    otel_trace = None
+
+# 計測区間 (スパン) の表示名 (使用量ログのステージ名は usage.STAGE_LABELS。ログの解析に使うため別の表にする)
+SPAN_LABELS = {
+    "neng": "NENG取得",
+    "record": "レコード全体",
+    "queue_wait": "同時実行枠の待ち",
+    "download": "Drive画像取得",
+    "preprocess": "前処理 (同一画像の判定)",
+    "vision": "画像OCR (Vision)",
+    "typo": "誤字脱字チェック",
+    "text_compare": "テキスト比較",
+    "volume_compare": "内容量比較",
+    "checks": "二次チェック",
+    "assemble": "結果テーブル作成",
+    "sheets_export": "スプレッドシート保存",
+}
+
+
+class Span:
+    """計測区間1つ分"""
+    __slots__ = ("name", "record", "start", "end", "start_wall_ns")
+
+    def __init__(self, name, record, start, end, start_wall_ns):
+        self.name = name
+        self.record = record # 画像名 (レコードに紐づかない場合は None)
+        self.start = start # perf_counter (秒)
+        self.end = end
+        self.start_wall_ns = start_wall_ns # エクスポート用のUNIX時刻 (ナノ秒)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def percentile(sorted_values, q):
+    """ソート済みリストのパーセンタイル (線形補間)"""
+    if not sorted_values:
+        return 0.0
+    pos = (len(sorted_values) - 1) * q
+    lower = int(pos)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (pos - lower)
+
+
+def peak_concurrency(spans):
+    """スパンの開始・終了時刻から最大同時実行数を求める (add_span で後から記録した区間も含む)"""
+    events = []
+    for s in spans:
+        events.append((s.start, 1))
+        events.append((s.end, -1))
+    events.sort() # 同時刻は終了 (-1) を先に数える
+    current = peak = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    return peak
+
+
+class OpenTelemetryExporter:
+    """記録済みのスパンを OpenTelemetry のトレーサーへ送信する (opentelemetry インストール時のみ)"""
+
+    def __init__(self, service_name="product-image-ocr"):
+        if otel_trace is None:
+            raise ImportError("opentelemetry がインストールされていません。")
+        self._tracer = otel_trace.get_tracer(service_name)
+
+    def export(self, run_id, spans, origin_perf, origin_wall_ns):
+        root = self._tracer.start_span("ocr_run", start_time=origin_wall_ns, attributes={"ocr.run_id": run_id})
+        context = otel_trace.set_span_in_context(root)
+        last_end_ns = origin_wall_ns
+        for s in spans:
+            end_ns = s.start_wall_ns + int(s.duration * 1e9)
+            child = self._tracer.start_span(s.name, context=context, start_time=s.start_wall_ns)
+            if s.record is not None:
+                child.set_attribute("ocr.image_name", s.record)
+            child.end(end_time=end_ns)
+            last_end_ns = max(last_end_ns, end_ns)
+        root.end(end_time=last_end_ns)
+
+
+class Tracer:
+    """
+    スパンの記録と集計を行うトレーサー (1回の実行につき1つ)。
+    同期・非同期どちらの処理も with tracer.span("stage", record=画像名): で計測できる。
+    """
+
+    def __init__(self, run_id="", exporter=None, enabled=True):
+        self.run_id = run_id
+        self.exporter = exporter
+        self.enabled = enabled
+        self._spans = []
+        self._lock = threading.Lock()
+        self._origin_perf = time.perf_counter()
+        self._origin_wall_ns = time.time_ns()
+        self.pipeline_stats = None # ステージ分割で実行した場合の、ステージ別のスループット・キュー長 (DataFrame)
+
+    @contextmanager
+    def span(self, name, record=None):
+        if not self.enabled:
+            yield
+            return
+        start_wall_ns = time.time_ns()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self._spans.append(Span(name, record, start, end, start_wall_ns))
+
+    def add_span(self, name, record, start, start_wall_ns):
+        """with で囲めない区間 (複数のステージにまたがるレコード全体など) を、start から現在までのスパンとして記録する"""
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        with self._lock:
+            self._spans.append(Span(name, record, start, end, start_wall_ns))
+
+    async def traced(self, name, coro, record=None):
+        """コルーチンを計測しながら実行する (asyncio.gather に渡す用)"""
+        with self.span(name, record):
+            return await coro
+
+    def export(self):
+        """エクスポーターが設定されていれば、記録済みのスパンを送信する"""
+        if not self.exporter or not self._spans:
+            return
+        try:
+            self.exporter.export(self.run_id, list(self._spans), self._origin_perf, self._origin_wall_ns)
+        except Exception as e:
+            print(f"トレースの送信に失敗しました: {e}")
+
+    # --- 集計 ---
+
+    def wall_time(self):
+        with self._lock:
+            if not self._spans:
+                return 0.0
+            return max(s.end for s in self._spans) - min(s.start for s in self._spans)
+
+    def stage_stats(self):
+        """ステージ別の件数・合計・p50/p95/p99・最大・最大同時実行数"""
+        with self._lock:
+            spans_by_stage = {}
+            for s in self._spans:
+                spans_by_stage.setdefault(s.name, []).append(s)
+
+        rows = []
+        for name, spans in spans_by_stage.items():
+            values = sorted(s.duration for s in spans)
+            rows.append({
+                "ステージ": SPAN_LABELS.get(name, name),
+                "件数": len(values),
+                "合計(秒)": round(sum(values), 2),
+                "p50(秒)": round(percentile(values, 0.50), 2),
+                "p95(秒)": round(percentile(values, 0.95), 2),
+                "p99(秒)": round(percentile(values, 0.99), 2),
+                "最大(秒)": round(values[-1], 2),
+                "最大同時実行数": peak_concurrency(spans),
+            })
+        return pd.DataFrame(rows)
+
+    def slowest_records(self, limit=5):
+        """処理時間の長いレコード (record スパン) の上位"""
+        with self._lock:
+            records = [s for s in self._spans if s.name == "record"]
+        records.sort(key=lambda s: s.duration, reverse=True)
+        return pd.DataFrame(
+            [{"画像名": s.record, "処理時間(秒)": round(s.duration, 2)} for s in records[:limit]]
+        )
+
+
+def get_default_exporter():
+    """OpenTelemetry が利用可能ならエクスポーターを返す (未インストール時は None)"""
+    if otel_trace is None:
+        return None
+    try:
+        return OpenTelemetryExporter()
+    except Exception:
+        return None
+
+
+NOOP_TRACER = Tracer(enabled=False)
@@ -0,0 +1,189 @@
+import threading
+import pandas as pd
+
+from routing import ESCALATION_REASONS
+
+# === トークン使用量・コストの集計 (usage.py) ===
+
+# モデルごとの料金 (USD / 100万トークン): (入力, 出力)
+PRICING_USD_PER_MILLION = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+DEFAULT_MODEL_FOR_PRICING = "gpt-4o" # 料金表にないモデルはこの料金で概算する
+USD_TO_JPY = 150 # 1ドル=150円換算
+
+# 処理段階 (ステージ) の表示名
+STAGE_LABELS = {
+    "vision": "画像OCR",
+    "typo": "誤字脱字",
+    "text_compare": "テキスト比較",
+    "volume_compare": "内容量比較",
+}
+
+
+def estimate_cost_jpy(model, input_tokens, output_tokens):
+    """モデルの料金表から概算コスト(円)を計算する"""
+    input_price, output_price = PRICING_USD_PER_MILLION.get(
+        model, PRICING_USD_PER_MILLION[DEFAULT_MODEL_FOR_PRICING]
+    )
+    cost_usd = (input_tokens / 1_000_000) * input_price + (output_tokens / 1_000_000) * output_price
+    return cost_usd * USD_TO_JPY
+
+
+class UsageEntry:
+    """API呼び出し1回分の使用量"""
+    __slots__ = ("stage", "model", "input_tokens", "output_tokens", "latency")
+
+    def __init__(self, stage, model, input_tokens, output_tokens, latency):
+        self.stage = stage
+        self.model = model
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.latency = latency # 秒
+
+
+class UsageLedger:
+    """
+    1回のOCR実行におけるAPI呼び出しの台帳。
+    呼び出し箇所 (ステージ) ・モデルごとにトークン数とレイテンシを記録し、集計する。
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._routes = [] # (ステージ, 昇格理由 or None) ※モデル振り分けを行った判定のみ
+        self._cache_lookups = [] # (ステージ, キャッシュにヒットしたか) ※OCR・二次チェックのキャッシュを引いた場合のみ
+        self._shared_results = {} # ステージ -> 他のセッション・タスクで実行中の処理の結果を共有した回数
+        self._schema_violations = {} # ステージ -> 応答スキーマ (schemas.py) に沿わなかった応答数
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def record(self, stage, model, input_tokens, output_tokens, latency):
+        with self._lock:
+            self._entries.append(UsageEntry(stage, model, input_tokens, output_tokens, latency))
+
+    def record_route(self, stage, escalation_reason):
+        """軽量モデルでの判定1回分を記録する (強いモデルへ昇格した場合はその理由も)"""
+        with self._lock:
+            self._routes.append((stage, escalation_reason))
+
+    def record_schema_violation(self, stage):
+        """応答スキーマに沿わなかった応答1件を記録する"""
+        with self._lock:
+            self._schema_violations[stage] = self._schema_violations.get(stage, 0) + 1
+
+    def schema_violation_counts(self):
+        """{ステージの表示名: スキーマ違反の応答数}"""
+        with self._lock:
+            return {STAGE_LABELS.get(stage, stage): count for stage, count in self._schema_violations.items()}
+
+    def record_cache(self, stage, hit):
+        """OCR・二次チェックのキャッシュ参照1回分を記録する"""
+        with self._lock:
+            self._cache_lookups.append((stage, hit))
+
+    def record_shared(self, stage):
+        """キャッシュになかったが、実行中の同じ処理の結果を共有した (APIを呼ばなかった) 1回分を記録する"""
+        with self._lock:
+            self._shared_results[stage] = self._shared_results.get(stage, 0) + 1
+
+    def cache_summary(self):
+        """ステージ別のキャッシュ参照回数・ヒット数・ヒット率・実行中の処理との共有数"""
+        with self._lock:
+            lookups = list(self._cache_lookups)
+            shared = dict(self._shared_results)
+        columns = ["ステージ", "参照回数", "ヒット数", "ヒット率", "共有数"]
+        if not lookups:
+            return pd.DataFrame(columns=columns)
+
+        rows = []
+        for stage in dict.fromkeys(s for s, _ in lookups):
+            hits = [h for s, h in lookups if s == stage]
+            rows.append([STAGE_LABELS.get(stage, stage), len(hits), sum(hits), round(sum(hits) / len(hits), 3), shared.get(stage, 0)])
+        return pd.DataFrame(rows, columns=columns)
+
+    def escalation_summary(self):
+        """ステージ別の判定回数・昇格回数・昇格率・理由の内訳"""
+        with self._lock:
+            routes = list(self._routes)
+        columns = ["ステージ", "判定回数", "昇格回数", "昇格率", "昇格理由"]
+        if not routes:
+            return pd.DataFrame(columns=columns)
+
+        rows = []
+        for stage in dict.fromkeys(s for s, _ in routes):
+            reasons = [r for s, r in routes if s == stage]
+            escalated = [r for r in reasons if r]
+            breakdown = {ESCALATION_REASONS.get(r, r): escalated.count(r) for r in dict.fromkeys(escalated)}
+            rows.append([
+                STAGE_LABELS.get(stage, stage),
+                len(reasons),
+                len(escalated),
+                round(len(escalated) / len(reasons), 3),
+                " / ".join(f"{label} {count}" for label, count in breakdown.items()),
+            ])
+        return pd.DataFrame(rows, columns=columns)
+
+    def totals(self):
+        """(入力トークン合計, 出力トークン合計)"""
+        with self._lock:
+            return (
+                sum(e.input_tokens for e in self._entries),
+                sum(e.output_tokens for e in self._entries),
+            )
+
+    def total_cost_jpy(self):
+        with self._lock:
+            return sum(estimate_cost_jpy(e.model, e.input_tokens, e.output_tokens) for e in self._entries)
+
+    def to_dataframe(self):
+        """呼び出しごとの明細"""
+        with self._lock:
+            return pd.DataFrame(
+                [(e.stage, e.model, e.input_tokens, e.output_tokens, e.latency) for e in self._entries],
+                columns=["stage", "model", "input_tokens", "output_tokens", "latency"],
+            )
+
+    def rollup(self):
+        """ステージ・モデル別の集計 (呼び出し回数・トークン・平均レイテンシ・概算コスト)"""
+        df = self.to_dataframe()
+        if df.empty:
+            return pd.DataFrame(columns=["ステージ", "モデル", "呼び出し回数", "入力トークン", "出力トークン", "平均レイテンシ(秒)", "概算コスト(円)"])
+
+        df["cost"] = [
+            estimate_cost_jpy(m, i, o) for m, i, o in zip(df["model"], df["input_tokens"], df["output_tokens"])
+        ]
+        summary = df.groupby(["stage", "model"], sort=False).agg(
+            calls=("stage", "size"),
+            input_tokens=("input_tokens", "sum"),
+            output_tokens=("output_tokens", "sum"),
+            latency=("latency", "mean"),
+            cost=("cost", "sum"),
+        ).reset_index()
+
+        summary["stage"] = summary["stage"].map(lambda s: STAGE_LABELS.get(s, s))
+        summary["latency"] = summary["latency"].round(2)
+        summary["cost"] = summary["cost"].round(2)
+        summary.columns = ["ステージ", "モデル", "呼び出し回数", "入力トークン", "出力トークン", "平均レイテンシ(秒)", "概算コスト(円)"]
+        return summary
+
+
+def rollup_usage_history(history_records, keys):
+    """
+    過去の実行ログ (ステージ別ログのレコード一覧) を指定キーで集計する。
+    keys 例: ["利用者"], ["事業者コード", "ステージ"]
+    """
+    df = pd.DataFrame(history_records)
+    if df.empty or any(k not in df.columns for k in keys):
+        return pd.DataFrame()
+    numeric_cols = ["呼び出し回数", "入力トークン", "出力トークン", "概算コスト(円)"]
+    for col in numeric_cols:
+        df[col] = pd.to_numeric(df.get(col), errors="coerce").fillna(0)
+    summary = df.groupby(keys)[numeric_cols].sum().reset_index()
+    summary["概算コスト(円)"] = summary["概算コスト(円)"].round(2)
+    return summary.sort_values("概算コスト(円)", ascending=False)